@@ -19,12 +19,32 @@ Purpose:
     they light up mostly proportionately to each other at various intensity
     levels.
 
+Measurements:
+    All the measurement files of a channel are used: each file may hold runs
+    at several PWM frequencies, the runs at the frequency of the set-up (give
+    or take 2%, the PWM board cannot hit the exact frequency anyway) are
+    fused into one curve:
+    1/ each run is normalised (0 at its lowest voltage, 1 at its highest), its
+    noise is estimated from the second differences of its voltages, and the
+    points that stand out of the run (compared to a running median) are
+    rejected,
+    2/ the runs are aligned on the union of their values (%) by linear
+    interpolation,
+    3/ at each value, the points too far from the median of the runs (robust
+    deviation, when there are 3 runs or more) are rejected,
+    4/ the remaining points are averaged, weighted by the inverse of the noise
+    of their run, giving the fused curve and its uncertainty at each value.
+    The segmentation then only cuts a segment when a point is further than
+    the tolerance plus its uncertainty, so adding runs refines the curve
+    without slowing the segmentation: it always works on one point per value.
+
 Tests and adjustments:
     Every time a zero or a power is changed, this program must be run to
-    produce the calibration curves and the webthing server must be restarted.
-    It is possible to change the "curves" live via the "channel_curve" property,
-    but I have not provided a user friendly means to do so.
-    It's easier to just restart the webthing server.
+    produce the calibration curves. The webthing server watches the
+    calibration files and takes the new curves within seconds, no restart
+    needed: the lights are redrawn with them as they are.
+    It is also possible to change the "curves" live via the "channel_curve"
+    property, but I have not provided a user friendly means to do so.
 
     1/ Start the webthing server (webthing_dimmable_LED_strip.py), start the
     gateway, connect to it (browse to the gateway).
@@ -55,6 +75,10 @@ Notes:
     the different LED wavelengths most likely respond differently to PWM and
     voltage, and their perceived brightness may not be solely correlated to the
     input voltage and waveform.
+    When the webthing server applies a perceptual model (the `perceptual`
+    parameter of Dimmable_LED_strip_channels, e.g. CIE lightness), the curve
+    bend common to all channels is done there: powers then only balance the
+    channels against each other and should be around 1.
 
     3/ the values of zeros and powers in this file are only relevant for the
     hardware I used them on, they must be tailored to each and every distinct
@@ -79,6 +103,11 @@ History:
     2020-10-09: V1.1
                 Formatting to text width = 79 characters, pycodestyle
                 Ignored some of the warnings - for higher legibility.
+    2026-10-18: Fusion of all the measurement runs of a channel, with
+                outlier rejection, instead of one file per channel.
+    2026-10-18: Curve family per channel: one curve per measured frequency.
+    2026-10-19: Files replaced in one go, for the server to reload them live.
+    2026-10-19: Notes on powers with the perceptual model of the server.
 
 ===============================================================================
 Future:
@@ -124,25 +153,103 @@ Disclaimer:
 ===============================================================================
 """
 
+import glob
 import pandas
 import numpy
 import pickle
-
-
-def compute_calibration(filename, channel, zeros, powers):
-
-    # Load the measurements (essentially value vs voltage for a given frequency
-    # of a given channel)
-    caldata = pandas.read_csv(filename)
-
-    # Extract only the data relevant for calibration purposes.
-    # Either adjust the frequency to the one relevant to your set-up or remove
-    # the filter but make sure the measurements only record a single frequency.
-    d = caldata[caldata['Frequency (Hz)'] == 991].loc[:, [
-        'Value (%)', 'Voltage (V)']].values
-
-    # sort the data by order of values (first column)
-    d.sort(axis=0)
+import os
+
+
+# Outlier thresholds, in robust standard deviations
+RUN_OUTLIER = 4
+FUSION_OUTLIER = 3.5
+
+
+def robust_std(x, axis=None):
+    # 1.4826 * median absolute deviation: the standard deviation of normally
+    # distributed data, but not thrown off by outliers
+    return 1.4826 * numpy.nanmedian(
+        numpy.abs(x - numpy.nanmedian(x, axis=axis, keepdims=True)), axis=axis)
+
+
+def load_measurements(pattern, frequency, frequency_tolerance=0.02):
+
+    # Load all the measurement files in one data frame, one run per file and
+    # frequency.
+    # The first runs did not record the load name or the channel, they are
+    # not needed here.
+    files = sorted(glob.glob(pattern))
+    caldata = pandas.concat(
+        [pandas.read_csv(f, usecols=['Value (%)', 'Frequency (Hz)',
+                                     'Voltage (V)']).assign(File=i)
+         for i, f in enumerate(files)],
+        ignore_index=True)
+
+    caldata = caldata[(caldata['Frequency (Hz)'] - frequency).abs()
+                      <= frequency_tolerance * frequency]
+    caldata = caldata.sort_values(['File', 'Frequency (Hz)', 'Value (%)'])
+    run = [caldata['File'], caldata['Frequency (Hz)']]
+
+    # 1/ normalise each run, estimate its noise (the second difference of
+    # independent noise has a variance 6 times that of the noise) and reject
+    # the points that stand out of the running median of the run
+    vo = caldata.groupby(run)['Voltage (V)']
+    norm = (caldata['Voltage (V)'] - vo.transform('min')) \
+        / (vo.transform('max') - vo.transform('min'))
+    d2 = norm.groupby(run).diff().groupby(run).diff()
+    noise = (d2.groupby(run).transform(robust_std) / numpy.sqrt(6)).clip(
+        lower=1e-6)
+    median = norm.groupby(run).transform(
+        lambda n: n.rolling(5, center=True, min_periods=1).median())
+    caldata = caldata.assign(Norm=norm, Noise=noise)[
+        (norm - median).abs() <= RUN_OUTLIER * noise]
+
+    # 2/ align the runs on the union of their values
+    values = numpy.unique(caldata['Value (%)'].values)
+    aligned, noises = [], []
+    for (f, hz), points in caldata.groupby(['File', 'Frequency (Hz)']):
+        aligned.append(numpy.interp(values, points['Value (%)'].values,
+                                    points['Norm'].values,
+                                    left=numpy.nan, right=numpy.nan))
+        noises.append(points['Noise'].iloc[0])
+        print(f"    run: {files[f]} at {hz} Hz, {len(points)} points, "
+              f"noise {noises[-1]:.2e}")
+    aligned = numpy.array(aligned)
+    noises = numpy.array(noises)[:, None]
+
+    # 3/ reject the points too far from the median of the runs, when there
+    # are enough runs to tell
+    if len(aligned) >= 3:
+        deviation = numpy.maximum(robust_std(aligned, axis=0), noises)
+        outliers = numpy.abs(aligned - numpy.nanmedian(aligned, axis=0)) \
+            > FUSION_OUTLIER * deviation
+        print(f"    rejected {numpy.sum(outliers)} aligned points")
+        aligned[outliers] = numpy.nan
+
+    # 4/ weighted average and its uncertainty (standard error)
+    weights = numpy.where(numpy.isnan(aligned), 0, 1 / noises**2)
+    total = numpy.sum(weights, axis=0)
+    fused = numpy.sum(numpy.nan_to_num(aligned) * weights, axis=0) / total
+    uncertainty = 1 / numpy.sqrt(total)
+
+    # back to 0 at the lowest value and 1 at the highest: the runs do not
+    # necessarily reach their extremes at the same values
+    span = fused[-1] - fused[0]
+    fused = numpy.clip((fused - fused[0]) / span, 0, 1)
+    uncertainty = uncertainty / span
+
+    # [.0] = Value (% of duty cycle)
+    # [.1] = normalised voltage
+    # [.2] = uncertainty of the normalised voltage
+    return numpy.column_stack((values, fused, uncertainty))
+
+
+def compute_calibration(pattern, channel, zeros, powers, frequency=991):
+
+    # Load and fuse the measurements (essentially value vs voltage for a
+    # given frequency of a given channel), sorted by value.
+    print(f"Channel {channel} at {frequency} Hz:")
+    d = load_measurements(pattern, frequency)
 
     # find the smallest and largest voltages measured (2nd column)
     min_vo = numpy.min(d[:, 1])
@@ -190,10 +297,11 @@ def compute_calibration(filename, channel, zeros, powers):
             # measurement. If we are within the tolerance we keep looking for a
             # longer segment, otherwise we stop and revert one position (last
             # error wihtin tolerance)
+            # The uncertainty of each point is added to the tolerance.
             error = numpy.max(numpy.abs(
                 d[six:(ix+1), 1] - svo -
                 (vo - svo) * (d[six:(ix+1), 0] - sva) / (va - sva)
-            ))
+            ) - d[six:(ix+1), 2])
 
         if (error > tolerance):
             ix,  va,  vo = (pix, pva, pvo)
@@ -209,42 +317,60 @@ def compute_calibration(filename, channel, zeros, powers):
     curve.pop(0)
     curve.pop(1.0)
 
-    # save the curve object for easy retrieval and so we do not have to compute
-    # this every time we start the webthing server.
-    with open(f"Calibration-channel{channel}.pkl", "wb") as f:
-        pickle.dump(curve, f, pickle.HIGHEST_PROTOCOL)
+    return curve
+
+
+def measured_frequencies(pattern, frequency_tolerance=0.02):
 
-    print(f"Saved file 'Calibration-channel{channel}.pkl': {curve}.")
+    # The frequencies of all the runs of a channel, only keeping one of those
+    # that are close enough to be fused (see load_measurements)
+    frequencies = numpy.unique(numpy.concatenate([
+        pandas.read_csv(f, usecols=['Frequency (Hz)'])['Frequency (Hz)'].values
+        for f in glob.glob(pattern)]))
+
+    kept = []
+    for frequency in frequencies:
+        if len(kept) == 0 or frequency > kept[-1] * (1 + frequency_tolerance):
+            kept.append(int(frequency))
+    return kept
+
+
+def save_calibration(filename, calibration):
+
+    # save the curve (or curve family) object for easy retrieval and so we do
+    # not have to compute this every time we start the webthing server.
+    # The server reloads the file when it changes: it must never see it half
+    # written.
+    with open(f"{filename}.tmp", "wb") as f:
+        pickle.dump(calibration, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(f"{filename}.tmp", filename)
+
+    print(f"Saved file '{filename}': {calibration}.")
 
 
 # Below, use data specific to your hardware set-up:
 #   See comments at the begining of this file for how to set zeros and power
 #   and how to take the measurements.
-#   Change file names to match your set-up.
+#   Change file names to match your set-up: all the files matching the
+#   pattern of a channel are fused.
 
 # Red Green White Blue
 zeros = [0.031, 0.0338, 0.0073, 0.23]
 powers = [1.59, 1.63, 1.29, 2.2]
 
-compute_calibration(
-    'LED measurements - Channel 2 - White LED strip, 1 channel '
-                        '- 2020-10-03 10:57:23.csv',            2,
-    zeros, powers
-)
-compute_calibration(
-    'LED measurements - Channel 0 - RGB LED strip, 3 channels, '
-                        'Red wire - 2020-10-03 16:45:22.csv',   0,
-    zeros, powers
-)
-compute_calibration(
-    'LED measurements - Channel 1 - RGB LED strip, 3 channels, '
-                        'Green wire - 2020-10-03 20:10:48.csv', 1,
-    zeros, powers
-)
-compute_calibration(
-    'LED measurements - Channel 3 - RGB LED strip, 3 channels, '
-                        'Blue wire - 2020-10-04 00:43:18.csv',  3,
-    zeros, powers
-)
+for channel in (2, 0, 1, 3):
+    pattern = f'LED measurements - Channel {channel} - *.csv'
+
+    # The curve at the frequency of the set-up
+    save_calibration(f"Calibration-channel{channel}.pkl",
+                     compute_calibration(pattern, channel, zeros, powers))
+
+    # The curve family: one curve per measured frequency, so that the
+    # webthing server can change the PWM frequency (the "frequency" property)
+    save_calibration(f"Calibration-channel{channel}-family.pkl", {
+        frequency: compute_calibration(pattern, channel, zeros, powers,
+                                       frequency)
+        for frequency in measured_frequencies(pattern)
+    })
 
 # vi:set expandtab ts=4 sw=4 tw=79:
@@ -0,0 +1,153 @@
+"""
+Module:     Compute-solar-table.py
+
+Purpose:
+    Compute, for the location of the lights, the times of sunrise, sunset,
+    dawn and dusk (civil twilight, sun 6° below the horizon) of every day of
+    the year, for the scheduler of the webthing server
+    (webthing_dimmable_LED_strip.py) to switch lights relative to them
+    ("sunset+15"...) without any computation or network access:
+        python3 Compute-solar-table.py 51.48 -0.01
+    writes "Solar-table.pkl", to copy next to the webthing server.
+
+    The table holds, for each event, one signed 16 bit number of minutes per
+    day of the year (366 days, 29th February included): the time of the
+    event relative to midnight UTC of that day (it may be negative or above
+    1440 far from the Greenwich meridian). Days without the event (polar day
+    or night) hold NONE. From one year to the next, the times differ by less
+    than a minute: the table does not depend on the year.
+
+    The sun position follows the sunrise equation (NOAA approximations),
+    accurate to a minute or two away from the polar circles, which is more
+    than enough to switch the porch lights.
+
+===============================================================================
+Author:     Alain Culos
+            programming-electronics@asoundmove.net
+
+Bio:        I love programming (pro), I love data (pro), I enjoy electronics as
+            a hobby.
+            I have worked on small and large software projects in various
+            industries: Defense (distributed systems, real-time, several
+            seconds), Air Traffic Control (mainframes, real-time, sub-second),
+            FinTech (software as a service, real-time, 10-100 milliseconds),
+            Avionics testing (embedded, milliseconds) and Banking (various
+            credit decision platforms, back office).
+            Now building up my python credentials (learning, practice,
+            sharing and giving back to the community).
+
+Module history:
+    2026-10-19: creation, for the scheduler of the webthing server
+
+===============================================================================
+Copyright:
+    Alain P.M. Culos 2026, all rights reserved.
+
+Licence:
+    You shall not use this code as part of a commercial activity without
+    reaching an explicit written commercial agreement with the author for
+    exclusive or non exclusive commercial use rights. Commercial activity
+    includes any activity that facilitates directly or indirectly another
+    commercial activity even if this software is not used in a commercial
+    product per se.
+    This includes private education, R&D even if indirectly linked to profit...
+
+    You may use the present code and text in part or whole free of charge for
+    any non-commercial activity.
+    This includes state sponsored education, volunteer run organisations, not
+    for profit organisations, and of course hobbyists, open source projects.
+    You must acknowledge the author, include and respect the terms of this
+    licence.
+
+Disclaimer:
+    Use at your own risk.
+
+    The author makes no claim as to suitability for purpose. Any consequence is
+    beyond my control and entirely your responsability.
+"""
+
+import argparse
+import array
+import datetime
+import pickle
+
+import numpy
+
+
+EVENTS = {                  # event: (sun altitude (°), rising)
+    "dawn":     (-6, True),
+    "sunrise":  (-0.833, True),
+    "sunset":   (-0.833, False),
+    "dusk":     (-6, False),
+}
+NONE = -32768               # no such event on that day
+YEAR = 2024                 # a leap year, for the 366 days
+
+
+def solar_table(latitude, longitude):
+    """
+    Return {event: array of minutes after midnight UTC, one per day of the
+    year} for the location (degrees, North and East positive).
+    """
+
+    days = numpy.arange(366)
+    # Julian day of midnight UTC of each day, and days since J2000
+    midnight = (datetime.date(YEAR, 1, 1).toordinal() + 1721424.5) + days
+    n = numpy.ceil(midnight - 2451545.0 + 0.0008)
+
+    # Mean solar noon, solar mean anomaly, equation of the centre, ecliptic
+    # longitude, solar transit and declination of the sun
+    noon = n - longitude / 360
+    M = numpy.radians((357.5291 + 0.98560028 * noon) % 360)
+    C = 1.9148 * numpy.sin(M) + 0.02 * numpy.sin(2 * M) + 0.0003 * numpy.sin(3 * M)
+    ecliptic = numpy.radians((numpy.degrees(M) + C + 180 + 102.9372) % 360)
+    transit = 2451545.0 + noon + 0.0053 * numpy.sin(M) - 0.0069 * numpy.sin(2 * ecliptic)
+    declination = numpy.arcsin(numpy.sin(ecliptic) * numpy.sin(numpy.radians(23.4397)))
+
+    phi = numpy.radians(latitude)
+    table = {}
+    for event, (altitude, rising) in EVENTS.items():
+        cos_hour_angle = ((numpy.sin(numpy.radians(altitude)) - numpy.sin(phi) * numpy.sin(declination))
+                          / (numpy.cos(phi) * numpy.cos(declination)))
+        hour_angle = numpy.degrees(numpy.arccos(numpy.clip(cos_hour_angle, -1, 1)))
+        time = transit - hour_angle / 360 if rising else transit + hour_angle / 360
+        minutes = numpy.round((time - midnight) * 1440).astype(int)
+        minutes[numpy.abs(cos_hour_angle) > 1] = NONE
+        table[event] = array.array("h", minutes.tolist())
+    return table
+
+
+def save_solar_table(filename, latitude, longitude):
+
+    # The webthing server loads the table when it starts.
+    table = {
+        "latitude":     latitude,
+        "longitude":    longitude,
+        "year":         YEAR,
+        "minutes":      solar_table(latitude, longitude),
+    }
+    with open(filename, "wb") as f:
+        pickle.dump(table, f, pickle.HIGHEST_PROTOCOL)
+
+    for day in (0, 79, 171, 265, 355):
+        date = datetime.date(YEAR, 1, 1) + datetime.timedelta(days=day)
+        times = {
+            event: "none" if minutes[day] == NONE else
+                   f"{minutes[day] // 60 % 24:02d}:{minutes[day] % 60:02d}"
+            for event, minutes in table["minutes"].items()
+        }
+        print(f"{date:%d %b} (UTC): {times}")
+    print(f"Saved file '{filename}'.")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sunrise, sunset, dawn and dusk table of the scheduler')
+    parser.add_argument('latitude', type=float, help='degrees, North positive')
+    parser.add_argument('longitude', type=float, help='degrees, East positive')
+    parser.add_argument('--output', default='Solar-table.pkl',
+                        help='table file (default: %(default)s)')
+    arguments = parser.parse_args()
+
+    save_solar_table(arguments.output, arguments.latitude, arguments.longitude)
+
+# vi:set expandtab ts=4 sw=4 tw=79:
@@ -0,0 +1,290 @@
+"""
+Module:     Replay-traffic.py
+
+Purpose:
+    Replay the traffic recorded by the webthing server against a server with
+    simulated hardware, to judge performance changes to
+    "webthing_dimmable_LED_strip.py" against real workloads: gateway polls,
+    slider storms, dashboards holding websockets open, streams.
+
+    Record on the real server:
+        python3 webthing_dimmable_LED_strip.py --record Traffic.pkl
+    Start a server with simulated hardware (no relay clicks, no lights, I2C
+    transfers take the time they would take on the bus):
+        python3 webthing_dimmable_LED_strip.py --simulate
+    Replay, here at 1x, 10x and as fast as possible (0):
+        python3 Replay-traffic.py Traffic.pkl --speed 1 10 0
+
+    Each recording is a scenario, replayed once per speed. HTTP requests and
+    websocket messages are sent at their recorded time (scaled by the speed),
+    requests keep their method, path and body, messages keep their
+    connection. The report of each run gives:
+        latency of HTTP requests and websocket connections (ms),
+        HTTP replies whose status differs from the recording,
+        dropped messages: requests and websocket messages that could not be
+        delivered, and stream frames the server dropped or rejected,
+        hardware writes: commits, I2C writes and bytes, relay toggles, read
+        from the /metrics of the server before and after the run,
+        send lag: how late the replayer was on the recorded timing (if the
+        replayer itself cannot keep up, latencies are not meaningful).
+
+===============================================================================
+Author:     Alain Culos
+            programming-electronics@asoundmove.net
+
+Bio:        I love programming (pro), I love data (pro), I enjoy electronics as
+            a hobby.
+            I have worked on small and large software projects in various
+            industries: Defense (distributed systems, real-time, several
+            seconds), Air Traffic Control (mainframes, real-time, sub-second),
+            FinTech (software as a service, real-time, 10-100 milliseconds),
+            Avionics testing (embedded, milliseconds) and Banking (various
+            credit decision platforms, back office).
+            Now building up my python credentials (learning, practice,
+            sharing and giving back to the community).
+
+Module history:
+    2026-10-18: creation, with traffic recording in the webthing server
+
+===============================================================================
+Copyright:
+    Alain P.M. Culos 2026, all rights reserved.
+
+Licence:
+    You shall not use this code as part of a commercial activity without
+    reaching an explicit written commercial agreement with the author for
+    exclusive or non exclusive commercial use rights. Commercial activity
+    includes any activity that facilitates directly or indirectly another
+    commercial activity even if this software is not used in a commercial
+    product per se.
+    This includes private education, R&D even if indirectly linked to profit...
+
+    You may use the present code and text in part or whole free of charge for
+    any non-commercial activity.
+    This includes state sponsored education, volunteer run organisations, not
+    for profit organisations, and of course hobbyists, open source projects.
+    You must acknowledge the author, include and respect the terms of this
+    licence.
+
+Disclaimer:
+    Use at your own risk.
+
+    The author makes no claim as to suitability for purpose. Any consequence is
+    beyond my control and entirely your responsability.
+"""
+
+import argparse
+import asyncio
+import pickle
+import time
+
+import numpy
+import tornado.httpclient
+import tornado.websocket
+
+
+# Server counters (see Metrics in webthing_dimmable_LED_strip.py) reported
+# for each run
+COUNTERS = ("commits", "i2c_writes", "i2c_bytes", "relay_toggles",
+            "notified_things", "stream_frames", "stream_frames_dropped",
+            "stream_frames_invalid", "slow_callbacks")
+
+
+def load_traffic(filename):
+    """
+    Return the records of a traffic file, see Traffic_recorder in
+    webthing_dimmable_LED_strip.py.
+    """
+
+    records = []
+    with open(filename, "rb") as f:
+        while True:
+            try:
+                records.append(pickle.load(f))
+            except EOFError:
+                break
+    return records
+
+
+async def server_counters(url):
+    """
+    Return the counters of the server, read from its Prometheus metrics.
+    """
+
+    response = await tornado.httpclient.AsyncHTTPClient().fetch(url + "/metrics")
+    counters = {}
+    for line in response.body.decode().splitlines():
+        name, _, value = line.partition(" ")
+        if name.startswith("powerled_") and name.endswith("_total"):
+            counters[name[len("powerled_"):-len("_total")]] = float(value)
+    return counters
+
+
+def latency_summary(latencies):
+    if len(latencies) == 0:
+        return "-"
+    p50, p90, p99 = numpy.percentile(latencies, (50, 90, 99)) * 1000
+    return f"p50 {p50:.1f}  p90 {p90:.1f}  p99 {p99:.1f}  max {max(latencies) * 1000:.1f} ms"
+
+
+class Replay():
+    """
+    One run of a scenario at a given speed (0 = as fast as possible), with at
+    most `connections` HTTP requests in flight.
+    """
+
+    def __init__(self, url, speed, connections=10):
+        self.url                = url.rstrip("/")
+        self.speed              = speed
+        self.client             = tornado.httpclient.AsyncHTTPClient(max_clients=connections)
+        self.slots              = asyncio.Semaphore(connections)
+        self.websockets         = {}    # {connection: future websocket}
+        self.sending            = {}    # {connection: last message task}
+        self.http_latency       = []
+        self.websocket_latency  = []
+        self.send_lag           = []
+        self.status_mismatches  = 0
+        self.messages           = 0
+        self.dropped            = 0
+
+    async def http(self, method, uri, body, status):
+        async with self.slots:
+            start = time.perf_counter()
+            try:
+                response = await self.client.fetch(
+                    self.url + uri, method=method,
+                    body=body if method in ("POST", "PUT", "PATCH") else None,
+                    raise_error=False, allow_nonstandard_methods=True)
+            except Exception:
+                self.dropped += 1
+                return
+            if response.code == 599:    # timeout or connection closed
+                self.dropped += 1
+                return
+            self.http_latency.append(time.perf_counter() - start)
+            if response.code != status:
+                self.status_mismatches += 1
+
+    async def open(self, uri):
+        start = time.perf_counter()
+        try:
+            websocket = await tornado.websocket.websocket_connect("ws" + self.url[4:] + uri)
+        except Exception:
+            return None
+        self.websocket_latency.append(time.perf_counter() - start)
+        asyncio.ensure_future(self.drain(websocket))
+        return websocket
+
+    @staticmethod
+    async def drain(websocket):
+        # Read what the server sends, as a dashboard would
+        while await websocket.read_message() is not None:
+            pass
+
+    async def message(self, connection, message, previous):
+        # Messages of a connection are sent in order
+        if previous is not None:
+            await previous
+
+        websocket = None
+        if connection in self.websockets:
+            websocket = await self.websockets[connection]
+        if websocket is None:
+            self.dropped += 1
+            return
+
+        try:
+            await websocket.write_message(message, binary=isinstance(message, bytes))
+            self.messages += 1
+        except tornado.websocket.WebSocketClosedError:
+            self.dropped += 1
+
+    async def close(self, connection):
+        if connection in self.sending:
+            await self.sending.pop(connection)
+        if connection in self.websockets:
+            websocket = await self.websockets.pop(connection)
+            if websocket is not None:
+                websocket.close()
+
+    async def run(self, records):
+        tasks = []
+        t0    = records[0][0]
+        start = time.perf_counter()
+
+        for t, kind, connection, *data in records:
+            if self.speed > 0:
+                delay = (t - t0) / self.speed - (time.perf_counter() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                else:
+                    self.send_lag.append(-delay)
+            else:
+                await asyncio.sleep(0)
+
+            if kind == "http":
+                method, uri, body, status, _ = data
+                tasks.append(asyncio.ensure_future(self.http(method, uri, body, status)))
+            elif kind == "open":
+                self.websockets[connection] = asyncio.ensure_future(self.open(data[0]))
+            elif kind == "message":
+                self.sending[connection] = asyncio.ensure_future(
+                    self.message(connection, data[0], self.sending.get(connection)))
+                tasks.append(self.sending[connection])
+            elif kind == "close":
+                tasks.append(asyncio.ensure_future(self.close(connection)))
+
+        await asyncio.gather(*tasks)
+        for connection in list(self.websockets):
+            await self.close(connection)
+        return time.perf_counter() - start
+
+
+async def replay(filenames, url, speeds, connections):
+    for filename in filenames:
+        records = load_traffic(filename)
+        if len(records) == 0:
+            print(f"{filename}: no traffic recorded")
+            continue
+
+        for speed in speeds:
+            before   = await server_counters(url)
+            run      = Replay(url, speed, connections)
+            duration = await run.run(records)
+            # let the server finish its fades and notifications
+            await asyncio.sleep(1)
+            after    = await server_counters(url)
+            delta    = {k: after.get(k, 0) - before.get(k, 0)  for k in COUNTERS}
+
+            print(f"{filename} at {f'{speed}x' if speed > 0 else 'full speed'}: "
+                  f"{len(records)} records in {duration:.2f} s "
+                  f"(recorded over {records[-1][0] - records[0][0]:.2f} s)")
+            print(f"    HTTP requests:      {len(run.http_latency)}, {latency_summary(run.http_latency)}")
+            print(f"    status mismatches:  {run.status_mismatches}")
+            print(f"    websockets:         {len(run.websocket_latency)} connected, "
+                  f"{latency_summary(run.websocket_latency)}")
+            print(f"    websocket messages: {run.messages}")
+            print(f"    dropped:            {run.dropped} by the replayer, "
+                  f"{delta['stream_frames_dropped'] + delta['stream_frames_invalid']:.0f} stream frames by the server")
+            print(f"    hardware writes:    {delta['commits']:.0f} commits, {delta['i2c_writes']:.0f} I2C writes "
+                  f"({delta['i2c_writes'] / duration:.1f}/s), {delta['i2c_bytes']:.0f} bytes, "
+                  f"{delta['relay_toggles']:.0f} relay toggles")
+            print(f"    notified webthings: {delta['notified_things']:.0f}, "
+                  f"slow callbacks: {delta['slow_callbacks']:.0f}")
+            if speed > 0:
+                print(f"    send lag:           {latency_summary(run.send_lag)}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay recorded webthing traffic')
+    parser.add_argument('traffic', nargs='+',
+                        help='traffic files recorded with webthing_dimmable_LED_strip.py --record')
+    parser.add_argument('--url', default='http://localhost:8888',
+                        help='webthing server, with simulated hardware (--simulate)')
+    parser.add_argument('--speed', type=float, nargs='+', default=[1],
+                        help='replay speeds, 0 for as fast as possible')
+    parser.add_argument('--connections', type=int, default=10,
+                        help='maximum number of HTTP requests in flight')
+    arguments = parser.parse_args()
+
+    asyncio.run(replay(arguments.traffic, arguments.url, arguments.speed, arguments.connections))
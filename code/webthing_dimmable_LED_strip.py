@@ -76,6 +76,72 @@ Module history:
     2021-02-12: Adding BME280 for temperature, humidity and pressure monitoring
                 Hardware addition, early software development of the sensor
                 functions, my beginnings at using asyncio.
+    2026-10-18: Multiple PWM boards: channels are addressed as (I2C address,
+                channel), boards are initialised on first use and the channels
+                of one board are written in a single I2C burst per commit.
+    2026-10-18: Scenes: named presets of channel values, saved to a file and
+                compiled to PWM duty cycles, applied in one commit or faded in
+                by the frame scheduler.
+    2026-10-18: Channel values, last ON values and default values survive
+                restarts and power cuts, saved through a write-behind journal.
+    2026-10-18: Metrics: counters and latency histograms of the hot paths,
+                served as Prometheus text on /metrics and as the read-only
+                "diagnostics" property.
+    2026-10-18: Event loop monitor: scheduling lag percentiles and callbacks
+                slower than a threshold, with the property that ran them (or
+                the callback, with --debug-loop).
+    2026-10-18: Trace buffer: the hot paths record binary trace records in an
+                in-memory ring buffer instead of formatting DEBUG log lines,
+                dumped on /trace, on errors, and sampled to the log.
+    2026-10-18: Split mode: PWM writes can run in a separate hardware driver
+                process fed by a shared memory command ring, so that web load
+                does not disturb frame timing.
+    2026-10-18: Binary websocket streaming of channel values (/stream) for
+                external sources driving the lights frame by frame.
+    2026-10-18: Bulk updates (/bulk): property changes of several webthings
+                merged into one hardware commit.
+    2026-10-18: Traffic recording (--record) and simulated hardware
+                (--simulate), to replay real workloads with Replay-traffic.py.
+    2026-10-18: PWM frequency switching (property "frequency"), with a family
+                of curves per channel indexed by frequency, compiled to look-up
+                tables.
+    2026-10-18: Self-calibration: with an ADS1115 plugged in, the curves are
+                re-measured in the background while the lights are off and
+                corrected for drift.
+    2026-10-19: Thermal derating: the output of all channels is capped, and
+                the "overheated" event emitted, as the enclosure temperature
+                (BME280) rises past a threshold.
+    2026-10-19: Calibration hot-reload: the calibration files are watched, the
+                curves of the channels whose files changed are compiled in the
+                background and swapped in, the lights redrawn with them.
+    2026-10-19: Audio-reactive mode (property "audio_source"): the lights follow
+                the energy of frequency bands of a WAV file or a PCM stream.
+    2026-10-19: Layered effects (action "overlay"): effects and transient
+                overlays are blended over the channel values, which they leave
+                untouched, and only the result goes to the hardware.
+    2026-10-19: Auto-off (properties "auto_off" and "auto_off_fade"): lights
+                switch off, optionally fading, after a while without command,
+                with the "auto-off" event. Timers on a timer wheel.
+    2026-10-19: Local scheduler (/schedule): scenes and light changes at set
+                times (cron) or relative to sunrise/sunset (table from
+                Compute-solar-table.py), without the gateway.
+    2026-10-19: Relay controller: the 12V supply is switched off after a
+                delay (fades through 0, quick off/on), and PWM output is held
+                back while it comes up.
+    2026-10-19: Phase-staggered PWM: the channels of a board switch on one
+                after the other across the period rather than all together.
+    2026-10-19: Power budget (property "estimated_current"): the current
+                drawn is estimated from the calibration and the output is
+                scaled down when it would exceed what the supply delivers.
+    2026-10-19: Energy metering (property "energy"): kWh of each webthing,
+                from the estimated power of its channels, saved across
+                restarts.
+    2026-10-19: Colour mixing for any set of channels (tunable white, RGB +
+                amber...): each channel has a primary colour, colours are
+                converted with matrices solved when the webthing is set up.
+    2026-10-19: Perceptual brightness (CIE 1931 lightness, gamma or custom)
+                baked in the look-up tables, "raw_channel_brightness" to set
+                channels on the calibration curves only.
 
 TODO, problems to solve:
     1/ SW: think about how to terminate the execution of a pattern mid-way
@@ -187,6 +253,11 @@ Webthing capabilities (what this module provides):
                         Dimmable_LED_strip_webthing.channel_brightness
                         Dimmable_LED_strip_webthing.colour
 
+    Recall scene:       ON if any level > 0, SET all channels of the scene in
+                        one commit (or fade), OFF if all levels = 0
+                        Dimmable_LED_strip_webthing.scenes
+                        Actions: apply_scene, save_scene
+
     Image pattern:      ON if OFF, SET, OFF if last level = 0, if not looping
                         TODO - not yet implemented
 
@@ -572,11 +643,27 @@ Target implementation (all these can be changed to suit your needs):
 from __future__ import division
 from webthing import (Action, Event, Property, MultipleThings, Thing, Value,
                       WebThingServer)
+from webthing.errors import PropertyError
 import logging  # First port of call for debugging
 import time
 import math
 import asyncio
-#import uuid     # TODO: currently unused (came from the example webthing)
+import uuid
+import bisect
+import json
+import itertools
+import argparse
+import array
+import collections
+import threading
+import wave
+import heapq
+import re
+import datetime
+import multiprocessing
+from multiprocessing import shared_memory
+import tornado.web      # To serve metrics next to the webthings (the webthing
+import tornado.websocket# server is a Tornado application)
 
 import RPi.GPIO as GPIO # To control the 12V relay
 import board            # To use the I2C bus
@@ -587,16 +674,28 @@ import busio            # To use the I2C bus
 from adafruit_pca9685 import PCA9685
 import adafruit_bme280
 
+# ADC - ADS1115 (optional)
+# plug-in to measure the MOS FET outputs, for self-calibration.
+try:
+    import adafruit_ads1x15.ads1115
+    import adafruit_ads1x15.analog_in
+except ImportError:
+    adafruit_ads1x15 = None
+
+import os
 import pickle
+import struct
 import numpy
 
 
-#TODO: develop an auto-off timer function - which would trigger this event
-"""
+class OverheatedEvent(Event):
+    def __init__(self, thing, data):
+        Event.__init__(self, thing, 'overheated', data=data)
+
+
 class AutoOffEvent(Event):
     def __init__(self, thing, data):
         Event.__init__(self, thing, 'auto-off', data=data)
-"""
 
 
 #TODO: develop functions to produce smooth intensity transitions when switchiing lights on and off, or changing levels
@@ -613,354 +712,3866 @@ class FadeAction(Action):
 """
 
 
-def scale(value, max_value, name = "value"):
+class OverlayAction(Action):
     """
+    Draw a layer over channels of the webthing for a while, without changing
+    their values (see Compositor), or clear it if no value is given.
     """
 
-    v = 0 if value <= 0 else max_value if value >= 1 else int(value * max_value)
-    logging.debug(f"{name}={value:0.3f} x {max_value} -> scaled {name}={v}")
-    return v
+    def __init__(self, thing, input_):
+        Action.__init__(self, uuid.uuid4().hex, thing, 'overlay', input_=input_)
+
+    def perform_action(self):
+        LED_strip_channels = self.thing.LED_strip_channels
+        layer  = self.input.get('layer', 'overlay')
+        values = {k: v  for k, v in self.input.get('values', {}).items() if k in self.thing.channels}
+        if len(values) == 0:
+            LED_strip_channels.clear_overlay(layer)
+        else:
+            LED_strip_channels.overlay(layer, values, self.input.get('mode', 'replace'),
+                                       self.input.get('duration', 0) / 1000)
 
 
-class Dimmable_LED_strip_channels():
+class ApplySceneAction(Action):
     """
-    This class manages the hardware interface: GPIOs and I2C communications for
-    control of the PWM channels.
-    The reason for separating this layer from the webthing is that we can
-    define muultiple instances of Dimmable_LED_strip_webthing that refer to
-    common channels.
-    This allows to have the best of both worlds: one can manage 4 channels as
-    one entity, or split them in 3+1 channels for example, and change between
-    the two at any time.
+    Recall a scene on all the channels it covers, optionally fading to it.
+    """
+
+    def __init__(self, thing, input_):
+        Action.__init__(self, uuid.uuid4().hex, thing, 'apply_scene', input_=input_)
+
+    def perform_action(self):
+        self.thing.LED_strip_channels.apply_scene(
+            self.input['name'], self.input.get('duration', 0))
+
+
+class SaveSceneAction(Action):
+    """
+    Save the current values of the channels of the webthing as a scene.
+    """
+
+    def __init__(self, thing, input_):
+        Action.__init__(self, uuid.uuid4().hex, thing, 'save_scene', input_=input_)
+
+    def perform_action(self):
+        LED_strip_channels = self.thing.LED_strip_channels
+        LED_strip_channels.save_scene(
+            self.input['name'],
+            {k: LED_strip_channels.value[k]  for k in self.thing.channels})
+
+
+class Metrics():
     """
+    This class counts events and records latencies on the hot paths (commits,
+    I2C writes, notifications, relay toggles, sensor reads).
+    Recording is a dictionary update and, for latencies, a bisect into fixed
+    histogram buckets, cheap enough to stay on in production.
+    """
+
+    PREFIX  = "powerled_"
+    BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+               0.05, 0.1, 0.25, 0.5, 1.0)  # seconds
 
-    def __init__(self, on_off_channel, i2c_bus, frequency, channels, channel_curves):
+    def __init__(self):
+        self.counters   = {}    # {name: count}
+        self.histograms = {}    # {name: [[count per bucket, ..., +Inf],
+                                #         sum, count]}
+        self.reports    = {}    # {name: function returning a report}
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, seconds):
+        if not name in self.histograms:
+            self.histograms[name] = [[0] * (len(self.BUCKETS) + 1), 0.0, 0]
+        histogram = self.histograms[name]
+        histogram[0][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+        histogram[1] += seconds
+        histogram[2] += 1
+
+    def percentile(self, name, p):
+        """
+        Upper bound (seconds) of the bucket that holds the `p` percentile,
+        None if above the last bucket or nothing was recorded.
         """
-        on_off_channel      # The GPIO output pin that controls the relay to
-                            # the transformer
-        i2c_bus             # The I2C bus object - passed as a parameter to
-                            # avoid multiple declarations
-        frequency           # The frequency at which we will operate the PWM
-                            # and therefore the lights
-                            # Note that frequency and channel_curves are
-                            # inter-dependant.
-        channels            # The PWM channels to use for all lights
-        channel_curves      # These curves attempt to correct the non linearity
-                            # between the PWM control value and the voltage
-                            # (TODO: or power?) output.
-                            # The curves are the result of a "manual"
-                            # calibration process.
-                            # See module PWM_and_MOSFET_calibration.py for
-                            # details.
 
-        channels = {        # A dictionary that associates channel names with
-         "channel name":    # Can be anything, it is a label, this will be the
-                            # key to colour data
-         channel_number,    # Channel on the PWM board, this corresponds to a
-                            # given pair of wires
-         ...
-        }
+        buckets, _, count = self.histograms[name]
+        cumulated = 0
+        for bound, n in zip(self.BUCKETS, buckets):
+            cumulated += n
+            if cumulated >= p / 100 * count:
+                return bound
+        return None
 
-        channel_curves = {  # A dictionary that associates channel names with
-                            # curves.
-         "channel name":    # Key to colour data, same same as in the
-                            # `channels` parameter
-          {                 # The curve: a dictionary that associates keys with
-                            # values.
-            brightness:     # The key is a number from 0 to 1 which is the
-                            # intended brightness of the channel to which
-                            # corresponds:
-            PWM_duty_cycle, # The value which is also a number from 0 to 1 but
-                            # represents the PWM duty cycle that needs to be
-                            # set to achieve the wanted brightness.
-            ...
-          }
-        }
+    def prometheus(self):
+        """
+        Return all metrics in the Prometheus text exposition format.
         """
 
-        self.on_off_channel = on_off_channel
-        self.channels       = channels
-        self.channel_curves = channel_curves
+        lines = []
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"# TYPE {self.PREFIX}{name}_total counter")
+            lines.append(f"{self.PREFIX}{name}_total {value}")
 
-        # set-up communication with the PWM board
-        self.PWM_board      = PCA9685(i2c_bus)
+        for name, (buckets, total, count) in sorted(self.histograms.items()):
+            lines.append(f"# TYPE {self.PREFIX}{name}_seconds histogram")
+            cumulated = 0
+            for bound, n in zip(self.BUCKETS + ("+Inf", ), buckets):
+                cumulated += n
+                lines.append(f'{self.PREFIX}{name}_seconds_bucket{{le="{bound}"}} {cumulated}')
+            lines.append(f"{self.PREFIX}{name}_seconds_sum {total}")
+            lines.append(f"{self.PREFIX}{name}_seconds_count {count}")
 
-        self.things         = {}
-        self.all_things     = []
-        self.value          = {}
-        self.last_on_value  = {}
-        self.default_value  = {}
+        return "\n".join(lines) + "\n"
 
-        self.PWM_board.frequency = frequency
+    def diagnostics(self):
+        """
+        Return a summary of all metrics: counters and, for each latency, the
+        count, mean, 50th and 99th percentiles in milliseconds.
+        """
 
-    def register_thing_with_LED_strip_channels(self, thing):
+        latency_ms = {}
+        for name, (_, total, count) in self.histograms.items():
+            p50, p99 = self.percentile(name, 50), self.percentile(name, 99)
+            latency_ms[name] = {
+                "count":    count,
+                "mean":     round(total / count * 1000, 3),
+                "p50":      None if p50 is None else p50 * 1000,
+                "p99":      None if p99 is None else p99 * 1000,
+            }
+
+        diagnostics = {"counters": dict(self.counters), "latency_ms": latency_ms}
+        for name, report in self.reports.items():
+            diagnostics[name] = report()
+        return diagnostics
+
+
+# The metrics of all webthings of this module
+metrics = Metrics()
+
+
+class Loop_monitor():
+    """
+    This class watches the asyncio loop that runs the webthing server: HTTP
+    and websocket handling, property setters (which write to the I2C bus) and
+    the sensor coroutines all share it, so any of them can delay the others
+    (e.g. make a fade stutter).
+    1/ Lag: a probe scheduled every `interval` seconds (loop.call_later)
+    measures how late it runs.
+    2/ Slow callbacks: a probe later than `threshold` seconds means a callback
+    ran that long, it is recorded along with the property or sensor handled
+    since the previous probe (see `blame`). In debug mode (run_server
+    --debug-loop) asyncio times every callback itself (slow_callback_duration)
+    and reports the callback, or the property it handled, rather than the
+    probe; debug mode slows the loop down, it is for finding culprits only.
+    The loop itself is not modified.
+    """
+
+    def __init__(self, interval=0.1, threshold=0.02, history=600):
         """
-        As this module provides for multiple ways to access LED channels, we
-        need to keep tabs as to which "webthing" object refers to which
-        channel, so that we are able to notify the relevant subscribers of
-        state changes.
+        interval            # Seconds between lag measurements
+        threshold           # Seconds above which a callback is slow
+        history             # Number of lag measurements and of slow
+                            # callbacks kept for reporting
         """
 
-        # First call: set-up the GPIO pin to be an output (it controls the
-        # relay to the transformer) as this pin is shared by all channels, it
-        # only makes sense to initialise it once. set it to OFF (no power)
-        if len(self.all_things) == 0:
-            GPIO.setup(self.on_off_channel, GPIO.OUT)
-            GPIO.output(self.on_off_channel, False)
+        self.interval       = interval
+        self.threshold      = threshold
+        self.lags           = collections.deque(maxlen=history)
+        self.slow_callbacks = collections.deque(maxlen=history)
+        self.source         = None
+        self.loop           = None
+        self.handle         = None
+        self.debug          = False
+        self.debug_settings = None      # (debug, slow_callback_duration) to restore
+        self.log_handler    = None
+
+    def blame(self, thing, name):
+        """
+        Attribute the callback currently running to property (or sensor)
+        `name` of `thing`, should it be slow.
+        """
 
-        # Register all "webthing"s that use any channel
-        if not thing in self.all_things:
-            self.all_things.append(thing)
-            logging.info(
-                'Dimmable_LED_strip_channels: '
-                f'len={len(self.all_things)}: {self.all_things}.'
-            )
+        self.source = (thing, name)
 
-        # For each channel, register all "webthing"s that use this channel
-        for c in thing.channels:
-            if not c in self.things:
-                self.things[c] = [thing, ]
-                logging.info(
-                    'Dimmable_LED_strip_channels: '
-                    f'Setting "{thing.title}" to channel {c}.'
-                )
-            else:
-                self.things[c].append(thing)
-                logging.info(
-                    'Dimmable_LED_strip_channels: '
-                    f'Adding "{thing.title}" to channel {c}.'
-                )
+    def start(self, debug=False):
+        """
+        Start measuring the lag on the running loop, `debug` to also have
+        asyncio time every callback (see the class).
+        """
 
-            # initialise channel current value
-            self.value[c]           = 0.0
+        if self.loop is not None:
+            return
+        self.loop  = asyncio.get_event_loop()
+        self.debug = debug
+        if debug:
+            self.debug_settings = (self.loop.get_debug(), self.loop.slow_callback_duration)
+            self.loop.set_debug(True)
+            self.loop.slow_callback_duration = self.threshold
+            self.log_handler = Loop_monitor.Log_handler(self)
+            logging.getLogger("asyncio").addHandler(self.log_handler)
+        self.source = None
+        self.__schedule_probe()
+
+    def stop(self):
+        """
+        Stop measuring, and leave debug mode.
+        """
 
-            # initialise channel value when "webthing" was last ON
-            self.last_on_value[c]   = 0.0
+        if self.loop is None:
+            return
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        if self.debug:
+            logging.getLogger("asyncio").removeHandler(self.log_handler)
+            self.log_handler = None
+            self.loop.set_debug(self.debug_settings[0])
+            self.loop.slow_callback_duration = self.debug_settings[1]
+        self.loop = None
+
+    class Log_handler(logging.Handler):
+        """
+        Catch the "Executing <callback> took 0.050 seconds" warnings of
+        asyncio in debug mode.
+        """
 
-            # initialise channel default value: if last_on are all 0, use default
-            self.default_value[c]   = 0.2
+        def __init__(self, monitor):
+            logging.Handler.__init__(self, logging.WARNING)
+            self.monitor = monitor
 
-            logging.info(
-                'Dimmable_LED_strip_channels: '
-                f'Associated "{c}" channel & '
-                f'on/off pin {self.on_off_channel} '
-                f'with {", ".join((f"""{t.title}""" for t in self.things[c]))}.'
-            )
+        def emit(self, record):
+            if record.msg.startswith("Executing") and len(record.args) == 2:
+                callback, duration = record.args
+                self.monitor.slow_callback(duration, str(callback))
 
-    def OnOff(self, thing, value):
+    def slow_callback(self, duration, callback=None):
+        if self.source is not None:
+            thing, name = self.source
+            source = f'{thing.title}: {name}'
+        else:
+            source = callback or "unknown callback"
+        self.source = None
+
+        self.slow_callbacks.append((time.time(), duration, source))
+        metrics.count("slow_callbacks")
+        logging.warning(f'Loop_monitor: {source} blocked the loop for {duration * 1000:0.1f}ms.')
+
+    def __schedule_probe(self):
+        self.handle = self.loop.call_later(self.interval, self.__probe, self.loop.time() + self.interval)
+
+    def __probe(self, expected):
+        lag = max(0.0, self.loop.time() - expected)
+        self.lags.append(lag)
+        metrics.observe("loop_lag", lag)
+        if lag > self.threshold and not self.debug:
+            self.slow_callback(lag)
+        self.source = None
+        self.__schedule_probe()
+
+    def report(self):
         """
-        Switch channel on (value is True) or off (value is False)
-        If all channels are at 0 (not just those of the current "webthing"
-        (thing)), then turn off the relay.
-        If at least one channel is non zero, then turn on the relay.
+        Return the lag percentiles (ms) over the last measurements and the
+        last slow callbacks.
+        """
+
+        lags = sorted(self.lags)
+        if len(lags) > 0:
+            lag_ms = {
+                f"p{p}": round(lags[min(len(lags) - 1, int(p / 100 * len(lags)))] * 1000, 3)
+                for p in (50, 90, 99)
+            }
+            lag_ms["max"] = round(lags[-1] * 1000, 3)
+        else:
+            lag_ms = {}
+
+        return {
+            "lag_ms":           lag_ms,
+            "slow_callbacks":   [
+                {
+                    "time":         time.strftime('%Y-%m-%d %X', time.localtime(t)),
+                    "duration_ms":  round(d * 1000, 1),
+                    "source":       source,
+                }
+                for t, d, source in list(self.slow_callbacks)[-10:]
+            ],
+        }
+
+
+# The monitor of the loop shared by all webthings of this module
+loop_monitor = Loop_monitor()
+metrics.reports["event_loop"] = loop_monitor.report
+
+
+class Trace_buffer():
+    """
+    This class records what happens on the hot paths (scaling, channel
+    commits, colour conversions, switching on and off) without formatting any
+    text: each record is packed in a preallocated ring buffer as
+        event id, timestamp, name id (channel, webthing...), value
+    The buffer holds the last `capacity` records. It is turned into text only
+    when dumped (on /trace, or in the log on errors) and, if `sample_every` is
+    not 0, one record in `sample_every` is also written to the log.
+    """
+
+    EVENTS = ("scale", "on_off", "brightness", "colour", "channel_brightness",
+              "reset", "frame", "scene", "lit_channels", "colour_convert",
+              "bulk", "output_cap")
+    RECORD = struct.Struct("<HdHf")
+
+    def __init__(self, capacity=4096, sample_every=0):
+        """
+        capacity            # Number of records kept
+        sample_every        # Write one record in `sample_every` to the log,
+                            # 0 to never write any
+        """
+
+        self.capacity       = capacity
+        self.sample_every   = sample_every
+        self.buffer         = bytearray(self.RECORD.size * capacity)
+        self.index          = 0     # Where the next record goes
+        self.count          = 0     # Number of records since the start
+        self.event_ids      = {e: i  for i, e in enumerate(self.EVENTS)}
+        self.names          = []
+        self.name_ids       = {}
+
+    def record(self, event, name, value):
+        """
+        Record `event` for `name` (any label: channel name, webthing title...)
+        with a numerical `value`.
+        """
+
+        name_id = self.name_ids.get(name)
+        if name_id is None:
+            name_id = self.name_ids[name] = len(self.names)
+            self.names.append(name)
+
+        self.RECORD.pack_into(self.buffer, self.index * self.RECORD.size,
+                              self.event_ids[event], time.time(), name_id, value)
+        self.index  = (self.index + 1) % self.capacity
+        self.count += 1
+
+        if self.sample_every and self.count % self.sample_every == 0:
+            logging.info("Trace: %s %s = %s", event, name, value)
+
+    def dump(self):
+        """
+        Return the records, oldest first, as (event, timestamp, name, value).
         """
 
-        logging.info(
-            'Dimmable_LED_strip_channels: '
-            f'{self.on_off_channel} to {"ON" if value else "OFF"}.'
+        if self.count < self.capacity:
+            indices = range(self.index)
+        else:
+            indices = (i % self.capacity  for i in range(self.index, self.index + self.capacity))
+
+        records = []
+        for i in indices:
+            event_id, timestamp, name_id, value = self.RECORD.unpack_from(self.buffer, i * self.RECORD.size)
+            records.append((self.EVENTS[event_id], timestamp, self.names[name_id], value))
+        return records
+
+    def dump_text(self):
+        return "".join(
+            f"{time.strftime('%X', time.localtime(t))}.{int(t % 1 * 1e6):06d}"
+            f" {event} {name} = {value:.9g}\n"
+            for event, t, name, value in self.dump()
         )
 
-        if value:
-            # Switch LEDs ON
-            # Notify subscribers of all webthings that use any channel of the
-            # change to the "on" property.
-            v = {k: self.last_on_value[k]  for k in thing.channels}
+    def dump_to_log(self):
+        logging.error(f'Trace_buffer: last {min(self.count, self.capacity)} records:\n{self.dump_text()}')
+
+
+# The trace of the hot paths of this module
+trace = Trace_buffer()
+
+
+class Trace_handler(tornado.web.RequestHandler):
+    """
+    Serve the content of the trace buffer (GET /trace).
+    """
+
+    def get(self):
+        self.set_header('Content-Type', 'text/plain')
+        self.write(trace.dump_text())
+
+
+class Diagnostics_value(Value):
+    """
+    A read-only property value computed from the metrics when it is read.
+    """
+
+    def __init__(self):
+        Value.__init__(self, {})
+
+    def get(self):
+        return metrics.diagnostics()
+
+
+class Stream_handler(tornado.websocket.WebSocketHandler):
+    """
+    Binary streaming of channel values (websocket on /stream), for external
+    sources that drive the lights frame by frame (music visualiser, video
+    sync box...) without the cost of a property change per frame.
+    Each binary message is one frame, little endian:
+        sequence number     uint32, incremented with every frame
+        first channel       uint16, index of the channel of bit 0 of the mask
+        channel mask        uint32, bit n set: a value follows for channel
+                            "first channel + n"
+        values              uint16 each, 0 = off to 65535 = fully on
+    Channels are indexed in the order of the `channels` parameter of
+    Dimmable_LED_strip_channels.
+    Frames older than the last one received are dropped, the others go to the
+    frame scheduler where the latest value of a channel wins.
+    """
+
+    HEADER = struct.Struct("<IHI")
+
+    def initialize(self, LED_strip_channels):
+        self.LED_strip_channels = LED_strip_channels
+        self.sequence           = None
+
+    def check_origin(self, origin):
+        return True
+
+    def on_message(self, message):
+        if not isinstance(message, bytes) or len(message) < self.HEADER.size:
+            metrics.count("stream_frames_invalid")
+            return
+
+        sequence, first, mask = self.HEADER.unpack_from(message)
+        if self.sequence is not None and (sequence - self.sequence - 1) & 0xffffffff >= 0x7fffffff:
+            metrics.count("stream_frames_dropped")
+            return
+        self.sequence = sequence
+
+        bits = [n  for n in range(32) if mask >> n & 1]
+        if len(message) != self.HEADER.size + 2 * len(bits):
+            metrics.count("stream_frames_invalid")
+            return
+
+        names  = self.LED_strip_channels.channel_names
+        values = struct.unpack_from(f"<{len(bits)}H", message, self.HEADER.size)
+        self.LED_strip_channels.frame_scheduler.stream({
+            names[first + n]: v / 65535  for n, v in zip(bits, values) if first + n < len(names)
+        })
+        metrics.count("stream_frames")
+
+
+class Bulk_handler(tornado.web.RequestHandler):
+    """
+    Change properties of several webthings at once (PUT or POST /bulk), e.g.
+    to switch strips together:
+        {"0": {"on": true}, "1": {"brightness": 40, "colour": "#ffffff"}}
+    Webthings are identified by their index, as in the webthing URLs, and
+    must be lights driven by `LED_strip_channels` (404 otherwise). All
+    changes are checked first (400 and nothing changes if one is invalid),
+    then go to the hardware in a single commit (see
+    Dimmable_LED_strip_channels.bulk).
+    The reply holds the resulting properties of the webthings.
+    """
+
+    PROPERTIES = ("on", "brightness", "colour", "channel_brightness")
+    ID         = re.compile(r"[0-9]+")
+
+    def initialize(self, things, LED_strip_channels):
+        self.things             = things
+        self.LED_strip_channels = LED_strip_channels
+
+    def put(self):
+        try:
+            request = json.loads(self.request.body.decode())
+        except ValueError:
+            self.set_status(400)
+            return
+
+        if not isinstance(request, dict):
+            self.set_status(400)
+            return
+
+        changes = []
+        for thing_id, properties in request.items():
+            if not self.ID.fullmatch(thing_id) or not int(thing_id) < len(self.things):
+                self.set_status(404)
+                return
+            thing = self.things[int(thing_id)]
+
+            if (getattr(thing, "LED_strip_channels", None) is not self.LED_strip_channels
+                or not isinstance(properties, dict)):
+                self.set_status(400)
+                return
+
+            for name, value in properties.items():
+                try:
+                    self.LED_strip_channels.check_change(thing, name, value)
+                except ValueError as e:
+                    self.set_status(400)
+                    self.write(str(e))
+                    return
+                changes.append((thing, name, value))
+
+        self.LED_strip_channels.bulk(changes)
+        for thing in {thing  for thing, _, _ in changes}:
+            thing.restart_auto_off()
+
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps({
+            thing_id: {name: self.things[int(thing_id)].get_property(name)  for name in self.PROPERTIES}
+            for thing_id in request.keys()
+        }))
+
+    def post(self):
+        self.put()
+
+
+class Schedule_handler(tornado.web.RequestHandler):
+    """
+    Read (GET) or replace (PUT or POST) the entries of the scheduler on
+    /schedule, see Scheduler. The reply holds the entries and their next
+    times.
+    """
+
+    def initialize(self, scheduler):
+        self.scheduler = scheduler
+
+    def get(self):
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps({
+            "entries":  self.scheduler.entries,
+            "next":     self.scheduler.report(),
+        }))
+
+    def put(self):
+        try:
+            request = json.loads(self.request.body.decode())
+            if not isinstance(request, dict):
+                raise ValueError("not an object")
+            self.scheduler.update(request)
+        except (ValueError, TypeError) as e:
+            self.set_status(400)
+            self.write(str(e))
+            return
+
+        self.get()
+
+    def post(self):
+        self.put()
+
+
+class Metrics_handler(tornado.web.RequestHandler):
+    """
+    Serve the metrics to Prometheus (GET /metrics).
+    """
+
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(metrics.prometheus())
+
+
+class Traffic_recorder():
+    """
+    This class records the traffic served by the webthing server (see
+    run_server --record) so that real workloads (gateway polls, slider
+    storms, dashboards holding websockets open) can be replayed against a
+    server with simulated hardware, see Replay-traffic.py.
+    Records are pickled tuples appended to the file:
+        (time, "http", 0, method, uri, body, status, duration)
+        (time, "open", connection, uri)
+        (time, "message", connection, message)
+        (time, "close", connection)
+    where connection numbers the websockets. Outgoing messages are not
+    recorded. The file is written through a buffer flushed every
+    `flush_interval` seconds.
+    """
+
+    def __init__(self, filename, flush_interval=1):
+        self.file           = open(filename, "ab")
+        self.flush_interval = flush_interval
+        self.flush_pending  = False
+        self.connection_ids = itertools.count(1)
+
+    def record(self, *record):
+        pickle.dump((time.time(), ) + record, self.file, pickle.HIGHEST_PROTOCOL)
+        metrics.count("traffic_records")
+
+        if not self.flush_pending:
+            self.flush_pending = True
+            asyncio.get_event_loop().call_later(self.flush_interval, self.flush)
+
+    def flush(self):
+        self.flush_pending = False
+        self.file.flush()
+
+    def start(self, application):
+        """
+        Hook into the Tornado `application` of the webthing server: its
+        request log for HTTP requests, and the websocket handlers of its
+        routes for websocket traffic.
+        """
+
+        log_request = application.log_request
+
+        def log_and_record(handler):
+            # 101: websocket upgrade, recorded by open
+            if handler.get_status() != 101:
+                request = handler.request
+                self.record("http", 0, request.method, request.uri, request.body,
+                            handler.get_status(), request.request_time())
+            log_request(handler)
+
+        application.log_request = log_and_record
+
+        for rule in application.wildcard_router.rules:
+            if (isinstance(rule.target, type)
+                and issubclass(rule.target, tornado.websocket.WebSocketHandler)):
+                self.__wrap(rule.target)
+
+        logging.info(f'Traffic_recorder: recording to {self.file.name}.')
+
+    def __wrap(self, handler_class):
+        recorder = self
+        open_, on_message, on_close = handler_class.open, handler_class.on_message, handler_class.on_close
+
+        def open(self, *args, **kwargs):
+            self.traffic_connection = next(recorder.connection_ids)
+            recorder.record("open", self.traffic_connection, self.request.uri)
+            return open_(self, *args, **kwargs)
+
+        def message(self, message):
+            recorder.record("message", getattr(self, "traffic_connection", 0), message)
+            return on_message(self, message)
+
+        def close(self):
+            recorder.record("close", getattr(self, "traffic_connection", 0))
+            return on_close(self)
+
+        handler_class.open, handler_class.on_message, handler_class.on_close = open, message, close
+
+    def stop(self):
+        self.file.close()
+
+
+def scale(value, max_value, name = "value"):
+    """
+    """
+
+    v = 0 if value <= 0 else max_value if value >= 1 else int(value * max_value)
+    trace.record("scale", name, v)
+    return v
+
+
+class PWM_boards():
+    """
+    This class manages the PCA9685 boards that share the I2C bus.
+    Boards are identified by their I2C address (0x40 by default, up to 62
+    boards depending on how the 6 address pins are soldered) and they are only
+    initialised the first time one of their channels is used.
+    Each board keeps a copy of its LED registers so that all the channels of a
+    board that change in one commit are written in a single I2C burst (the
+    PCA9685 auto-increments the register address, this is switched on when the
+    frequency is set).
+    The channels of a board do not all switch on at the start of the PWM
+    period: each lit channel switches on where the previous one switches off
+    (LEDn_ON offset), so that their conduction is spread across the period
+    and the current drawn from the supply is smoother. The offsets are
+    rebalanced whenever a duty cycle changes and the channels whose offset
+    moved are written in the same burst.
+    """
+
+    DEFAULT_ADDRESS = 0x40
+    LED0_ON_L       = 0x06  # First LED register, 4 registers per channel:
+                            # ON_L, ON_H, OFF_L, OFF_H
+    FULL_ON_OFF     = 0x1000
+
+    def __init__(self, i2c_bus, frequency):
+        """
+        i2c_bus             # The I2C bus object shared by all boards
+        frequency           # The frequency at which we will operate the PWMs
+        """
+
+        self.i2c_bus    = i2c_bus
+        self.frequency  = frequency
+        self.boards     = {}
+        self.registers  = {}    # {address: [(ON, OFF), ... 16 channels]}
+        self.duty_cycles = {}   # {address: [duty cycle, ... 16 channels]}
+
+    def board(self, address):
+        """
+        Return the board at `address`.
+        On first use, set the frequency and switch all its channels fully off,
+        so that the copy of the registers matches the board.
+        """
+
+        if not address in self.boards:
+            logging.info(f'PWM_boards: initialising PCA9685 at 0x{address:02x}.')
+            board = PCA9685(self.i2c_bus, address=address)
+            board.frequency = self.frequency
+            self.boards[address]    = board
+            self.registers[address] = [(0, self.FULL_ON_OFF)] * 16
+            self.duty_cycles[address] = [0] * 16
+            self.__write(address, 0, 15)
+
+        return self.boards[address]
+
+    @classmethod
+    def duty_cycle_registers(cls, duty_cycle):
+        """
+        Convert a 16 bit duty cycle to the (ON, OFF) 12 bit counts of a LED
+        register, the same way adafruit_pca9685 does it.
+        """
+
+        if duty_cycle >= 0xffff:
+            return (cls.FULL_ON_OFF, 0)
+        if duty_cycle < 0x0010:
+            return (0, cls.FULL_ON_OFF)
+        return (0, duty_cycle >> 4)
+
+    @classmethod
+    def staggered_registers(cls, duty_cycles):
+        """
+        Convert the 16 bit duty cycles of the channels of a board to (ON, OFF)
+        counts where each channel that is neither fully on nor fully off
+        starts where the previous one stops, wrapping around the period (the
+        PCA9685 accepts OFF < ON).
+        """
+
+        registers = []
+        phase     = 0
+        for duty_cycle in duty_cycles:
+            on, off = cls.duty_cycle_registers(duty_cycle)
+            if on != cls.FULL_ON_OFF and off != cls.FULL_ON_OFF:
+                on, off = phase, (phase + off) & 0x0fff
+                phase   = off
+            registers.append((on, off))
+        return registers
+
+    def write(self, duty_cycles):
+        """
+        duty_cycles = {     # The duty cycles to set in this commit
+         (address,          # I2C address of the board
+          channel):         # Channel on the board
+         duty_cycle,        # 16 bit PWM duty cycle
+         ...
+        }
+
+        Write the duty cycles, one I2C burst per board that covers the
+        channels from the lowest to the highest one that is set or whose
+        phase offset moved.
+        """
+
+        per_board = {}
+        for (address, channel), duty_cycle in duty_cycles.items():
+            if not address in per_board:
+                per_board[address] = {}
+            per_board[address][channel] = duty_cycle
+
+        for address, channels in per_board.items():
+            self.board(address)
+            board_duty_cycles = self.duty_cycles[address]
+            for channel, duty_cycle in channels.items():
+                board_duty_cycles[channel] = duty_cycle
+            registers = self.staggered_registers(board_duty_cycles)
+            moved     = [channel for channel, pair in enumerate(registers)
+                         if pair != self.registers[address][channel]]
+            self.registers[address] = registers
+            first = min(min(channels), min(moved, default=15))
+            last  = max(max(channels), max(moved, default=0))
+            self.__write(address, first, last)
+
+    def __write(self, address, first, last):
+        """
+        Write the registers of channels `first` to `last` (included) of the
+        board at `address` in one I2C transaction.
+        """
+
+        buffer = bytearray(1 + 4 * (last - first + 1))
+        buffer[0] = self.LED0_ON_L + 4 * first
+        for i, (on, off) in enumerate(self.registers[address][first:last + 1]):
+            struct.pack_into("<HH", buffer, 1 + 4 * i, on, off)
+
+        start = time.perf_counter()
+        with self.boards[address].i2c_device as i2c:
+            i2c.write(buffer)
+        metrics.observe("i2c_write", time.perf_counter() - start)
+        metrics.count("i2c_writes")
+        metrics.count("i2c_bytes", len(buffer))
+
+    def set_frequency(self, frequency):
+        """
+        Change the PWM frequency of all the boards, the LED registers are
+        kept.
+        """
+
+        self.frequency = frequency
+        for board in self.boards.values():
+            board.frequency = frequency
+
+    def stop(self):
+        """
+        Nothing to release, the boards keep their last setting.
+        """
+
+        pass
+
+
+class PWM_driver_process():
+    """
+    This class offers the same `write` as PWM_boards, but the PWM boards are
+    driven by a separate process (split mode): the web process never touches
+    the I2C bus, so HTTP load or garbage collection pauses in the web process
+    do not show up as jitter in fades.
+    Commands go through a ring buffer in shared memory, one record per
+    channel:
+        timestamp, sequence number, duty cycle, board address, channel,
+        last record of the commit (0 or 1)
+    There is a single writer (the web process) and a single reader (the
+    driver process), so no lock is needed: the writer publishes a record by
+    writing its sequence number last, the reader only takes records whose
+    sequence number is the one it expects. The driver applies complete
+    commits only, merging all those waiting into one write per board.
+    The driver reports back, also in shared memory, the duty cycle applied to
+    each channel, the number of commits applied and the latency of the last
+    one.
+    A frequency change is a commit of one record with board address
+    FREQUENCY and the frequency as duty cycle, applied in order with the
+    other commits.
+    If the driver process dies, or does not make room in the ring within
+    MAX_WAIT seconds, it is stopped and the PWM boards are written directly
+    (as without split mode) from then on, starting with the latest duty
+    cycle of every channel: the event loop is never blocked for longer.
+    """
+
+    HEADER  = struct.Struct("<IIIId")   # write index, read index, commits
+                                        # applied, stop, last latency (s)
+    RECORD  = struct.Struct("<dIHBBB")
+    STATE   = struct.Struct("<H")       # Applied duty cycle, 16 per board
+    MASK    = 0xffffffff
+    FREQUENCY = 0xff                    # Board address of frequency changes
+    MAX_WAIT  = 0.1                     # Seconds a write waits for the driver
+
+    def __init__(self, frequency, capacity=4096, simulated=False):
+        """
+        frequency           # The frequency at which we will operate the PWMs
+        capacity            # Number of records in the ring
+        simulated           # True to drive a Simulated_I2C bus
+        """
+
+        self.capacity       = capacity
+        self.frequency      = frequency
+        self.simulated      = simulated
+        self.duty_cycles    = {}    # Latest duty cycle of each channel
+        self.fallback       = None  # PWM_boards written directly once the
+                                    # driver has failed
+        self.state_offset   = self.HEADER.size + capacity * self.RECORD.size
+        self.memory         = shared_memory.SharedMemory(
+            create=True, size=self.state_offset + 64 * 16 * self.STATE.size)
+        self.buffer         = self.memory.buf
+        self.buffer[:]      = bytes(len(self.buffer))
+        self.write_index    = 0
+        self.wakeup         = multiprocessing.Semaphore(0)
+
+        self.process = multiprocessing.Process(
+            target=run_PWM_driver,
+            args=(self.memory.name, capacity, frequency, self.wakeup, simulated),
+            daemon=True,
+        )
+        self.process.start()
+        logging.info(f'PWM_driver_process: started driver process {self.process.pid}.')
+        metrics.reports["hardware_driver"] = self.report
+
+    def write(self, duty_cycles):
+        """
+        Queue one commit, see PWM_boards.write.
+        """
+
+        if len(duty_cycles) == 0:
+            return
+        if self.fallback is not None:
+            self.fallback.write(duty_cycles)
+            return
+
+        self.duty_cycles.update(
+            (PWM_address, d)  for PWM_address, d in duty_cycles.items() if PWM_address[0] != self.FREQUENCY)
+        if not self.process.is_alive():
+            self.__fall_back(f'driver process exited ({self.process.exitcode})')
+            return
+
+        # The ring is only full if the driver is stuck, wait for it (a
+        # little) rather than lose part of a commit.
+        deadline = time.monotonic() + self.MAX_WAIT
+        while (self.write_index + len(duty_cycles) - self.__read_index()) & self.MASK > self.capacity:
+            metrics.count("driver_ring_full")
+            if not self.process.is_alive() or time.monotonic() > deadline:
+                self.__fall_back('driver process stuck, ring full')
+                return
+            time.sleep(0.001)
+
+        now  = time.time()
+        last = len(duty_cycles) - 1
+        for i, ((address, channel), duty_cycle) in enumerate(duty_cycles.items()):
+            offset = self.HEADER.size + (self.write_index % self.capacity) * self.RECORD.size
+            self.RECORD.pack_into(self.buffer, offset, now, 0, duty_cycle, address, channel, i == last)
+            self.write_index = (self.write_index + 1) & self.MASK
+            # Publish the record
+            struct.pack_into("<I", self.buffer, offset + 8, self.write_index)
+
+        struct.pack_into("<I", self.buffer, 0, self.write_index)
+        self.wakeup.release()
+        metrics.count("driver_commits")
+
+    def __fall_back(self, reason):
+        """
+        Stop the driver process and write the PWM boards directly from now
+        on, starting with the latest duty cycles of all the channels.
+        """
+
+        logging.error(f'PWM_driver_process: {reason}, writing to the PWM boards directly.')
+        metrics.count("driver_fallbacks")
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join(1)
+        self.fallback = PWM_boards(Simulated_I2C() if self.simulated else busio.I2C(board.SCL, board.SDA),
+                                   self.frequency)
+        self.fallback.write(self.duty_cycles)
+
+    def set_frequency(self, frequency):
+        """
+        Queue a change of the PWM frequency of all the boards.
+        """
+
+        self.frequency = frequency
+        if self.fallback is not None:
+            self.fallback.set_frequency(frequency)
+            return
+        self.write({(self.FREQUENCY, 0): frequency})
+
+    def __read_index(self):
+        return struct.unpack_from("<I", self.buffer, 4)[0]
+
+    def applied_duty_cycles(self, PWM_addresses):
+        """
+        Return the duty cycles applied by the driver to the given (board
+        address, channel).
+        """
+
+        if self.fallback is not None:
+            return {
+                (address, channel): self.fallback.duty_cycles.get(address, [0] * 16)[channel]
+                for address, channel in PWM_addresses
+            }
+        return {
+            (address, channel): self.STATE.unpack_from(
+                self.buffer,
+                self.state_offset + ((address & 0x3f) * 16 + channel) * self.STATE.size)[0]
+            for address, channel in PWM_addresses
+        }
+
+    def report(self):
+        write_index, read_index, applied, _, latency = self.HEADER.unpack_from(self.buffer, 0)
+        return {
+            "alive":            self.process.is_alive(),
+            "fallback":         self.fallback is not None,
+            "commits_applied":  applied,
+            "queued_records":   (write_index - read_index) & self.MASK,
+            "last_latency_ms":  round(latency * 1000, 3),
+        }
+
+    def stop(self):
+        """
+        Let the driver apply what is queued, then stop it.
+        """
+
+        struct.pack_into("<I", self.buffer, 12, 1)
+        self.wakeup.release()
+        self.process.join(5)
+        self.buffer.release()
+        self.memory.close()
+        self.memory.unlink()
+        logging.info('PWM_driver_process: stopped.')
+
+
+def run_PWM_driver(memory_name, capacity, frequency, wakeup, simulated=False):
+    """
+    Main loop of the hardware driver process, see PWM_driver_process.
+    """
+
+    HEADER, RECORD, STATE = PWM_driver_process.HEADER, PWM_driver_process.RECORD, PWM_driver_process.STATE
+    memory       = shared_memory.SharedMemory(name=memory_name)
+    buffer       = memory.buf
+    state_offset = HEADER.size + capacity * RECORD.size
+    boards       = PWM_boards(Simulated_I2C() if simulated else busio.I2C(board.SCL, board.SDA),
+                              frequency)
+
+    read_index = 0
+    applied    = 0
+    partial    = {}     # records of a commit not yet complete
+    complete   = {}     # complete commits not yet applied, latest wins
+    timestamp  = 0
+
+    def apply(complete):
+        boards.write(complete)
+        for (address, channel), duty_cycle in complete.items():
+            STATE.pack_into(buffer, state_offset + ((address & 0x3f) * 16 + channel) * STATE.size, duty_cycle)
+
+    while True:
+        wakeup.acquire(timeout=1)
+        stop = struct.unpack_from("<I", buffer, 12)[0]
+        applied_before = applied
+
+        # Drain all the published records
+        while True:
+            offset = HEADER.size + (read_index % capacity) * RECORD.size
+            t, sequence, duty_cycle, address, channel, last = RECORD.unpack_from(buffer, offset)
+            if sequence != (read_index + 1) & PWM_driver_process.MASK:
+                break
+            read_index = (read_index + 1) & PWM_driver_process.MASK
+            if address == PWM_driver_process.FREQUENCY:
+                # Commits queued before the change are applied at the
+                # previous frequency
+                if len(complete) > 0:
+                    apply(complete)
+                    complete = {}
+                boards.set_frequency(duty_cycle)
+                timestamp = t
+                applied  += 1
+                continue
+            partial[(address, channel)] = duty_cycle
+            if last:
+                complete.update(partial)
+                partial   = {}
+                timestamp = t
+                applied  += 1
+
+        struct.pack_into("<I", buffer, 4, read_index)
+
+        if len(complete) > 0:
+            apply(complete)
+        if applied != applied_before:
+            struct.pack_into("<I", buffer, 8, applied)
+            struct.pack_into("<d", buffer, 16, time.time() - timestamp)
+            complete = {}
+
+        if stop:
+            break
+
+    buffer.release()
+    memory.close()
+
+
+class Simulated_I2C():
+    """
+    This class stands in for busio.I2C when there is no hardware to drive
+    (run_server --simulate), e.g. to replay recorded traffic at full speed.
+    Each device is a 256 byte register image: a write sets the register
+    pointer (first byte) then the registers from there on, a read returns the
+    registers from the pointer on (auto-increment, as on the PCA9685 and the
+    BME280). Transfers take the time they would take on a bus at `bit_rate`.
+    The BME280 holds the calibration and readings of the example of its
+    datasheet (25.08 °C, 1006.5 hPa).
+    """
+
+    BME280_ADDRESSES = (0x76, 0x77)
+
+    def __init__(self, bit_rate=100000):
+        self.bit_rate = bit_rate
+        self.devices  = {}      # {address: [register pointer, registers]}
+
+    def device(self, address):
+        if not address in self.devices:
+            registers = bytearray(256)
+            if address in self.BME280_ADDRESSES:
+                registers[0xD0] = 0x60     # chip id
+                struct.pack_into("<HhhHhhhhhhhh", registers, 0x88,
+                                 27504, 26435, -1000,
+                                 36477, -10685, 3024, 2855, 140, -7, 15500, -14600, 6000)
+                registers[0xA1] = 75
+                struct.pack_into("<hBbBbb", registers, 0xE1, 362, 0, 19, 0x29, 3, 30)
+                registers[0xF7:0xFF] = bytes((0x65, 0x5a, 0xc0, 0x7e, 0xed, 0x00, 0x6b, 0x00))
+            self.devices[address] = [0, registers]
+        return self.devices[address]
+
+    def __transfer(self, n):
+        # address byte + n bytes, 9 bits each (with ACK)
+        time.sleep(9 * (n + 1) / self.bit_rate)
+
+    def try_lock(self):
+        return True
+
+    def unlock(self):
+        pass
+
+    def deinit(self):
+        pass
+
+    def scan(self):
+        return list(self.devices)
+
+    def writeto(self, address, buffer, *, start=0, end=None):
+        data = bytes(buffer[start:end])
+        device = self.device(address)
+        if len(data) > 0:
+            device[0] = data[0]
+            for i, b in enumerate(data[1:]):
+                device[1][(device[0] + i) & 0xff] = b
+        self.__transfer(len(data))
+
+    def readfrom_into(self, address, buffer, *, start=0, end=None):
+        pointer, registers = self.device(address)
+        end = len(buffer) if end is None else end
+        for i in range(start, end):
+            buffer[i] = registers[(pointer + i - start) & 0xff]
+        self.__transfer(end - start)
+
+    def writeto_then_readfrom(self, address, buffer_out, buffer_in, *,
+                              out_start=0, out_end=None, in_start=0, in_end=None):
+        self.writeto(address, buffer_out, start=out_start, end=out_end)
+        self.readfrom_into(address, buffer_in, start=in_start, end=in_end)
+
+
+class Simulated_GPIO():
+    """
+    This class stands in for RPi.GPIO when there is no hardware to drive
+    (run_server --simulate): the relay output is only remembered.
+    """
+
+    BCM = 11
+    OUT = 0
+
+    def __init__(self):
+        self.outputs = {}
+
+    def setmode(self, mode):
+        pass
+
+    def setup(self, channel, direction):
+        self.outputs[channel] = False
+
+    def output(self, channel, value):
+        self.outputs[channel] = bool(value)
+
+    def cleanup(self):
+        self.outputs = {}
+
+
+class Timer_wheel():
+    """
+    This class runs many timers (e.g. one auto-off per webthing) on the
+    asyncio loop with a single callback per tick, rather than a sleeping task
+    each. Timers are hashed to the slot of the tick they are due at, modulo
+    `slots`: starting, restarting or cancelling a timer is O(1), and a tick
+    only looks at the timers of its slot (those due then, or whole turns of
+    the wheel later). Timers are late by up to `tick` seconds, never early.
+    The ticks only run while there are timers.
+    """
+
+    def __init__(self, tick=1, slots=512):
+        """
+        tick                # Seconds per tick
+        slots               # Slots of the wheel
+        """
+
+        self.tick           = tick
+        self.wheel          = [{}  for _ in range(slots)]   # [{key: (due tick,
+                                                            #  callback)}]
+        self.slot_of        = {}    # {key: slot}
+        self.current        = self.__now()
+        self.handle         = None
+
+    def __now(self):
+        return int(time.monotonic() / self.tick)
+
+    def schedule(self, key, delay, callback):
+        """
+        Call `callback` in `delay` seconds, replacing the timer of `key`.
+        """
+
+        self.cancel(key)
+        if self.handle is None:
+            self.current = self.__now()
+        due  = max(self.current + 1, math.ceil((time.monotonic() + delay) / self.tick))
+        slot = due % len(self.wheel)
+        self.wheel[slot][key] = (due, callback)
+        self.slot_of[key] = slot
+        if self.handle is None:
+            self.__next_tick()
+
+    def cancel(self, key):
+        slot = self.slot_of.pop(key, None)
+        if slot is not None:
+            del self.wheel[slot][key]
+
+    def __next_tick(self):
+        self.handle = asyncio.get_event_loop().call_at(
+            asyncio.get_event_loop().time() + self.tick - time.monotonic() % self.tick, self.__tick)
+
+    def __tick(self):
+        self.handle = None
+        # Catch up with the ticks missed while the loop was busy
+        now = self.__now()
+        while self.current < now:
+            self.current += 1
+            timers = self.wheel[self.current % len(self.wheel)]
+            due = [key  for key, (tick, _) in timers.items() if tick <= self.current]
+            for key in due:
+                _, callback = timers.pop(key)
+                del self.slot_of[key]
+                callback()
+            metrics.count("timer_ticks")
+
+        if len(self.slot_of) > 0:
+            self.__next_tick()
+
+    def __len__(self):
+        return len(self.slot_of)
+
+
+class Scheduler():
+    """
+    This class changes the lights at set times, on the device itself so that
+    it does not depend on the gateway. Entries (see Schedule_handler):
+        {"name": {"trigger": "30 23 * * *", "thing": 2, "on": false},
+         "evening": {"trigger": "sunset+15", "scene": "porch", "duration": 5000},
+         ...}
+    The trigger is either
+        cron like: "minute hour day month weekday", each field "*", numbers,
+        ranges and steps ("1-5", "*/15", "0,30"), weekday 0 or 7 = Sunday,
+        in local time,
+        or solar: "sunrise", "sunset", "dawn" or "dusk" (civil twilight),
+        optionally with an offset in minutes ("dusk-10"), from the table
+        computed for the location by Compute-solar-table.py.
+    When an entry is due, its scene is applied (optionally fading over
+    "duration" milliseconds), then its properties ("on", "brightness",
+    "colour", "channel_brightness") are set on its webthing (index, as in the
+    webthing URLs), through the same path as commands from the gateway.
+    The next time of each entry is kept in a heap: the loop sleeps until the
+    first one (at most `max_sleep` seconds, to follow changes of the clock,
+    e.g. set by NTP after boot). Entries due more than `max_late` seconds ago
+    (the clock jumped) are skipped to their next time.
+    """
+
+    SOLAR    = ("dawn", "sunrise", "sunset", "dusk")
+    NONE     = -32768       # no such solar event on that day
+    CRON     = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, things, LED_strip_channels, filename="Schedule.pkl",
+                 solar_table="Solar-table.pkl", max_sleep=600, max_late=60):
+        """
+        things              # The webthings, by index
+        LED_strip_channels  # The Dimmable_LED_strip_channels of the scenes
+        filename            # Where the entries are saved, None not to save
+        solar_table         # Table of Compute-solar-table.py
+        max_sleep           # Longest sleep (seconds)
+        max_late            # Oldest due time still applied (seconds)
+        """
+
+        self.things         = things
+        self.LED_strip_channels = LED_strip_channels
+        self.filename       = filename
+        self.max_sleep      = max_sleep
+        self.max_late       = max_late
+
+        self.solar_table    = None
+        if solar_table is not None and os.path.exists(solar_table):
+            with open(solar_table, "rb") as f:
+                self.solar_table = pickle.load(f)
+        else:
+            logging.warning(f'Scheduler: no table "{solar_table}", solar triggers are off.')
+
+        self.entries        = {}
+        self.triggers       = {}    # {name: parsed trigger}
+        self.heap           = []    # [(time, name)]
+        self.handle         = None
+        metrics.reports["scheduler"] = self.report
+
+        entries = load_schedule(filename)
+        for name, entry in list(entries.items()):
+            try:
+                self.check_entry(name, entry)
+            except ValueError as e:
+                logging.warning(f'Scheduler: entry "{name}" ignored: {e}.')
+                del entries[name]
+        self.update(entries, save=False)
+
+    def parse_trigger(self, trigger):
+        """
+        Return ("cron", [set of values per field]) or ("solar", event,
+        offset in minutes) for `trigger`, raise ValueError if invalid.
+        """
+
+        trigger = str(trigger).strip()
+        for event in self.SOLAR:
+            if trigger.startswith(event):
+                offset = trigger[len(event):].replace(" ", "")
+                if self.solar_table is None:
+                    raise ValueError(f"no solar table for {trigger!r}")
+                return ("solar", event, int(offset) if offset else 0)
+
+        fields = trigger.split()
+        if len(fields) != len(self.CRON):
+            raise ValueError(f"{trigger!r} is neither cron like nor solar")
+        values = []
+        for field, (low, high) in zip(fields, self.CRON):
+            allowed = set()
+            for part in field.split(","):
+                part, _, step = part.partition("/")
+                if part == "*":
+                    first, last = low, high
+                elif "-" in part:
+                    first, last = (int(v)  for v in part.split("-", 1))
+                else:
+                    first = last = int(part)
+                    if step:
+                        last = high
+                if not low <= first <= last <= high:
+                    raise ValueError(f"{field!r} out of {low}-{high} in {trigger!r}")
+                allowed.update(range(first, last + 1, int(step) if step else 1))
+            values.append(allowed)
+        # Sunday is 0 or 7, restricted day or weekday fields match either
+        values[4] = {d % 7  for d in values[4]}
+        values.append((fields[2] != "*", fields[4] != "*"))
+        return ("cron", values)
+
+    def next_time(self, trigger, after):
+        """
+        Return the first time (seconds since the epoch) of `trigger` (parsed)
+        strictly after `after`, None if there is none (within a year for solar
+        triggers, 8 years for cron like triggers: 29th February).
+        """
+
+        if trigger[0] == "solar":
+            _, event, offset = trigger
+            minutes = self.solar_table["minutes"][event]
+            day = datetime.datetime.fromtimestamp(after, datetime.timezone.utc).date()
+            # The event of a day may fall on the day before or after, in UTC
+            for d in range(-1, 367):
+                date = day + datetime.timedelta(days=d)
+                # The table is for a leap year: every date has its day
+                m = minutes[date.replace(year=self.solar_table["year"]).timetuple().tm_yday - 1]
+                if m == self.NONE:
+                    continue
+                midnight = datetime.datetime(date.year, date.month, date.day, tzinfo=datetime.timezone.utc)
+                t = midnight.timestamp() + (m + offset) * 60
+                if t > after:
+                    return t
+            return None
+
+        minutes, hours, days, months, weekdays, (restricted_day, restricted_weekday) = trigger[1]
+        start = datetime.datetime.fromtimestamp(after).replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        for d in range(8 * 366):
+            date = start.date() + datetime.timedelta(days=d)
+            if not date.month in months:
+                continue
+            day_ok, weekday_ok = date.day in days, (date.weekday() + 1) % 7 in weekdays
+            if not ((day_ok or weekday_ok) if restricted_day and restricted_weekday else (day_ok and weekday_ok)):
+                continue
+            for hour in sorted(hours):
+                for minute in sorted(minutes):
+                    t = time.mktime((date.year, date.month, date.day, hour, minute, 0, 0, 0, -1))
+                    if t > after:
+                        return t
+        return None
+
+    def check_entry(self, name, entry):
+        """
+        Return the parsed trigger of entry `name`, raise ValueError if the
+        entry is invalid: it would fail when it fires.
+        """
+
+        if not isinstance(entry, dict) or not "trigger" in entry:
+            raise ValueError(f'entry "{name}" has no trigger')
+        try:
+            index = int(entry.get("thing", 0))
+        except (TypeError, ValueError):
+            raise ValueError(f'entry "{name}": no webthing {entry.get("thing")!r}')
+        if not 0 <= index < len(self.things):
+            raise ValueError(f'entry "{name}": no webthing {index}')
+        if "scene" in entry and not entry["scene"] in self.LED_strip_channels.scenes:
+            raise ValueError(f'entry "{name}": no scene {entry["scene"]!r}')
+
+        thing = self.things[index]
+        for property_name in Bulk_handler.PROPERTIES:
+            if property_name in entry:
+                try:
+                    self.LED_strip_channels.check_change(thing, property_name, entry[property_name])
+                except ValueError as e:
+                    raise ValueError(f'entry "{name}": {e}')
+        return self.parse_trigger(entry["trigger"])
+
+    def update(self, entries, save=True):
+        """
+        Replace all the entries, raise ValueError (changing nothing) if an
+        entry is invalid.
+        """
+
+        triggers = {name: self.check_entry(name, entry)  for name, entry in entries.items()}
+
+        self.entries  = entries
+        self.triggers = triggers
+        now = time.time()
+        self.heap = []
+        for name, trigger in triggers.items():
+            t = self.next_time(trigger, now)
+            if t is not None:
+                self.heap.append((t, name))
+        heapq.heapify(self.heap)
+        if save:
+            save_schedule(self.filename, entries)
+        self.__sleep()
+
+    def __sleep(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        if len(self.heap) == 0:
+            return
+        loop  = asyncio.get_event_loop()
+        delay = min(self.max_sleep, max(0, self.heap[0][0] - time.time()))
+        self.handle = loop.call_at(loop.time() + delay, self.__wake)
+
+    def __wake(self):
+        self.handle = None
+        now = time.time()
+        while len(self.heap) > 0 and self.heap[0][0] <= now:
+            t, name = heapq.heappop(self.heap)
+            if now - t <= self.max_late:
+                try:
+                    self.fire(name)
+                except Exception:
+                    # The other entries, and the next times of this one, go
+                    # on
+                    logging.exception(f'Scheduler: "{name}" failed.')
+                    metrics.count("schedule_errors")
+            else:
+                logging.warning(f'Scheduler: "{name}" skipped, due {now - t:.0f}s ago.')
+            t = self.next_time(self.triggers[name], max(t, now))
+            if t is not None:
+                heapq.heappush(self.heap, (t, name))
+        self.__sleep()
+
+    def fire(self, name):
+        """
+        Apply entry `name` now.
+        """
+
+        entry = self.entries[name]
+        logging.info(f'Scheduler: "{name}" ({entry["trigger"]}).')
+        metrics.count("schedule_triggers")
+        if "scene" in entry:
+            self.LED_strip_channels.apply_scene(entry["scene"], entry.get("duration", 0))
+        thing = self.things[int(entry.get("thing", 0))]
+        for property_name in Bulk_handler.PROPERTIES:
+            if property_name in entry:
+                thing.set_property(property_name, entry[property_name])
+
+    def report(self):
+        return {
+            name: datetime.datetime.fromtimestamp(t).isoformat(timespec="seconds")
+            for t, name in sorted(self.heap)
+        }
+
+    def stop(self):
+        if self.handle is not None:
+            self.handle.cancel()
+
+
+class Relay_controller():
+    """
+    This class switches the relay of the 12V supply (transformer) for the
+    channels: ON as soon as a channel is lit, OFF only once all channels have
+    been off for `off_delay` seconds, so that a fade through 0 or a quick
+    off/on does not cycle the mains power (chatter).
+    After switching ON, the 12V rail needs `settle` seconds to come up: the
+    PWM output is held back until then (see Dimmable_LED_strip_channels.
+    __commit) and `on_switch_on` is called with the settle time (the frame
+    scheduler postpones its fades, so that they are seen from the start).
+    The GPIO is only written when the relay changes.
+    """
+
+    def __init__(self, pin, off_delay=2, settle=0.15, on_switch_on=None):
+        """
+        pin                 # The GPIO output pin that controls the relay
+        off_delay           # Seconds all channels stay off before switching
+                            # OFF
+        settle              # Seconds for the 12V rail to come up after
+                            # switching ON
+        on_switch_on        # Called with `settle` when the relay switches ON
+        """
+
+        self.pin            = pin
+        self.off_delay      = off_delay
+        self.settle         = settle
+        self.on_switch_on   = on_switch_on
+        self.on             = False
+        self.settled_at     = 0     # time.monotonic() when the rail is up
+        self.off_handle     = None
+        self.on_since       = None
+        self.on_seconds     = 0     # total time ON, for wear
+        metrics.reports["relay"] = self.report
+
+    def setup(self):
+        GPIO.setup(self.pin, GPIO.OUT)
+        GPIO.output(self.pin, False)
+
+    def request(self, on):
+        """
+        Ask for the relay ON (a channel is lit) or OFF (all channels off).
+        Return the seconds before the 12V rail is up, 0 if it is up or OFF.
+        """
+
+        if on:
+            if self.off_handle is not None:
+                # Back on before the delay: the relay never moved
+                self.off_handle.cancel()
+                self.off_handle = None
+                metrics.count("relay_offs_cancelled")
+            if not self.on:
+                self.__switch(True)
+                self.settled_at = time.monotonic() + self.settle
+                if self.on_switch_on is not None:
+                    self.on_switch_on(self.settle)
+            return max(0, self.settled_at - time.monotonic())
+
+        if self.on and self.off_handle is None:
+            self.off_handle = asyncio.get_event_loop().call_later(self.off_delay, self.__off)
+        return 0
+
+    def __off(self):
+        self.off_handle = None
+        self.__switch(False)
+
+    def __switch(self, on):
+        GPIO.output(self.pin, on)
+        self.on = on
+        metrics.count("relay_toggles")
+        if on:
+            self.on_since = time.monotonic()
+        else:
+            self.on_seconds += time.monotonic() - self.on_since
+            self.on_since = None
+
+    def report(self):
+        return {
+            "on":               self.on,
+            "switching_off":    self.off_handle is not None,
+            "on_seconds":       round(self.on_seconds + (0 if self.on_since is None else time.monotonic() - self.on_since)),
+        }
+
+    def stop(self):
+        """
+        Switch OFF now.
+        """
+
+        if self.off_handle is not None:
+            self.off_handle.cancel()
+            self.off_handle = None
+        if self.on:
+            self.__switch(False)
+
+
+class Frame_scheduler():
+    """
+    This class produces smooth transitions of channel values (fades) and
+    applies streamed channel values (see Stream_handler).
+    While there is work to do, an asyncio task computes the channel values at
+    a fixed frame rate and commits them to the hardware in one write per
+    frame. Notifications to the webthings are only sent when transitions end
+    and, while values keep changing, at most every `notify_period` seconds
+    (see Dimmable_LED_strip_channels.frame).
+    The latest command wins: setting a channel directly cancels the transition
+    running on that channel, streamed values replace those not yet applied.
+    """
+
+    def __init__(self, LED_strip_channels, frame_rate=50, linger=0.5):
+        """
+        LED_strip_channels  # The Dimmable_LED_strip_channels to drive
+        frame_rate          # Frames per second while there is work to do
+        linger              # Seconds without work before the task stops
+        """
+
+        self.LED_strip_channels = LED_strip_channels
+        self.frame_period       = 1 / frame_rate
+        self.linger             = linger
+        self.transitions        = {}    # {channel name: (start time,
+                                        #  duration, start value, end value)}
+        self.streamed           = {}    # {channel name: value} for the next
+                                        # frame
+        self.last_on            = {}    # {channel name: value} to remember
+                                        # at the end of a fade off
+        self.task               = None
+
+    def fade(self, values, duration, off=False):
+        """
+        Start transitions from the current channel values to `values` over
+        `duration` seconds.
+        If `off` is True (fading to 0), the channels remember the values they
+        faded from as their last ON values, as if switched off.
+        """
+
+        now = time.monotonic()
+        for channel_name, value in values.items():
+            self.streamed.pop(channel_name, None)
+            self.last_on.pop(channel_name, None)
+            start_value = self.LED_strip_channels.value[channel_name]
+            self.transitions[channel_name] = (now, duration, start_value, value)
+            if off and start_value > 0:
+                self.last_on[channel_name] = start_value
+
+        self.__start()
+
+    def stream(self, values):
+        """
+        Set channel `values` at the next frame.
+        """
+
+        for channel_name in values.keys():
+            self.transitions.pop(channel_name, None)
+            self.last_on.pop(channel_name, None)
+        self.streamed.update(values)
+
+        self.__start()
+
+    def cancel(self, channel_names):
+        """
+        Stop the transitions running on `channel_names`, where they are, and
+        forget streamed values not yet applied.
+        """
+
+        for channel_name in channel_names:
+            self.transitions.pop(channel_name, None)
+            self.streamed.pop(channel_name, None)
+            self.last_on.pop(channel_name, None)
+
+    def postpone(self, delay):
+        """
+        Start the running transitions `delay` seconds later (see
+        Relay_controller), their channels are left as they are until then.
+        """
+
+        self.transitions = {
+            k: (start + delay, duration, start_value, end_value)
+            for k, (start, duration, start_value, end_value) in self.transitions.items()
+        }
+
+    def wake(self):
+        """
+        Commit a frame even if no channel value changed (see Compositor).
+        """
+
+        self.__start()
+
+    def __start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.__run())
+
+    async def __run(self):
+        idle_since = None
+        while True:
+            frame_start = time.monotonic()
+            values   = {}
+            finished = []
+            for channel_name, (start, duration, start_value, end_value) in self.transitions.items():
+                if frame_start < start:
+                    # Postponed
+                    continue
+                progress = (frame_start - start) / duration
+                if progress >= 1:
+                    values[channel_name] = end_value
+                    finished.append(channel_name)
+                else:
+                    values[channel_name] = start_value + (end_value - start_value) * progress
+
+            last_on = {}
+            for channel_name in finished:
+                del self.transitions[channel_name]
+                if channel_name in self.last_on:
+                    last_on[channel_name] = self.last_on.pop(channel_name)
+
+            if len(self.streamed) > 0:
+                values.update(self.streamed)
+                self.streamed = {}
+
+            if len(values) > 0 or self.LED_strip_channels.compositor.dirty:
+                idle_since = None
+                self.LED_strip_channels.frame(values, len(finished) > 0, last_on)
+            elif len(self.transitions) > 0:
+                # Only postponed transitions
+                pass
+            elif idle_since is None:
+                idle_since = frame_start
+                self.LED_strip_channels.frame_notify()
+            elif frame_start - idle_since > self.linger:
+                break
+
+            await asyncio.sleep(max(0, self.frame_period - (time.monotonic() - frame_start)))
+
+
+class Audio_reactive():
+    """
+    This class drives channels with audio: each channel follows the energy of
+    a band of frequencies (e.g. Red for the bass, Blue for the treble) of a
+    WAV file or of a raw PCM stream (a FIFO fed by `arecord -t raw -f S16_LE`,
+    or any file of 16 bit little endian samples).
+    A worker thread reads blocks of `hop` samples (one per frame), keeps the
+    last `window` samples, and for each frame:
+    1/ applies a Hann window and a real FFT (NumPy), giving the power of
+    each frequency bin,
+    2/ sums the power of the bins of each band in one matrix product,
+    3/ follows each band with an envelope: its level relative to a peak that
+    decays slowly (automatic gain), smoothed with fast attack and slow
+    release, as one vector operation over all bands.
+    The levels go to the frame scheduler as streamed values, on the event
+    loop: the channel curves are applied through the look-up tables, one
+    commit per frame, and the webthing loop only sees one call per frame.
+    A WAV file is played in real time, a stream paces itself.
+    The last ON values of the channels are those from before the audio once
+    it stops or ends: the audio levels (going through 0 all the time) are not
+    what "on" should bring back.
+    """
+
+    BANDS = {                       # {channel name: (low Hz, high Hz)}
+        "Red":      (20, 250),
+        "Green":    (250, 2000),
+        "Blue":     (2000, 8000),
+        "White":    (40, 120),      # kick drum
+    }
+
+    def __init__(self, LED_strip_channels, channel_names, source, on_end=None,
+                 bands=None, frame_rate=50, window=2048, sample_rate=44100,
+                 channels=1, attack=0.6, release=0.08, decay=0.998, floor=0.02,
+                 noise=-50):
+        """
+        LED_strip_channels  # The Dimmable_LED_strip_channels to drive
+        channel_names       # The channels to drive, those with a band
+        source              # WAV file (.wav) or raw PCM stream
+        on_end              # Called (on the event loop) at the end of the
+                            # source
+        bands               # {channel name: (low Hz, high Hz)}, BANDS by
+                            # default
+        frame_rate          # Frames per second
+        window              # FFT size (samples)
+        sample_rate         # Of a raw PCM stream (a WAV file has its own)
+        channels            # Of a raw PCM stream, mixed down to mono
+        attack              # Share of a rise of level taken per frame
+        release             # Share of a fall of level taken per frame
+        decay               # Of the peak of a band, per frame
+        floor               # Level (relative to the peak) shown as off
+        noise               # Lowest peak (dB full scale), quieter bands
+                            # stay off rather than showing the noise
+        """
+
+        bands = self.BANDS if bands is None else bands
+        self.LED_strip_channels = LED_strip_channels
+        self.channel_names  = [k  for k in channel_names if k in bands]
+        self.bands          = [bands[k]  for k in self.channel_names]
+        self.source         = source
+        self.on_end         = on_end
+        self.frame_rate     = frame_rate
+        self.window         = window
+        self.sample_rate    = sample_rate
+        self.channels       = channels
+        self.attack         = attack
+        self.release        = release
+        self.decay          = decay
+        self.floor          = floor
+        # Energy of a sine at `noise` dBFS through the Hann window
+        self.noise          = window / 4 * 10 ** (noise / 20)
+
+        self.last_on        = {k: LED_strip_channels.last_on_value[k]  for k in self.channel_names}
+        self.loop           = asyncio.get_event_loop()
+        self.stopping       = threading.Event()
+        self.thread         = threading.Thread(target=self.__run, name="Audio_reactive", daemon=True)
+        self.thread.start()
+
+    def __band_matrix(self, sample_rate):
+        """
+        Return the matrix that sums the power of the FFT bins of each band.
+        """
+
+        frequencies = numpy.fft.rfftfreq(self.window, 1 / sample_rate)
+        return numpy.array([
+            (frequencies >= low) & (frequencies < high)  for low, high in self.bands
+        ], dtype=numpy.float32)
+
+    def __open(self):
+        """
+        Return a function reading `n` samples (mono, float), fewer at the end,
+        the sample rate, and whether to pace the reads in real time.
+        """
+
+        if self.source.lower().endswith(".wav"):
+            f = wave.open(self.source, "rb")
+            if f.getsampwidth() != 2:
+                raise ValueError(f"{self.source}: only 16 bit samples are supported")
+            channels = f.getnchannels()
+            read = lambda n: f.readframes(n)
+            sample_rate, realtime = f.getframerate(), True
+        else:
+            f = open(self.source, "rb")
+            channels = self.channels
+            read = lambda n: f.read(2 * channels * n)
+            sample_rate, realtime = self.sample_rate, False
+
+        def samples(n):
+            data = read(n)
+            data = numpy.frombuffer(data[:len(data) // (2 * channels) * 2 * channels], dtype="<i2")
+            return data.reshape(-1, channels).mean(axis=1, dtype=numpy.float32) / 32768
+
+        return samples, sample_rate, realtime, f
+
+    def __run(self):
+        try:
+            samples, sample_rate, realtime, f = self.__open()
+        except (OSError, EOFError, wave.Error, ValueError) as e:
+            logging.warning(f'Audio_reactive: cannot read {self.source}: {e!r}.')
+            self.loop.call_soon_threadsafe(self.__end)
+            return
+
+        hop       = max(1, int(sample_rate / self.frame_rate))
+        hann      = numpy.hanning(self.window).astype(numpy.float32)
+        bands     = self.__band_matrix(sample_rate)
+        buffer    = numpy.zeros(self.window, dtype=numpy.float32)
+        peak      = numpy.full(len(self.bands), self.noise, dtype=numpy.float32)
+        level     = numpy.zeros(len(self.bands), dtype=numpy.float32)
+        next_time = time.monotonic()
+
+        try:
+            while not self.stopping.is_set():
+                block = samples(hop)
+                if len(block) == 0:
+                    break
+                start = time.perf_counter()
+
+                buffer = numpy.roll(buffer, -len(block))
+                buffer[-len(block):] = block
+                power  = numpy.abs(numpy.fft.rfft(buffer * hann)) ** 2
+                energy = numpy.sqrt(bands @ power)
+
+                peak   = numpy.maximum(peak * self.decay, energy)
+                target = numpy.clip((energy / peak - self.floor) / (1 - self.floor), 0, 1)
+                level += (target - level) * numpy.where(target > level, self.attack, self.release)
+
+                self.loop.call_soon_threadsafe(
+                    self.__frame, dict(zip(self.channel_names, level.tolist())),
+                    time.perf_counter() - start)
+
+                if realtime:
+                    next_time += len(block) / sample_rate
+                    time.sleep(max(0, next_time - time.monotonic()))
+        finally:
+            f.close()
+
+        if not self.stopping.is_set():
+            self.loop.call_soon_threadsafe(self.__end)
+
+    def __frame(self, values, analysis_time):
+        if self.stopping.is_set():
+            return
+        metrics.count("audio_frames")
+        metrics.observe("audio_analysis", analysis_time)
+        self.LED_strip_channels.frame_scheduler.stream(values)
+
+    def __end(self):
+        logging.info(f'Audio_reactive: end of {self.source}.')
+        if self.stopping.is_set():
+            return
+        self.__restore_last_on()
+        if self.on_end is not None:
+            self.on_end()
+
+    def __restore_last_on(self):
+        if self.last_on is not None:
+            self.LED_strip_channels.set_last_on_values(self.last_on)
+            self.last_on = None
+
+    def stop(self):
+        """
+        Stop following the audio, the channels stay as they are.
+        """
+
+        self.stopping.set()
+        self.__restore_last_on()
+
+
+class Colour_mixer():
+    """
+    This class converts between colours (#rrggbb) and the channel values of a
+    webthing, for any set of channels: each channel is described by the
+    colour it gives at full brightness (its primary, see PRIMARIES), the
+    primaries are the columns of the mixing matrix (colour = mixing @ channel
+    values). The matrices are solved once, when the webthing is set up:
+    - 3 channels whose primaries span the colours (the most saturated ones,
+      e.g. Red, Green, Blue) form the basis, the inverse of their mixing
+      matrix gives their values,
+    - the other channels (e.g. White, Amber) are extras: in order, from the
+      least saturated, each takes the largest part of the colour its primary
+      fits in (White takes min(r, g, b)), the basis makes up the rest,
+    - without 3 independent primaries (e.g. White alone, warm and cool
+      white), the pseudo-inverse gives the nearest mix.
+    Values are clipped to 0-1. Both conversions take arrays of colours or of
+    channel values (last axis), so a fade or a pattern converts all its
+    frames in one go.
+    """
+
+    PRIMARIES = {
+        "Red":          "#ff0000",
+        "Green":        "#00ff00",
+        "Blue":         "#0000ff",
+        "White":        "#ffffff",
+        "Warm white":   "#ffb46b",
+        "Cool white":   "#d4ebff",
+        "Amber":        "#ffbf00",
+    }
+
+    COLOUR = re.compile(r"#[0-9a-fA-F]{6}")
+
+    def __init__(self, channels, primaries=None):
+        """
+        channels            # Channel names of the webthing
+        primaries           # {channel name: "#rrggbb"}, colour of the
+                            # channels at full brightness, in addition to (or
+                            # instead of) PRIMARIES, channels without a primary
+                            # are left out of colours
+        """
+
+        primaries       = {**self.PRIMARIES, **(primaries or {})}
+        self.channels   = [k  for k in channels if k in primaries]
+        self.mixing     = numpy.array(
+            [self.rgb(primaries[k])  for k in self.channels]
+        ).T.reshape(3, len(self.channels))
+
+        # Most saturated primaries first
+        saturation = [
+            (c.max() - c.min()) / c.max() if c.max() > 0 else 0  for c in self.mixing.T
+        ]
+        order = sorted(range(len(self.channels)), key=lambda i: -saturation[i])
+        basis = []
+        for i in order:
+            if numpy.linalg.matrix_rank(self.mixing[:, basis + [i]]) > len(basis):
+                basis.append(i)
+
+        if len(basis) == 3:
+            self.basis   = basis
+            self.extras  = [i  for i in reversed(order) if not i in basis]
+            self.inverse = numpy.linalg.inv(self.mixing[:, basis])
+        else:
+            self.basis   = None
+            self.extras  = []
+            self.inverse = numpy.linalg.pinv(self.mixing) if len(self.channels) > 0 else None
+
+    @classmethod
+    def rgb(cls, colour):
+        """
+        Return r, g, b (from 0 to 1) of `colour`, raise ValueError if it is
+        not #rrggbb.
+        """
+
+        if not isinstance(colour, str) or not cls.COLOUR.fullmatch(colour):
+            raise ValueError(f"colour {colour!r} is not #rrggbb")
+        return [int(colour[i:i + 2], 16) / 255.0  for i in (1, 3, 5)]
+
+    def channel_values(self, colours):
+        """
+        Return the channel values (last axis in the order of `channels`) of
+        `colours` (last axis r, g, b from 0 to 1).
+        """
+
+        colours = numpy.asarray(colours, dtype=float)
+        if self.basis is None:
+            return numpy.clip(colours @ self.inverse.T, 0, 1)
+
+        values = numpy.zeros(colours.shape[:-1] + (len(self.channels),))
+        rest   = colours.copy()
+        for i in self.extras:
+            primary = self.mixing[:, i]
+            parts   = primary > 0
+            amount  = numpy.clip((rest[..., parts] / primary[parts]).min(axis=-1), 0, 1)
+            values[..., i] = amount
+            rest  -= amount[..., None] * primary
+        values[..., self.basis] = numpy.clip(rest @ self.inverse.T, 0, 1)
+        return values
+
+    def colours(self, values):
+        """
+        Return the colours (last axis r, g, b from 0 to 1) of channel `values`
+        (last axis in the order of `channels`).
+        """
+
+        return numpy.clip(numpy.asarray(values, dtype=float) @ self.mixing.T, 0, 1)
+
+
+class Compositor():
+    """
+    This class holds layers of channel values drawn over the channel values
+    set by the webthings (the base layer), so that an effect or a transient
+    overlay (e.g. a doorbell blink) does not overwrite the state chosen by
+    the user, which comes back as it is when the layer goes.
+    Layers are drawn bottom to top by `order`:
+        0   base        the channel values (Dimmable_LED_strip_channels.value)
+        1   effect      a running effect
+        2   overlay     a transient overlay
+            cap         the output cap (see Thermal_derating), on the duty
+                        cycles
+    Each layer covers some channels, blended with what is below according to
+    its mode:
+        replace         the value of the layer
+        add             the sum, up to 1
+        multiply        the product
+        max             the largest
+    All the layers are combined for all the channels in one vectorised step,
+    when a commit is made (see Dimmable_LED_strip_channels.__commit): a layer
+    change does not write anything by itself, it marks the composite dirty and
+    the frame scheduler commits it at the next frame, with the other changes
+    of that frame. Only the channels whose composite value changed are
+    written.
+    """
+
+    MODES  = ("replace", "add", "multiply", "max")
+    ORDERS = {"effect": 1, "overlay": 2}
+
+    def __init__(self, channel_names):
+        self.channel_names  = channel_names
+        self.index          = {k: i  for i, k in enumerate(channel_names)}
+        self.layers         = {}    # {name: (order, mode, values, mask)}
+        self.stack          = []    # layers, bottom to top
+        self.output         = None  # composite last written, None when there
+                                    # are no layers
+        self.dirty          = False
+
+    def active(self):
+        """
+        Return True if the composite differs, or may differ, from the base
+        layer.
+        """
+
+        return len(self.stack) > 0 or self.output is not None
+
+    def set_layer(self, name, values, mode="replace", order=None):
+        """
+        Draw the layer `name` over the channels of `values` ({channel name:
+        value}), replacing what that layer covered before.
+        """
+
+        if not mode in self.MODES:
+            raise ValueError(f"Compositor: unknown blend mode {mode!r}")
+
+        layer_values = numpy.zeros(len(self.channel_names))
+        mask         = numpy.zeros(len(self.channel_names), dtype=bool)
+        for k, v in values.items():
+            if k in self.index:
+                layer_values[self.index[k]] = min(max(float(v), 0.0), 1.0)
+                mask[self.index[k]]         = True
+
+        order = self.ORDERS.get(name, 1) if order is None else order
+        self.layers[name] = (order, mode, layer_values, mask)
+        self.stack = sorted(self.layers.values(), key=lambda layer: layer[0])
+        self.dirty = True
+
+    def clear_layer(self, name):
+        if self.layers.pop(name, None) is not None:
+            self.stack = sorted(self.layers.values(), key=lambda layer: layer[0])
+            self.dirty = True
+
+    def composite(self, base):
+        """
+        Return the composite of the layers over `base` (array of the channel
+        values).
+        """
+
+        output = base
+        for _, mode, values, mask in self.stack:
+            if mode == "replace":
+                blended = values
+            elif mode == "add":
+                blended = numpy.minimum(output + values, 1)
+            elif mode == "multiply":
+                blended = output * values
+            else:
+                blended = numpy.maximum(output, values)
+            output = numpy.where(mask, blended, output)
+        return output
+
+
+class State_journal():
+    """
+    This class saves the state of the channels (value, last ON value, default
+    value) so that it survives a restart or a power cut.
+    Changes are only kept in memory when they happen (the latest change of a
+    channel wins) and are appended to the journal file, then synced to the SD
+    card, at most once every `flush_interval` seconds. When the journal holds
+    too many records, it is compacted to one record per channel.
+    Record format, one line per record, tab separated:
+        channel name, value, last ON value, default value
+    """
+
+    def __init__(self, filename, flush_interval=10, compact_after=1000):
+        """
+        filename            # The journal file, None to keep the state in
+                            # memory only
+        flush_interval      # Seconds between writes to the journal file
+        compact_after       # Number of records in the journal file above
+                            # which it is compacted
+        """
+
+        self.filename       = filename
+        self.flush_interval = flush_interval
+        self.compact_after  = compact_after
+        self.pending        = {}
+        self.flush_scheduled = False
+        self.records        = 0
+        self.state          = self.__load()
+
+    def __load(self):
+        """
+        Read the journal: return {channel name: (value, last ON value, default
+        value)} from the latest record of each channel.
+        """
+
+        state = {}
+        if self.filename is None or not os.path.exists(self.filename):
+            return state
+
+        with open(self.filename, "rb+") as f:
+            data = f.read()
+            # A power cut may leave the last record incomplete: cut it off,
+            # the next records would be appended to it
+            end = data.rfind(b"\n") + 1
+            if end < len(data):
+                logging.warning(f'State_journal: incomplete last record {data[end:]!r} removed.')
+                f.truncate(end)
+
+        for line in data[:end].decode(errors="replace").splitlines():
+            fields = line.split("\t")
+            if len(fields) != 4:
+                continue
+            try:
+                state[fields[0]] = tuple(float(v)  for v in fields[1:])
+            except ValueError:
+                continue
+            self.records += 1
+
+        logging.info(f'State_journal: restored {state} from {self.records} records.')
+        return state
+
+    def record(self, channel_name, value, last_on_value, default_value):
+        """
+        Record the state of a channel, it is written at the next flush.
+        """
+
+        self.pending[channel_name] = (value, last_on_value, default_value)
+        if self.filename is not None and not self.flush_scheduled:
+            self.flush_scheduled = True
+            asyncio.get_event_loop().call_later(self.flush_interval, self.flush)
+
+    def flush(self):
+        """
+        Append the pending records to the journal file and sync it.
+        """
+
+        self.flush_scheduled = False
+        if self.filename is None or len(self.pending) == 0:
+            return
+
+        with open(self.filename, "a") as f:
+            f.write("".join(
+                f"{k}\t{v[0]!r}\t{v[1]!r}\t{v[2]!r}\n"  for k, v in self.pending.items()))
+            f.flush()
+            os.fsync(f.fileno())
+
+        self.records += len(self.pending)
+        self.state.update(self.pending)
+        self.pending = {}
+
+        if self.records > self.compact_after:
+            self.__compact()
+
+    def __compact(self):
+        """
+        Rewrite the journal with only the latest record of each channel,
+        replacing the previous file in one step.
+        """
+
+        with open(f"{self.filename}.tmp", "w") as f:
+            f.write("".join(
+                f"{k}\t{v[0]!r}\t{v[1]!r}\t{v[2]!r}\n"  for k, v in self.state.items()))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f"{self.filename}.tmp", self.filename)
+
+        logging.info(f'State_journal: compacted {self.records} records to {len(self.state)}.')
+        self.records = len(self.state)
+
+
+class Self_calibration():
+    """
+    This class keeps the channel curves calibrated while the server runs,
+    when an ADS1115 is plugged in with its inputs wired to the MOS FET outputs
+    (through voltage dividers, see PWM_and_MOSFET_calibration.py).
+    Once all lights have been off for `idle_delay` seconds, it lights one
+    channel at a time, for a fraction of a second, at each duty cycle of
+    VALUES and measures the output voltage, sampling in small batches so that
+    the event loop keeps serving. Any command to the lights interrupts the
+    measurement, which is taken again later. A round over all channels is
+    taken every `round_interval` seconds.
+    The first complete pass over a channel (at the current PWM frequency) is
+    its baseline. Each following pass is compared with it: the brightnesses
+    (keys) of the baseline curve move with the normalised voltages measured at
+    the same duty cycles, and the corrected curve is swapped in when it moved
+    by more than `threshold`. The drift of each pass is kept and reported in
+    the diagnostics.
+    """
+
+    VALUES = (0, 0.25, 0.5, 1, 1.5, 2, 3, 4, 5, 6, 8, 10, 12, 15, 20, 25, 30,
+              40, 50, 60, 70, 80, 90, 100)     # PWM duty cycles (%)
+    BATCH  = 8                                  # samples between yields
+
+    def __init__(self, LED_strip_channels, ads, inputs, idle_delay=300,
+                 round_interval=3600, samples=64, threshold=0.002, history=100):
+        """
+        LED_strip_channels  # The Dimmable_LED_strip_channels to calibrate
+        ads                 # The ADS1115
+        inputs              # {channel name: ADS1115 input (0 to 3)}
+        idle_delay          # Seconds with all lights off before measuring
+        round_interval      # Seconds from a round over all channels to the
+                            # next
+        samples             # ADC samples per measurement
+        threshold           # Drift (brightness) above which curves are
+                            # corrected
+        history             # Drifts kept per channel
+        """
+
+        self.LED_strip_channels = LED_strip_channels
+        self.inputs         = {
+            k: adafruit_ads1x15.analog_in.AnalogIn(ads, getattr(adafruit_ads1x15.ads1115, f"P{i}"))
+            for k, i in inputs.items() if k in LED_strip_channels.channels
+        }
+        self.idle_delay     = idle_delay
+        self.round_interval = round_interval
+        self.samples        = samples
+        self.threshold      = threshold
+
+        self.measured       = {}    # {channel name: {value: voltage}}
+        self.baselines      = {}    # {(channel name, frequency):
+                                    #  (normalised voltages, curve)}
+        self.drift          = {k: collections.deque(maxlen=history)  for k in self.inputs}
+        self.round_start    = None
+        self.task           = None
+        metrics.reports["self_calibration"] = self.report
+
+    @classmethod
+    def detect(cls, LED_strip_channels, i2c_bus, inputs, address=0x48, **kwargs):
+        """
+        Return the self-calibration if an ADS1115 answers at `address`, None
+        otherwise (or if its library is not installed).
+        """
+
+        if adafruit_ads1x15 is None:
+            return None
+        try:
+            ads = adafruit_ads1x15.ads1115.ADS1115(i2c_bus, address=address, data_rate=860, mode=0)
+        except (ValueError, OSError):
+            return None
+
+        logging.info(f'Self_calibration: ADS1115 found at 0x{address:02x}.')
+        return cls(LED_strip_channels, ads, inputs, **kwargs)
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.__run())
+
+    async def __run(self):
+        LED_strip_channels = self.LED_strip_channels
+        while True:
+            if (LED_strip_channels.relay_on
+                or time.monotonic() - LED_strip_channels.last_commit < self.idle_delay
+                or (self.round_start is not None
+                    and time.monotonic() - self.round_start < self.round_interval)):
+                await asyncio.sleep(1)
+                continue
+
+            channel_name, value = self.__next_point()
+            if channel_name is None:
+                # Round complete
+                self.round_start = time.monotonic()
+                self.measured    = {}
+                continue
+
+            start   = time.perf_counter()
+            voltage = await self.__measure(channel_name, value)
+            if voltage is None:
+                metrics.count("calibration_interrupted")
+                continue
+
+            metrics.count("calibration_measurements")
+            self.measured.setdefault(channel_name, {})[value] = voltage
+            if len(self.measured[channel_name]) == len(self.VALUES):
+                self.__update(channel_name)
+
+            # Let the LEDs cool down for 40% of the time they were on
+            await asyncio.sleep(0.4 * (time.perf_counter() - start))
+
+    def __next_point(self):
+        for channel_name in self.inputs:
+            measured = self.measured.get(channel_name, {})
+            for value in self.VALUES:
+                if not value in measured:
+                    return channel_name, value
+        return None, None
+
+    async def __measure(self, channel_name, value):
+        """
+        Return the average voltage of `channel_name` at duty cycle `value`
+        (%), None if the measurement was interrupted.
+        """
+
+        LED_strip_channels = self.LED_strip_channels
+        settle = LED_strip_channels.calibration_output(channel_name, int(value / 100 * 0xfffe))
+        if settle is None:
+            return None
+        address = LED_strip_channels.calibrating
+
+        try:
+            # Let the 12V rail, the PWM + LED settle
+            await asyncio.sleep(settle + 0.04)
+            analog_in = self.inputs[channel_name]
+            total = 0
+            for n in range(0, self.samples, self.BATCH):
+                if LED_strip_channels.calibrating != address:
+                    return None
+                for _ in range(self.BATCH):
+                    total += analog_in.voltage
+                await asyncio.sleep(0)
+
+            if LED_strip_channels.calibrating != address:
+                return None
+            return total / (len(range(0, self.samples, self.BATCH)) * self.BATCH)
+        finally:
+            if LED_strip_channels.calibrating == address:
+                LED_strip_channels.calibration_end()
+
+    def __update(self, channel_name):
+        """
+        Compare the complete pass over `channel_name` with its baseline and
+        correct its curve if it drifted.
+        """
+
+        LED_strip_channels = self.LED_strip_channels
+        voltages = numpy.array([self.measured[channel_name][v]  for v in self.VALUES])
+        if voltages[-1] - voltages[0] < 0.01:
+            logging.warning(f'Self_calibration: no output measured on {channel_name}, check the wiring.')
+            return
+        normalised = numpy.maximum.accumulate((voltages - voltages[0]) / (voltages[-1] - voltages[0]))
+
+        key = (channel_name, LED_strip_channels.frequency)
+        if not key in self.baselines:
+            logging.info(f'Self_calibration: baseline of {channel_name} at {key[1]} Hz.')
+            self.baselines[key] = (normalised, LED_strip_channels.channel_curves[channel_name])
+            return
+
+        # Brightness k of the baseline curve was measured at duty cycle
+        # n0^-1(k), which now gives n1(n0^-1(k))
+        baseline, curve = self.baselines[key]
+        if type(curve) is int:
+            return
+        keys  = numpy.array([float(k)  for k in curve])
+        moved = numpy.interp(numpy.interp(keys, baseline, self.VALUES), self.VALUES, normalised)
+        moved = numpy.clip(numpy.maximum.accumulate(moved), 1e-6, 1)
+        drift = float(numpy.max(numpy.abs(moved - keys)))
+        self.drift[channel_name].append((round(time.time()), round(drift, 5)))
+        logging.info(f'Self_calibration: {channel_name} drifted by {drift:.5f}.')
+
+        if drift > self.threshold:
+            metrics.count("calibration_corrections")
+            LED_strip_channels.channel_curve({
+                channel_name: {float(k): v  for k, v in zip(moved, curve.values())}
+            })
+
+    def report(self):
+        return {
+            "baselines":    [f"{k} at {f} Hz"  for k, f in self.baselines],
+            "drift":        {k: list(v)[-10:]  for k, v in self.drift.items()},
+            "max_drift":    {k: max((d for _, d in v), default=None)  for k, v in self.drift.items()},
+        }
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+        self.LED_strip_channels.calibration_end()
+
+
+class Thermal_derating():
+    """
+    This class protects the MOS FETs and the power supply, in the same
+    enclosure as the BME280, from overheating: as the enclosure temperature
+    rises from `start` to `full`, the output cap of all the channels goes down
+    from 100% to `minimum`. The cap moves towards its target by at most
+    `step_down` per reading when heating up, and `step_up` when cooling down,
+    so that the lights dim (and recover) smoothly rather than following the
+    noise of the sensor.
+    Going past `start` emits the "overheated" event on all the webthings,
+    once, until the temperature is back under `start` - `hysteresis`.
+    The cap is a single ratio applied to the duty cycles of each commit (see
+    Dimmable_LED_strip_channels.set_output_cap): the curves are untouched.
+    """
+
+    def __init__(self, LED_strip_channels, start=45, full=60, minimum=0.3,
+                 step_down=0.05, step_up=0.01, hysteresis=3):
+        """
+        LED_strip_channels  # The Dimmable_LED_strip_channels to derate
+        start               # Temperature (°C) from which the output is capped
+        full                # Temperature (°C) at which the cap is `minimum`
+        minimum             # Lowest output cap (0 to 1)
+        step_down           # Largest change of the cap per reading, heating
+        step_up             # Largest change of the cap per reading, cooling
+        hysteresis          # Degrees (°C) under `start` to re-arm the event
+        """
+
+        self.LED_strip_channels = LED_strip_channels
+        self.start          = start
+        self.full           = full
+        self.minimum        = minimum
+        self.step_down      = step_down
+        self.step_up        = step_up
+        self.hysteresis     = hysteresis
+
+        self.temperature    = None
+        self.overheated     = False
+        self.max_temperature = None
+        metrics.reports["thermal_derating"] = self.report
+
+    def target(self, temperature):
+        """
+        Return the output cap for `temperature`.
+        """
+
+        if temperature <= self.start:
+            return 1.0
+        if temperature >= self.full:
+            return self.minimum
+        return 1 - (1 - self.minimum) * (temperature - self.start) / (self.full - self.start)
+
+    def update(self, temperature):
+        """
+        Take a new reading of the enclosure temperature (°C).
+        """
+
+        self.temperature = temperature
+        if self.max_temperature is None or temperature > self.max_temperature:
+            self.max_temperature = temperature
+
+        if temperature > self.start and not self.overheated:
+            self.overheated = True
+            logging.warning(f'Thermal_derating: enclosure at {temperature:.1f}°C, derating the output.')
+            metrics.count("overheated_events")
+            for thing in self.LED_strip_channels.all_things:
+                thing.add_event(OverheatedEvent(thing, round(temperature, 1)))
+        elif temperature < self.start - self.hysteresis and self.overheated:
+            self.overheated = False
+            logging.info(f'Thermal_derating: enclosure back to {temperature:.1f}°C.')
+
+        cap    = self.LED_strip_channels.output_cap
+        target = self.target(temperature)
+        if target < cap:
+            cap = max(target, cap - self.step_down)
+        elif target > cap:
+            cap = min(target, cap + self.step_up)
+        else:
+            return
+
+        trace.record("output_cap", "all", cap)
+        metrics.count("output_cap_changes")
+        self.LED_strip_channels.set_output_cap(cap)
+
+    def report(self):
+        return {
+            "temperature":      self.temperature,
+            "max_temperature":  self.max_temperature,
+            "overheated":       self.overheated,
+            "output_cap":       round(self.LED_strip_channels.output_cap, 3),
+        }
+
+
+class Power_budget():
+    """
+    This class keeps the current drawn by the LED strips within what the 12V
+    supply can deliver: it estimates the current of each commit from a load
+    model of the channels and, when the total goes over `budget`, scales the
+    current of all the lit channels down by the same ratio.
+    The load model takes the normalised output voltage of the calibration
+    (the brightness of the curves, see Compute-LED-calibration.py) as the
+    ratio of the full load current of the strip, `watts` / `voltage`. For each
+    channel, the ratio of full load is tabulated at each of the 4096 counts
+    of the PCA9685, so that estimating the current, as well as finding the
+    duty cycles of the scaled currents, are a single numpy operation for all
+    the channels.
+    The duty cycles asked are remembered: the channels scaled down in one
+    commit are written back as asked when the total is under budget again.
+    """
+
+    COUNTS = 4096   # PWM steps of the PCA9685
+
+    def __init__(self, channel_names, channel_watts, budget=None, voltage=12):
+        """
+        channel_names       # Channel names, in the order of the streams
+        channel_watts       # {channel name: power (W) of the strip at full
+                            # output}, channels not given draw nothing
+        budget              # Current (A) the supply can deliver, None not to
+                            # limit (the current is still estimated)
+        voltage             # Voltage (V) of the supply of the LED strips
+        """
+
+        self.channel_names  = channel_names
+        self.budget         = budget
+        self.amps           = numpy.array([(channel_watts or {}).get(k, 0) / voltage  for k in channel_names])
+        self.index          = {k: i  for i, k in enumerate(channel_names)}
+        self.rows           = numpy.arange(len(channel_names))
+        self.loads          = None  # [channel, count]: ratio of full load
+        self.ranked         = None  # `loads` offset by channel, flattened
+        self.generation     = None  # of the curves of `loads`
+        self.asked          = numpy.zeros(len(channel_names), dtype=int)
+        self.applied        = numpy.zeros(len(channel_names), dtype=int)
+        self.voltage        = voltage
+        self.current        = 0.0   # Estimated current (A) of the applied
+                                    # duty cycles
+        self.watts          = numpy.zeros(len(channel_names))  # Estimated
+                                    # power (W) of each channel
+        self.limited        = False
+        metrics.reports["power_budget"] = self.report
+
+    def compile(self, LUT, generation):
+        """
+        Tabulate the load model from the look-up tables of the channels (see
+        Dimmable_LED_strip_channels.__compile_LUTs), without the perceptual
+        model.
+        """
+
+        duty_cycles = numpy.arange(self.COUNTS) / (self.COUNTS - 1)
+        self.loads = numpy.empty((len(self.channel_names), self.COUNTS))
+        for i, k in enumerate(self.channel_names):
+            x, y, _ = LUT[k][3]
+            # Duty cycle to brightness, non decreasing for the reverse look-up
+            self.loads[i] = numpy.maximum.accumulate(numpy.interp(duty_cycles, y, x))
+        self.loads[:, 0] = 0
+        # Each row offset by its index: one sorted array for all the channels
+        self.ranked = (self.loads + self.rows[:, None]).ravel()
+        self.generation = generation
+
+    def limit(self, duty_cycles):
+        """
+        duty_cycles = {channel name: 16 bit duty cycle, ...}  # asked in this
+                                                              # commit
+
+        Return the duty cycles to write: those of `duty_cycles` and of the
+        other channels whose duty cycle changed, scaled down if the estimated
+        total current is over budget.
+        """
+
+        for k, duty_cycle in duty_cycles.items():
+            self.asked[self.index[k]] = duty_cycle
+
+        counts  = numpy.minimum(self.asked >> 4, self.COUNTS - 1)
+        loads   = self.loads[self.rows, counts]
+        current = float(self.amps @ loads)
+        applied = self.asked
+        self.limited = self.budget is not None and current > self.budget
+        if self.limited:
+            # Largest count of each channel under its scaled load
+            scaled  = numpy.where(self.amps > 0, loads * (self.budget / current), loads)
+            counts  = numpy.searchsorted(self.ranked, scaled + self.rows, side="right") \
+                      - 1 - self.rows * self.COUNTS
+            applied = numpy.minimum(self.asked, counts << 4)
+            loads   = self.loads[self.rows, numpy.minimum(applied >> 4, self.COUNTS - 1)]
+            metrics.count("power_limited_commits")
+
+        changed = {self.channel_names[i]  for i in numpy.flatnonzero(applied != self.applied)}
+        self.applied = applied.copy()
+        self.current = float(self.amps @ loads)
+        self.watts   = self.amps * loads * self.voltage
+        return {k: int(applied[self.index[k]])  for k in changed | set(duty_cycles)}
+
+    def report(self):
+        return {
+            "budget":   self.budget,
+            "current":  round(self.current, 3),
+            "limited":  self.limited,
+        }
+
+
+class Energy_accountant():
+    """
+    This class meters the energy used by each channel without a meter: it
+    integrates the power estimated by the load model (see Power_budget) over
+    time. The power of the channels only changes at commits, so the energy is
+    only added up at commits, the duration since the previous commit times
+    the power set then, one numpy operation for all the channels however
+    many frames a fade has.
+    The energy is saved to `filename` (and `on_save` is called) at most once
+    every `save_interval` seconds, and every `save_interval` seconds while a
+    channel is lit.
+    File format (pickle): {channel name: energy (J)}
+    """
+
+    def __init__(self, channel_names, filename=None, save_interval=300):
+        """
+        channel_names       # Channel names, in the order of the streams
+        filename            # File where the energy is saved, None to keep it
+                            # in memory only
+        save_interval       # Seconds between saves of the energy
+        """
+
+        self.channel_names  = channel_names
+        self.index          = {k: i  for i, k in enumerate(channel_names)}
+        self.filename       = filename
+        self.save_interval  = save_interval
+        self.joules         = numpy.zeros(len(channel_names))
+        self.watts          = numpy.zeros(len(channel_names))
+        self.since          = time.monotonic()
+        self.save_scheduled = False
+        self.on_save        = None  # Called after each save, e.g. to notify
+                                    # the energy properties
+
+        if filename is not None and os.path.exists(filename):
+            with open(filename, "rb") as f:
+                saved = pickle.load(f)
+            for k, joules in saved.items():
+                if k in self.index:
+                    self.joules[self.index[k]] = joules
+            logging.info(f'Energy_accountant: restored {self.report()["kWh"]} from {filename}.')
+        metrics.reports["energy"] = self.report
+
+    def update(self, watts):
+        """
+        Add up the energy used since the previous update, then take `watts`
+        (the power of each channel from now on).
+        """
+
+        self.__add_up()
+        self.watts  = watts
+        if not self.save_scheduled:
+            self.save_scheduled = True
+            asyncio.get_event_loop().call_later(self.save_interval, self.save)
+
+    def __add_up(self):
+        now = time.monotonic()
+        self.joules += self.watts * (now - self.since)
+        self.since  = now
+
+    def energy(self, channel_names):
+        """
+        Return the energy (kWh) used by the channels of `channel_names`, until
+        now.
+        """
+
+        i = [self.index[k]  for k in channel_names]
+        return float((self.joules[i] + self.watts[i] * (time.monotonic() - self.since)).sum()) / 3.6e6
+
+    def save(self):
+        """
+        Save the energy of the channels to the file, in one step (see
+        save_scenes), and again after `save_interval` seconds if a channel is
+        lit.
+        """
+
+        self.save_scheduled = False
+        self.__add_up()
+        if self.filename is not None:
+            with open(f"{self.filename}.tmp", "wb") as f:
+                pickle.dump({k: float(self.joules[i])  for k, i in self.index.items()}, f,
+                            pickle.HIGHEST_PROTOCOL)
+            os.replace(f"{self.filename}.tmp", self.filename)
+            metrics.count("energy_saves")
+        if self.watts.max(initial=0) > 0:
+            self.save_scheduled = True
+            asyncio.get_event_loop().call_later(self.save_interval, self.save)
+        if self.on_save is not None:
+            self.on_save()
+
+    def report(self):
+        return {
+            "kWh":      {k: round(self.energy([k]), 6)  for k in self.channel_names},
+            "watts":    {k: round(float(self.watts[i]), 2)  for k, i in self.index.items()},
+        }
+
+
+class Calibration_watcher():
+    """
+    This class reloads the calibration curves when their files change (see
+    Compute-LED-calibration.py), so that tuning does not need a restart of the
+    server. Every `interval` seconds, it compares the modification time and
+    size of the files of each channel:
+        Calibration-channel{n}.pkl          # curve at the calibrated
+                                            # frequency
+        Calibration-channel{n}-family.pkl   # curves indexed by frequency
+    The files of the channels that changed are loaded and compiled in a
+    worker thread, then swapped in on the event loop, between two commits
+    (see Dimmable_LED_strip_channels.compile_calibration). A file that cannot
+    be loaded (e.g. being written) is tried again when it changes again.
+    """
+
+    def __init__(self, LED_strip_channels, channels, directory=".", interval=1):
+        """
+        LED_strip_channels  # The Dimmable_LED_strip_channels to reload
+        channels            # {channel name: calibration channel number}
+        directory           # Where the calibration files are
+        interval            # Seconds between checks
+        """
+
+        self.LED_strip_channels = LED_strip_channels
+        self.files          = {
+            k: (os.path.join(directory, f"Calibration-channel{n}.pkl"),
+                os.path.join(directory, f"Calibration-channel{n}-family.pkl"))
+            for k, n in channels.items() if k in LED_strip_channels.channels
+        }
+        self.interval       = interval
+        self.stamps         = {k: self.__stamps(k)  for k in self.files}
+        self.task           = None
+
+    def __stamps(self, channel_name):
+        stamps = []
+        for filename in self.files[channel_name]:
+            try:
+                status = os.stat(filename)
+                stamps.append((status.st_mtime_ns, status.st_size))
+            except OSError:
+                stamps.append(None)
+        return stamps
+
+    def __load(self, changed):
+        """
+        Return the curves and curve families of the `changed` channels, {}
+        for the files that do not exist.
+        """
+
+        curves, curve_families = {}, {}
+        for k in changed:
+            curve_file, family_file = self.files[k]
+            if os.path.exists(curve_file):
+                with open(curve_file, "rb") as f:
+                    curves[k] = pickle.load(f)
+            if os.path.exists(family_file):
+                with open(family_file, "rb") as f:
+                    curve_families[k] = pickle.load(f)
+        return curves, curve_families
+
+    def __compile(self, snapshot, changed):
+        curves, curve_families = self.__load(changed)
+        return self.LED_strip_channels.compile_calibration(snapshot, curves, curve_families)
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.__run())
+
+    async def __run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(self.interval)
+            stamps  = {k: self.__stamps(k)  for k in self.files}
+            changed = [k  for k in self.files if stamps[k] != self.stamps[k]]
+            if len(changed) == 0:
+                continue
+
+            # A file being written changes again when it is complete
+            self.stamps.update({k: stamps[k]  for k in changed})
+            start = time.perf_counter()
+            try:
+                while True:
+                    snapshot = self.LED_strip_channels.calibration_snapshot()
+                    compiled = await loop.run_in_executor(None, self.__compile, snapshot, changed)
+                    if self.LED_strip_channels.swap_calibration(compiled):
+                        break
+            except Exception as e:
+                logging.warning(f'Calibration_watcher: cannot load the calibration of {changed}: {e!r}.')
+                continue
+
+            metrics.observe("calibration_reload", time.perf_counter() - start)
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+
+class Dimmable_LED_strip_channels():
+    """
+    This class manages the hardware interface: GPIOs and I2C communications for
+    control of the PWM channels.
+    The reason for separating this layer from the webthing is that we can
+    define muultiple instances of Dimmable_LED_strip_webthing that refer to
+    common channels.
+    This allows to have the best of both worlds: one can manage 4 channels as
+    one entity, or split them in 3+1 channels for example, and change between
+    the two at any time.
+    """
+
+    LUT_SIZE = 1024     # Look-up table steps from brightness 0 to 1
+    PERCEPTUAL_STEPS = 256  # Steps of brightness of the perceptual model
+                            # baked in the look-up tables
+
+    def __init__(self, on_off_channel, i2c_bus, frequency, channels, channel_curves,
+                 scenes_file=None, state_file=None, split_process=False,
+                 frame_rate=50, curve_families=None, relay_off_delay=2,
+                 relay_settle=0.15, channel_watts=None, power_budget=None,
+                 supply_voltage=12, energy_file=None, perceptual=None):
+        """
+        on_off_channel      # The GPIO output pin that controls the relay to
+                            # the transformer
+        i2c_bus             # The I2C bus object - passed as a parameter to
+                            # avoid multiple declarations
+        frequency           # The frequency at which we will operate the PWM
+                            # and therefore the lights
+                            # Note that frequency and channel_curves are
+                            # inter-dependant.
+        channels            # The PWM channels to use for all lights, on any
+                            # number of PWM boards
+        channel_curves      # These curves attempt to correct the non linearity
+                            # between the PWM control value and the voltage
+                            # (TODO: or power?) output.
+                            # The curves are the result of a "manual"
+                            # calibration process.
+                            # See module PWM_and_MOSFET_calibration.py for
+                            # details.
+
+        channels = {        # A dictionary that associates channel names with
+         "channel name":    # Can be anything, it is a label, this will be the
+                            # key to colour data
+         channel_number,    # Channel on the PWM board, this corresponds to a
+                            # given pair of wires
+                            # (board address, channel_number) for a board
+                            # other than the default one (0x40)
+         ...
+        }
+
+        channel_curves = {  # A dictionary that associates channel names with
+                            # curves.
+         "channel name":    # Key to colour data, same same as in the
+                            # `channels` parameter
+          {                 # The curve: a dictionary that associates keys with
+                            # values.
+            brightness:     # The key is a number from 0 to 1 which is the
+                            # intended brightness of the channel to which
+                            # corresponds:
+            PWM_duty_cycle, # The value which is also a number from 0 to 1 but
+                            # represents the PWM duty cycle that needs to be
+                            # set to achieve the wanted brightness.
+            ...
+          }
+        }
+
+        scenes_file         # File where scenes are saved (pickle), None to
+                            # keep scenes in memory only.
+        state_file          # Journal where channel values are saved, None to
+                            # start with all channels off and default values.
+        split_process       # True to drive the PWM boards from a separate
+                            # process (see PWM_driver_process)
+        frame_rate          # Frames per second of fades and streams
+        curve_families      # Curves of the channels at other frequencies,
+                            # to change frequency at run time (see
+                            # set_frequency), None to only have
+                            # `channel_curves` (at `frequency`)
+        relay_off_delay     # Seconds all channels stay off before the relay
+                            # switches OFF
+        relay_settle        # Seconds for the 12V rail to come up after the
+                            # relay switches ON, PWM output is held back (see
+                            # Relay_controller)
+        channel_watts       # {channel name: power (W) of the strip at full
+                            # output}, to estimate the current drawn
+        power_budget        # Current (A) the 12V supply can deliver, None not
+                            # to limit the output (see Power_budget)
+        supply_voltage      # Voltage (V) of the supply of the LED strips
+        energy_file         # File where the energy used by the channels is
+                            # saved (see Energy_accountant), None to keep it
+                            # in memory only
+        perceptual          # Perceived brightness model, brightness is mapped
+                            # to light output before the curves: "CIE" (CIE
+                            # 1931 lightness), a gamma (number), a function
+                            # (numpy arrays of brightness 0 to 1 to light
+                            # output 0 to 1), None for linear
+
+        curve_families = {  # Curves indexed by frequency:
+         "channel name":    # Key to colour data
+          {frequency:       # PWM frequency (Hz)
+            curve,          # as in `channel_curves`
+           ...
+          }
+        }
+
+        Curves are compiled to look-up tables: one for each channel at each
+        frequency of the curve families, so that changing to one of these
+        frequencies costs nothing. At other frequencies, the curves are
+        interpolated between the two nearest frequencies.
+        The perceptual model is baked in the look-up tables, it costs nothing
+        per write. Channels set with channel_brightness in raw mode skip it.
+        """
+
+        self.on_off_channel = on_off_channel
+        self.perceptual     = self.__transfer_function(perceptual)
+        self.raw_channels   = set() # channels set in raw mode (no perceptual
+                                    # model)
+        self.channels       = {k: self.__PWM_address(c)  for k, c in channels.items()}
+        self.channel_names  = list(self.channels)   # channel indices for
+                                                    # streaming
+        self.frequency      = frequency
+        self.channel_curves = channel_curves
+        # The curves given for `frequency` prevail over those of the families
+        self.curve_families = {
+            k: {**(curve_families or {}).get(k, {}), frequency: channel_curves[k]}
+            for k in self.channels
+        }
+        self.LUTs           = {     # {frequency: {channel name: LUT}}
+            f: self.__compile_LUTs(self.__curves_at(f))
+            for f in set().union(*self.curve_families.values())
+        }
+        self.LUT            = self.LUTs[frequency]
+        self.calibrated_frequency = frequency   # of the channel curves given
+        self.curves_generation    = 0           # changes with any curve or LUT
+
+        # set-up communication with the PWM boards (each board is initialised
+        # when first used), directly or through the driver process
+        if split_process:
+            self.PWM_boards = PWM_driver_process(
+                frequency, simulated=isinstance(i2c_bus, Simulated_I2C))
+        else:
+            self.PWM_boards = PWM_boards(i2c_bus, frequency)
+
+        self.things         = {}    # {channel name: (webthing, ...)}
+        self.related_things = {}    # {webthing: (webthings sharing a channel)}
+        self.all_things     = []
+        self.value          = {}
+        self.last_on_value  = {}
+        self.default_value  = {}
+        self.lit_channels   = set() # channels with a value > 0
+        self.relay_on       = False
+        self.last_commit    = time.monotonic()
+        self.calibrating    = None  # PWM address driven by Self_calibration
+        self.output_cap     = 1.0   # Ratio of the duty cycles, see Thermal_derating
+        self.compositor     = Compositor(self.channel_names)
+        self.power          = Power_budget(self.channel_names, channel_watts,
+                                           power_budget, supply_voltage)
+        self.energy         = Energy_accountant(self.channel_names, energy_file)
+        # The `webthing`s whose channels did not change are only refreshed
+        # when the energy is saved
+        self.energy.on_save = lambda: self.__notify_power(self.all_things)
+        self.channel_at     = {a: k  for k, a in self.channels.items()}
+        self.journal        = State_journal(state_file)
+
+        self.frame_scheduler = Frame_scheduler(self, frame_rate)
+        self.relay          = Relay_controller(on_off_channel, relay_off_delay, relay_settle,
+                                               on_switch_on=self.frame_scheduler.postpone)
+        self.held           = {}    # duty cycles held back until the 12V
+                                    # rail is up
+        self.release_handle = None
+        self.timers         = Timer_wheel()     # auto-off of the webthings
+        self.fading_things  = set() # webthings to notify after frames
+        self.frame_notified = 0     # time of the last frame notifications
+        self.notify_period  = 0.25  # seconds
+
+        # Scenes: {"scene name": {"channel name": brightness, ...}, ...}
+        # Each scene is compiled to the PWM duty cycles of its channels.
+        self.scenes_file    = scenes_file
+        self.scenes         = {
+            name: {k: v  for k, v in scene.items() if k in self.channels}
+            for name, scene in load_scenes(scenes_file).items()
+        }
+        self.compiled_scenes = {}
+        self.__compile_scenes()
+
+    @staticmethod
+    def __PWM_address(channel):
+        """
+        Return the (board address, channel number) of a channel given either
+        as a channel number on the default board or as a pair.
+        """
+
+        if isinstance(channel, int):
+            return (PWM_boards.DEFAULT_ADDRESS, channel)
+        return tuple(channel)
+
+    def register_thing_with_LED_strip_channels(self, thing):
+        """
+        As this module provides for multiple ways to access LED channels, we
+        need to keep tabs as to which "webthing" object refers to which
+        channel, so that we are able to notify the relevant subscribers of
+        state changes.
+        """
+
+        # First call: set-up the GPIO pin to be an output (it controls the
+        # relay to the transformer) as this pin is shared by all channels, it
+        # only makes sense to initialise it once. set it to OFF (no power)
+        if len(self.all_things) == 0:
+            self.relay.setup()
+
+        # Register all "webthing"s that use any channel
+        if not thing in self.all_things:
+            self.all_things.append(thing)
+            logging.info(
+                'Dimmable_LED_strip_channels: '
+                f'len={len(self.all_things)}: {self.all_things}.'
+            )
+
+        # For each channel, register all "webthing"s that use this channel
+        for c in thing.channels:
+            if not c in self.things:
+                self.things[c] = (thing, )
+                logging.info(
+                    'Dimmable_LED_strip_channels: '
+                    f'Setting "{thing.title}" to channel {c}.'
+                )
+            else:
+                self.things[c] += (thing, )
+                logging.info(
+                    'Dimmable_LED_strip_channels: '
+                    f'Adding "{thing.title}" to channel {c}.'
+                )
+
+            # Saved state of the channel, if any, see `restore`
+            _, last_on_value, default_value = self.journal.state.get(c, (0.0, 0.0, 0.2))
+
+            # initialise channel current value (the hardware is OFF)
+            self.value[c]           = 0.0
+
+            # initialise channel value when "webthing" was last ON
+            self.last_on_value[c]   = last_on_value
+
+            # initialise channel default value: if last_on are all 0, use default
+            self.default_value[c]   = default_value
+
+            logging.info(
+                'Dimmable_LED_strip_channels: '
+                f'Associated "{c}" channel & '
+                f'on/off pin {self.on_off_channel} '
+                f'with {", ".join((f"""{t.title}""" for t in self.things[c]))}.'
+            )
+
+        # Precompute, for each "webthing", the "webthing"s that share at least
+        # one channel with it, so that notifications never need to scan all
+        # channels or all "webthing"s.
+        for thing1 in self.all_things:
+            self.related_things[thing1] = tuple(
+                thing2  for thing2 in self.all_things
+                if set(thing2.channels) & set(thing1.channels)
+            )
+
+    def OnOff(self, thing, value):
+        """
+        Switch channel on (value is True) or off (value is False)
+        If all channels are at 0 (not just those of the current "webthing"
+        (thing)), then turn off the relay.
+        If at least one channel is non zero, then turn on the relay.
+        """
+
+        trace.record("on_off", thing.title, value)
+
+        if value:
+            # Switch LEDs ON
+            # Notify subscribers of all webthings that use any channel of the
+            # change to the "on" property.
+            self.channel_brightness(thing, self.on_values(thing))
+
+            for thing2 in self.related_things[thing]:
+                t2v = [self.value[k]  for k in thing2.channels]
+
+                if sum(t2v) > 0:
+                    thing2.properties["on"].value.notify_of_external_update(True)
+                else:
+                    thing2.properties["on"].value.notify_of_external_update(False)
+
+                thing2.properties["brightness"].value.\
+                    notify_of_external_update(scale(max(t2v), 100, "brightness"))
+
+        else:
+            # Switch LEDs OFF
+            # Notifications are handled by `reset`
+            self.reset(thing, {k: 0  for k in thing.channels})
+
+    def on_values(self, thing):
+        """
+        Return the channel values to switch `thing` on: the last ON values, or
+        the default values if the last ON values are all 0.
+        """
+
+        v = {k: self.last_on_value[k]  for k in thing.channels}
+
+        if sum(v.values()) > 0:
+            return v
+        return {k: self.default_value[k]  for k in thing.channels}
+
+    def brightness(self, thing, value):
+        """
+        """
+
+        trace.record("brightness", thing.title, value)
+        self.channel_brightness(thing, self.brightness_values(thing, value))
+
+    def brightness_values(self, thing, value):
+        """
+        Return the channel values of `thing` scaled so that the brightest one
+        is at `value` percent.
+        """
+
+        values = {k: self.value[k]  for k in thing.channels}
+        if sum(values.values()) == 0:
+            values = {k: self.last_on_value[k]  for k in thing.channels}
+            if sum(values.values()) == 0:
+                values = {k: self.default_value[k]  for k in thing.channels}
+
+        scale = value / (100 * max(values.values()))
+        return {k: v*scale  for k, v in values.items()}
+
+    def colour(self, thing, value):
+        """
+        """
+
+        values = self.colour_values(thing, value)
+        trace.record("colour", thing.title, int(value[1:7], 16))
+        if len(values) > 0:
+            self.channel_brightness(thing, values)
+
+    def colour_values(self, thing, value):
+        """
+        Return the channel values of `thing` for colour `value` (#rrggbb),
+        raise ValueError if `value` is not a colour.
+        """
+
+        rgb   = Colour_mixer.rgb(value)
+        mixer = thing.mixer
+        if len(mixer.channels) == 0:
+            return {}
+
+        values = mixer.channel_values(rgb)
+        return {k: float(v)  for k, v in zip(mixer.channels, values)}
+
+    @staticmethod
+    def __curve_points(curve):
+        """
+        Return the brightnesses and PWM duty cycles of the segment ends of
+        `curve`, including the implied (0, 0) and (1, 1), as numpy arrays.
+        A curve can also be a number: the duty cycle at the lowest brightness
+        of a straight line to (1, 1).
+        """
+
+        if type(curve) is int:
+            return numpy.array([0, 1e-9, 1]), numpy.array([0, curve, 1])
+        points = sorted((float(k), float(v))  for k, v in curve.items())
+        return (numpy.array([0] + [k for k, _ in points] + [1]),
+                numpy.array([0] + [v for _, v in points] + [1]))
+
+    def __curves_at(self, frequency, curve_families=None):
+        """
+        Return the curves of the channels at `frequency`: from the curve
+        families (all of them by default), interpolated between the two
+        nearest frequencies if `frequency` is not in a family (the nearest one
+        outside the range of a family).
+        """
+
+        curves = {}
+        for k, family in (self.curve_families if curve_families is None else curve_families).items():
+            below = [f  for f in family if f <= frequency]
+            above = [f  for f in family if f >= frequency]
+            f1 = max(below) if len(below) > 0 else min(above)
+            f2 = min(above) if len(above) > 0 else max(below)
+            if f1 == f2:
+                curves[k] = family[f1]
+                continue
+
+            # Between segment ends of either curve, both curves are straight
+            # lines: so is their weighted average
+            t = (frequency - f1) / (f2 - f1)
+            x1, y1 = Dimmable_LED_strip_channels.__curve_points(family[f1])
+            x2, y2 = Dimmable_LED_strip_channels.__curve_points(family[f2])
+            x = numpy.union1d(x1, x2)
+            y = (1 - t) * numpy.interp(x, x1, y1) + t * numpy.interp(x, x2, y2)
+            curves[k] = {float(a): float(b)  for a, b in zip(x[1:-1], y[1:-1])}
+        return curves
+
+    @staticmethod
+    def __transfer_function(model):
+        """
+        Return the function of the perceptual model `model` (see __init__),
+        None for linear.
+        """
+
+        if model is None or model == "linear":
+            return None
+        if model == "CIE":
+            # CIE 1931 lightness L* (0 to 100) to relative luminance
+            def CIE_1931(brightness):
+                L = 100 * brightness
+                return numpy.where(L > 8, ((L + 16) / 116) ** 3, L / 903.3)
+            return CIE_1931
+        if isinstance(model, (int, float)):
+            return lambda brightness: brightness ** model
+        return model
+
+    def __compile_LUTs(self, curves):
+        """
+        Return the look-up tables of `curves`: the segment ends of each curve
+        and, for LUT_SIZE steps of brightness from 0 to 1, the segment where
+        the step starts, with the perceptual model; then the same without
+        (raw).
+        The look-up finds the segment of a brightness in one step (a few more
+        if the step holds segment ends), however many segments the curve has,
+        and it is exact, even for the very steep segments near full
+        brightness, narrower than a step.
+        With a perceptual model, the curve is resampled at PERCEPTUAL_STEPS
+        steps of brightness and at the brightness of each of its segment
+        ends, which are kept exact.
+        """
+
+        steps = numpy.linspace(0, 1, self.LUT_SIZE + 1)
+        if self.perceptual is not None:
+            brightness = numpy.linspace(0, 1, self.LUT_SIZE * 4 + 1)
+            output     = numpy.maximum.accumulate(self.perceptual(brightness))
+            resampled  = numpy.linspace(0, 1, self.PERCEPTUAL_STEPS + 1)
+
+        def LUT(x, y):
+            segment = numpy.maximum(numpy.searchsorted(x, steps) - 1, 0)
+            return (x.tolist(), y.tolist(), array.array("H", segment.tolist()))
+
+        LUTs = {}
+        for k, curve in curves.items():
+            x, y = self.__curve_points(curve)
+            raw  = LUT(x, y)
+            if self.perceptual is None:
+                LUTs[k] = (*raw, raw)
+                continue
+            # Brightness of the segment ends: inverse of the model
+            xp = numpy.union1d(resampled, numpy.interp(x, output, brightness))
+            yp = numpy.interp(numpy.interp(xp, brightness, output), x, y)
+            LUTs[k] = (*LUT(xp, yp), raw)
+        return LUTs
+
+    def __rectified_channel(self, value, channel_name, raw=False):
+        """
+        Calculate, scale and cap the PWM duty cycle we need to set based on the intended brightness
+        Return the scaled and capped value (as it must conform to the ADS device specification)
+        `raw` skips the perceptual model.
+        """
+
+        if value <= 0:
+            return 0
+        if value >= 1:
+            return 0xfffe
+
+        LUT = self.LUT[channel_name]
+        x, y, segment = LUT[3] if raw else LUT[:3]
+        i = segment[int(value * self.LUT_SIZE)]
+        while x[i + 1] < value:
+            i += 1
+        duty_cycle = y[i] + (value - x[i]) * (y[i + 1] - y[i]) / (x[i + 1] - x[i])
+        return 0 if duty_cycle <= 0 else 0xfffe if duty_cycle >= 1 else int(duty_cycle * 0xfffe)
+
+    def reset(self, thing, values):
+        """
+        Set channel values to zero, remember last ON values, but only for the channels relevant to the calling
+        `webthing`.
+        If all channels are 0, then switch the relay OFF.
+        Notify all relevant changes to their `webthing`.
+        """
+
+        for k in values.keys():
+            trace.record("reset", k, 0)
+        metrics.count("reset_commits")
+        self.frame_scheduler.cancel(values.keys())
+        self.raw_channels.difference_update(values)
+        values = {k: 0  for k in values.keys()}
+        self.__notify(self.__commit(
+            values,
+            {self.channels[k]: 0  for k in values.keys()},
+            remember_last_on=True
+        ))
+
+    def channel_brightness(self, thing, values, raw=False):
+        """
+        Set channel values (maybe to zero), but only for the channels relevant to the calling `webthing`.
+        If all channels are 0, then switch the relay OFF.
+        If any channel is non 0, then switch the relay ON.
+        Notify all relevant changes to their `webthing`.
+        `raw` sets the values without the perceptual model (calibration work),
+        until the channels are set otherwise.
+        """
+
+        for k, v in values.items():
+            trace.record("channel_brightness", k, v)
+        metrics.count("channel_brightness_commits")
+        self.frame_scheduler.cancel(values.keys())
+        if raw:
+            self.raw_channels.update(values)
+        else:
+            self.raw_channels.difference_update(values)
+        self.__notify(self.__commit(
+            values,
+            {self.channels[k]: self.__rectified_channel(v, k, raw)  for k, v in values.items()}
+        ))
+
+    def check_change(self, thing, name, value):
+        """
+        Raise ValueError if property `name` of `thing` cannot be set to
+        `value` (see bulk): the value must fit the property, a colour must be
+        #rrggbb and channel brightnesses must be numbers from 0 to 1 of
+        channels of `thing`.
+        """
+
+        if not name in Bulk_handler.PROPERTIES or not name in thing.properties:
+            raise ValueError(f"no property {name}")
+        if name == "colour":
+            Colour_mixer.rgb(value)
+        elif name == "channel_brightness" and isinstance(value, dict):
+            for k, v in value.items():
+                if not k in thing.channels:
+                    raise ValueError(f"no channel {k!r} in {thing.title}")
+                if isinstance(v, bool) or not isinstance(v, (int, float)) or not 0 <= v <= 1:
+                    raise ValueError(f"channel {k}: {v!r} is not a number from 0 to 1")
+        try:
+            thing.properties[name].validate_value(value)
+        except PropertyError as e:
+            raise ValueError(f"{name} {value!r}: {e}")
+
+    def bulk(self, changes):
+        """
+        Apply property changes of several `webthing`s in one commit:
+        changes = [(webthing, property name, value), ...]
+        Supported properties: on, brightness, colour, channel_brightness,
+        checked beforehand with check_change.
+        Changes are merged in order (the last change of a channel wins) and
+        each channel is set as by the property on its own: only channels
+        switched off ("on": false) remember their last ON value, and
+        channel_brightness follows the raw mode of its `webthing`.
+        Each `webthing` whose channels changed is notified once.
+        """
+
+        values   = {}
+        remember = set()    # channels switched off, last change
+        raw      = set()    # channels set in raw mode, last change
+        for thing, name, value in changes:
+            if name == "on":
+                change = self.on_values(thing) if value else {k: 0  for k in thing.channels}
+            elif name == "brightness":
+                change = self.brightness_values(thing, value)
+            elif name == "colour":
+                change = self.colour_values(thing, value)
+            elif name == "channel_brightness":
+                change = {k: v  for k, v in value.items() if k in thing.channels}
+            else:
+                continue
+            values.update(change)
+            if name == "on" and not value:
+                remember.update(change)
+            else:
+                remember.difference_update(change)
+            if name == "channel_brightness" and thing.raw_brightness:
+                raw.update(change)
+            else:
+                raw.difference_update(change)
+
+        for k, v in values.items():
+            trace.record("bulk", k, v)
+        metrics.count("bulk_commits")
+
+        self.frame_scheduler.cancel(values.keys())
+        self.raw_channels.difference_update(values)
+        self.raw_channels.update(raw)
+        self.__notify(self.__commit(
+            values,
+            {self.channels[k]: self.__rectified_channel(v, k, k in raw)  for k, v in values.items()},
+            remember_last_on=remember
+        ))
+
+    def frame(self, values, notify, last_on=None):
+        """
+        Commit one frame of the frame scheduler.
+        Notifications are deferred until `notify` is True (end of a fade) or
+        until `notify_period` seconds have passed since the last ones.
+        `last_on` holds the last ON values of channels ending a fade off.
+        """
+
+        for k, v in values.items():
+            trace.record("frame", k, v)
+        metrics.count("frame_commits")
+
+        self.raw_channels.difference_update(values)
+        self.fading_things |= self.__commit(
+            values,
+            {self.channels[k]: self.__rectified_channel(v, k)  for k, v in values.items()},
+            remember_last_on=True
+        )
+
+        self.set_last_on_values(last_on or {})
+
+        if notify or time.monotonic() - self.frame_notified >= self.notify_period:
+            self.frame_notify()
+
+    def set_last_on_values(self, values):
+        """
+        Set the last ON values of the channels of `values`.
+        """
+
+        for k, v in values.items():
+            self.last_on_value[k] = v
+            self.journal.record(k, self.value[k], v, self.default_value[k])
+
+    def fade_off(self, thing, duration):
+        """
+        Fade the channels of `thing` off over `duration` seconds, they
+        remember their current values as their last ON values.
+        """
+
+        trace.record("on_off", thing.title, False)
+        self.frame_scheduler.fade({k: 0  for k in thing.channels}, duration, off=True)
+
+    def frame_notify(self):
+        """
+        Notify the changes made by the frames committed since the last
+        notifications.
+        """
+
+        self.frame_notified = time.monotonic()
+        if len(self.fading_things) > 0:
+            self.__notify(self.fading_things)
+            self.fading_things = set()
+
+    def __commit(self, values, duty_cycles, remember_last_on=False):
+        """
+        Record the channel values, write all the duty cycles to the hardware
+        in one go and ask the relay for ON if any channel is non 0, OFF
+        otherwise (see Relay_controller).
+        `remember_last_on` is True for all the channels set to 0 to remember
+        their last ON value, or the set of those channels.
+        Return the `webthing`s whose channels changed.
+        """
+
+        start = time.perf_counter()
+        updated_things = set()
+        # This is not a call to the self.set function, but the creation of a standard python set object (empty)
+
+        for channel_name, value in values.items():
+            previous_value = self.value[channel_name]
+            if previous_value != value:
+                updated_things.update(self.things[channel_name])
+                if value > 0:
+                    self.lit_channels.add(channel_name)
+                else:
+                    self.lit_channels.discard(channel_name)
+                    if previous_value > 0 and (remember_last_on is True or
+                                               remember_last_on and channel_name in remember_last_on):
+                        self.last_on_value[channel_name] = previous_value
+                self.value[channel_name] = value
+                self.journal.record(channel_name, value,
+                                    self.last_on_value[channel_name],
+                                    self.default_value[channel_name])
+
+        relay_on = len(self.lit_channels) > 0
+        if self.compositor.active():
+            duty_cycles, lit = self.__composite(duty_cycles)
+            relay_on = relay_on or lit
+
+        if self.output_cap < 1:
+            cap = self.output_cap
+            duty_cycles = {k: int(d * cap)  for k, d in duty_cycles.items()}
+
+        duty_cycles = self.__power_limit(duty_cycles)
+
+        if self.calibrating is not None:
+            # Commands interrupt the measurements of the self-calibration
+            duty_cycles = {self.calibrating: 0, **duty_cycles}
+            self.calibrating = None
+
+        self.relay_on = relay_on
+        settle = self.relay.request(relay_on)
+        if settle > 0:
+            # The 12V rail is coming up: the latest duty cycles are written
+            # once it is up
+            self.held.update(duty_cycles)
+            if self.release_handle is None:
+                self.release_handle = asyncio.get_event_loop().call_later(settle, self.__release)
+            metrics.count("held_commits")
+        else:
+            if len(self.held) > 0:
+                duty_cycles = {**self.held, **duty_cycles}
+                self.held = {}
+            self.PWM_boards.write(duty_cycles)
+        self.last_commit = time.monotonic()
+
+        metrics.count("commits")
+        metrics.observe("commit", time.perf_counter() - start)
+        return updated_things
+
+    def __power_limit(self, duty_cycles):
+        """
+        Return `duty_cycles` with the channels scaled down, or back up, to
+        keep within the power budget (see Power_budget).
+        """
+
+        power = self.power
+        if power.generation != self.curves_generation:
+            power.compile(self.LUT, self.curves_generation)
+
+        limited = power.limit({self.channel_at[a]: d  for a, d in duty_cycles.items() if a in self.channel_at})
+        self.energy.update(power.watts)
+        return {**duty_cycles, **{self.channels[k]: d  for k, d in limited.items()}}
+
+    def __release(self):
+        """
+        Write the duty cycles held back while the 12V rail came up.
+        """
+
+        self.release_handle = None
+        if len(self.held) > 0:
+            self.PWM_boards.write(self.held)
+            self.held = {}
+
+    def __composite(self, duty_cycles):
+        """
+        Return the duty cycles of the composite of the layers over the
+        channel values (see Compositor): those of the channels of
+        `duty_cycles` and of the channels whose composite changed since the
+        last commit. Also return True if any channel is lit in the composite.
+        """
+
+        compositor = self.compositor
+        base   = numpy.fromiter((self.value.get(k, 0)  for k in self.channel_names), float, len(self.channel_names))
+        output = compositor.composite(base)
+        # Without layers, the base layer was written (the channels of the
+        # base that changed are in `duty_cycles`)
+        changed = numpy.flatnonzero(output != (base if compositor.output is None else compositor.output))
+        names = {self.channel_at[a]  for a in duty_cycles} | {self.channel_names[i]  for i in changed}
+
+        compositor.output = output if len(compositor.stack) > 0 else None
+        compositor.dirty  = False
+        metrics.count("composite_commits")
+        return (
+            {self.channels[k]: self.__rectified_channel(output[compositor.index[k]], k, k in self.raw_channels)
+             for k in names},
+            bool(output.max(initial=0) > 0)
+        )
+
+    def overlay(self, name, values, mode="replace", duration=0):
+        """
+        Draw the layer `name` of the compositor (e.g. "effect", "overlay")
+        over the channels of `values`, for `duration` seconds (0 until
+        clear_overlay). The channel values are not changed.
+        """
+
+        logging.info(f'Dimmable_LED_strip_channels: command to draw layer {name} with {values} ({mode}).')
+        self.compositor.set_layer(name, values, mode)
+        self.frame_scheduler.wake()
+        if duration > 0:
+            layer = self.compositor.layers[name]
+            def expire():
+                # Unless the layer was drawn again since
+                if self.compositor.layers.get(name) is layer:
+                    self.clear_overlay(name)
+            asyncio.get_event_loop().call_later(duration, expire)
+
+    def clear_overlay(self, name):
+        logging.info(f'Dimmable_LED_strip_channels: command to clear layer {name}.')
+        self.compositor.clear_layer(name)
+        self.frame_scheduler.wake()
+
+    def __notify(self, updated_things):
+        """
+        Notify the `webthing`s whose channels changed, the cost only depends on
+        the number of channels of those `webthing`s, not on the total number of
+        channels.
+        """
 
-            if sum(v.values()) > 0:
-                self.channel_brightness(thing, v)
-            else:
-                self.channel_brightness(
-                    thing,
-                    {k: self.default_value[k]  for k in thing.channels}
-                )
+        start = time.perf_counter()
+        for thing1 in updated_things:
+            t1v = {k: self.value[k]  for k in thing1.channels}
+            thing1.properties["channel_brightness"].value.notify_of_external_update(t1v)
+            thing1.properties["colour"].value.notify_of_external_update(thing1.colour_convert(t1v))
+            thing1.properties["brightness"].value.notify_of_external_update(scale(max(t1v.values()), 100, "brightness"))
+            thing1.properties["on"].value.notify_of_external_update(max(t1v.values()) > 0)
 
-            for thing2 in self.all_things:
-                t2v = [self.value[k]  for k in thing2.channels]
-                logging.info(f'Dimmable_LED_strip_channels: {thing2.title}: {t2v}.')
+        self.__notify_power(updated_things)
 
-                if sum(t2v) > 0:
-                    logging.info(f'Dimmable_LED_strip_channels: {thing2.title} to "ON".')
-                    thing2.properties["on"].value.notify_of_external_update(True)
-                else:
-                    logging.info(f'Dimmable_LED_strip_channels: {thing2.title} to "OFF".')
-                    thing2.properties["on"].value.notify_of_external_update(False)
+        metrics.count("notified_things", len(updated_things))
+        metrics.observe("notify", time.perf_counter() - start)
+        trace.record("lit_channels", "all", len(self.lit_channels))
 
-                thing2.properties["brightness"].value.\
-                    notify_of_external_update(scale(max(t2v), 100, "brightness"))
+    def __notify_power(self, things):
+        """
+        Notify the estimated current and the energy of `things`, when they
+        changed.
+        """
 
-        else:
-            # Switch LEDs OFF
-            # Notifications are handled by `reset`
-            self.reset(thing, {k: 0  for k in thing.channels})
+        current = round(self.power.current, 2)
+        for thing1 in things:
+            if current != thing1.properties["estimated_current"].value.get():
+                thing1.properties["estimated_current"].value.notify_of_external_update(current)
+            energy = round(self.energy.energy(thing1.channels), 4)
+            if energy != thing1.properties["energy"].value.get():
+                thing1.properties["energy"].value.notify_of_external_update(energy)
 
-    def brightness(self, thing, value):
+    def calibration_output(self, channel_name, duty_cycle):
         """
+        Drive channel `channel_name` at `duty_cycle` (16 bit), with the relay
+        ON, for a measurement of the self-calibration, without changing the
+        channel value. Only while all channels are off: return None
+        otherwise, the seconds before the 12V rail is up if it is done.
+        The measurement ends with `calibration_end` or with the next commit.
         """
 
-        logging.info(f'Dimmable_LED_strip_channels: {self.channels} brightness to {value}.')
+        if self.relay_on:
+            return None
 
-        values = {k: self.value[k]  for k in thing.channels}
-        if sum(values.values()) == 0:
-            values = {k: self.last_on_value[k]  for k in thing.channels}
-            if sum(values.values()) == 0:
-                values = {k: self.default_value[k]  for k in thing.channels}
+        self.calibrating = self.channels[channel_name]
+        self.PWM_boards.write({self.calibrating: duty_cycle})
+        return self.relay.request(True)
 
-        scale = value / (100 * max(values.values()))
-        self.channel_brightness(thing, {k: v*scale  for k, v in values.items()})
+    def calibration_end(self):
+        if self.calibrating is not None:
+            self.PWM_boards.write({self.calibrating: 0})
+            self.relay.request(False)
+            self.calibrating = None
 
-    def colour(self, thing, value):
+    def stop(self):
         """
+        Save the state and release the hardware driver.
         """
 
-        logging.info(f'Dimmable_LED_strip_channels: {self.channels} colour to {value} for {thing.title}, {thing.colour_type}.')
+        self.journal.flush()
+        self.energy.save()
+        if self.release_handle is not None:
+            self.release_handle.cancel()
+        self.relay.stop()
+        self.PWM_boards.stop()
 
-        if   thing.colour_type == "RGB":
-            self.channel_brightness(
-                thing, 
-                {"Red":     int(value[1:3], 16) / 255.0,
-                 "Green":   int(value[3:5], 16) / 255.0,
-                 "Blue":    int(value[5:7], 16) / 255.0,
-                }
-            )
+    def restore(self):
+        """
+        Switch back on the channels that were on when the state was last saved
+        (e.g. before a power cut). After a clean stop, all channels were
+        switched off, so only the last ON values are restored (by
+        `register_thing_with_LED_strip_channels`).
+        """
 
-        elif thing.colour_type == "RGBW":
-            r = int(value[1:3], 16) / 255.0
-            g = int(value[3:5], 16) / 255.0
-            b = int(value[5:7], 16) / 255.0
-            w = min((r, g, b))
-            W = w * (1 - max((r, g, b, 0.0001)))
-
-            self.channel_brightness(
-                thing, 
-                {"Red":     r - W,
-                 "Green":   g - W,
-                 "Blue":    b - W,
-                 "White":   w,
-                }
-            )
+        values = {
+            k: v[0]  for k, v in self.journal.state.items()
+            if k in self.channels and v[0] > 0
+        }
+        if len(values) > 0:
+            logging.info(f'Dimmable_LED_strip_channels: restore {values}.')
+            self.__notify(self.__commit(
+                values,
+                {self.channels[k]: self.__rectified_channel(v, k)  for k, v in values.items()}
+            ))
+
+    def __compile_scenes(self, names=None):
+        """
+        Compile scenes (all of them by default) to the PWM duty cycles of
+        their channels, so that applying a scene does not evaluate any curve.
+        """
 
-        elif thing.colour_type == "W":
-            r = int(value[1:3], 16) / 255.0
-            g = int(value[3:5], 16) / 255.0
-            b = int(value[5:7], 16) / 255.0
+        for name in (self.scenes.keys() if names is None else names):
+            self.compiled_scenes[name] = {
+                self.channels[k]: self.__rectified_channel(v, k)
+                for k, v in self.scenes[name].items()
+            }
+
+    def scenes_update(self, value):
+        """
+        Replace all scenes by `value`, ignoring channels that do not exist.
+        """
 
-            self.channel_brightness(thing, {"White": numpy.mean((r, g, b))})
+        logging.info(f'Dimmable_LED_strip_channels: command to set scenes to {value}.')
+        self.scenes = {
+            name: {k: min(max(float(v), 0.0), 1.0)  for k, v in scene.items() if k in self.channels}
+            for name, scene in value.items()
+        }
+        self.compiled_scenes = {}
+        self.__compile_scenes()
+        self.__scenes_changed()
 
-    @staticmethod
-    def __find_segment(value, curve):
+    def save_scene(self, name, values):
         """
-        Find between which two keys `value` lies in the `curve` - which is a list of segments
-        This is the intended brightness.
-        Return the segment ends (key, value) pairs.
+        Create or replace scene `name` with the channel `values`.
         """
 
-        pchannel_brightness, pPWM_duty_cycle = 0, 0
-        for channel_brightness in curve:
-            if value <= channel_brightness:
-                return [[pchannel_brightness, pPWM_duty_cycle], [channel_brightness, curve[channel_brightness]]]
-            pchannel_brightness, pPWM_duty_cycle = channel_brightness, curve[channel_brightness]
-        return [[pchannel_brightness, pPWM_duty_cycle], [1, 1]]
+        logging.info(f'Dimmable_LED_strip_channels: save scene "{name}" = {values}.')
+        self.scenes = dict(self.scenes)
+        self.scenes[name] = dict(values)
+        self.__compile_scenes([name])
+        self.__scenes_changed()
 
-    @staticmethod
-    def __apply_curve(value, curve):
+    def __scenes_changed(self):
+        save_scenes(self.scenes_file, self.scenes)
+        for thing2 in self.all_things:
+            thing2.properties["scenes"].value.notify_of_external_update(self.scenes)
+
+    def apply_scene(self, name, duration=0):
         """
-        Calculate the PWM duty cycle we need to set based on the intended brightness
-        Return that value
+        Set all the channels of scene `name` together: in one commit or, if
+        `duration` (milliseconds) is not 0, by fading to the scene.
         """
 
-        if type(curve) is int:
-            return value * (1 - curve) + curve
+        if not name in self.scenes:
+            logging.warning(f'Dimmable_LED_strip_channels: unknown scene "{name}".')
+            return
+
+        trace.record("scene", name, duration)
+        if duration > 0:
+            self.frame_scheduler.fade(self.scenes[name], duration / 1000)
         else:
-            ((channel_brightness1, PWM_duty_cycle1), (channel_brightness2, PWM_duty_cycle2)) =  \
-                Dimmable_LED_strip_channels.__find_segment(value, curve)
+            self.frame_scheduler.cancel(self.scenes[name].keys())
+            self.raw_channels.difference_update(self.scenes[name])
+            metrics.count("scene_commits")
+            self.__notify(self.__commit(
+                self.scenes[name],
+                self.compiled_scenes[name],
+                remember_last_on=True
+            ))
 
-            return PWM_duty_cycle1 + (value - channel_brightness1) *                            \
-                                     (PWM_duty_cycle2 - PWM_duty_cycle1) /                      \
-                                     (channel_brightness2 - channel_brightness1)
+    def channel_curve(self, value):
+        logging.info(f'Dimmable_LED_strip_channels: command to adjust channel curves to {value}.')
+        self.curves_generation += 1
+        self.channel_curves = dict(self.channel_curves)
+        for c in value.keys():
+            if c in self.channels:
+                self.channel_curves[c] = {float(k): v  for k, v in value[c].items()}
+                # The curve now is the one at the current frequency
+                self.curve_families[c][self.frequency] = self.channel_curves[c]
+
+        self.LUT = {**self.LUT, **self.__compile_LUTs(
+            {c: self.channel_curves[c]  for c in value.keys() if c in self.channels})}
+        self.LUTs[self.frequency] = self.LUT
+
+        # Scenes hold duty cycles computed with the previous curves
+        self.__compile_scenes()
+
+        for thing2 in self.all_things:
+            thing2.properties["channel_curve"].value.notify_of_external_update(self.channel_curves)
 
-    def __rectified_channel(self, value, channel_name):
+    def set_frequency(self, frequency):
         """
-        Calculate, scale and cap the PWM duty cycle we need to set based on the intended brightness
-        Return the scaled and capped value (as it must conform to the ADS device specification)
+        Change the PWM frequency of all the boards and switch to the curves
+        of that frequency: the channels keep their brightness, with the duty
+        cycles of the new curves, written in one commit.
         """
-        return scale(self.__apply_curve(value, self.channel_curves[channel_name]), 0xfffe, "PWM " + channel_name)
 
-    def reset(self, thing, values):
+        logging.info(f'Dimmable_LED_strip_channels: command to set the PWM frequency to {frequency} Hz.')
+        frequency = int(frequency)
+        if frequency == self.frequency:
+            return
+
+        self.curves_generation += 1
+        self.channel_curves = self.__curves_at(frequency)
+        if frequency in self.LUTs:
+            self.LUT = self.LUTs[frequency]
+        else:
+            # Interpolated curves are not kept: there is no end to them
+            self.LUT = self.__compile_LUTs(self.channel_curves)
+        self.frequency = frequency
+        self.PWM_boards.set_frequency(frequency)
+        metrics.count("frequency_switches")
+
+        self.__compile_scenes()
+        self.__commit(
+            dict(self.value),
+            {self.channels[k]: self.__rectified_channel(v, k, k in self.raw_channels)  for k, v in self.value.items()}
+        )
+
+        for thing2 in self.all_things:
+            thing2.properties["frequency"].value.notify_of_external_update(frequency)
+            thing2.properties["channel_curve"].value.notify_of_external_update(self.channel_curves)
+
+    def calibration_snapshot(self):
         """
-        Set channel values to zero, remember last ON values, but only for the channels relevant to the calling
-        `webthing`.
-        If all channels are 0, then switch the relay OFF.
-        Notify all relevant changes to their `webthing`.
+        Return what compile_calibration needs, taken on the event loop: it
+        then runs on its own copy.
         """
 
-        updated_things = set()
-        # This is not a call to the self.set function, but the creation of a standard python set object (empty)
+        return (
+            self.curves_generation,
+            self.frequency,
+            self.calibrated_frequency,
+            {k: dict(family)  for k, family in self.curve_families.items()},
+            dict(self.LUTs),
+            self.LUT,
+        )
 
-        logging.info(f'Dimmable_LED_strip_channels: reset {thing.channels} to {values}.')
-        for channel_name in values.keys():
-            self.PWM_board.channels[self.channels[channel_name]].duty_cycle = 0
-            if self.value[channel_name] > 0:
-                self.last_on_value[channel_name] = self.value[channel_name]
-                self.value[channel_name] = 0
-                for thing1 in self.things[channel_name]:
-                    updated_things.add(thing1)
+    def compile_calibration(self, snapshot, curves, curve_families):
+        """
+        Compile the new `curves` ({channel name: curve at the calibrated
+        frequency}) and `curve_families` ({channel name: {frequency: curve}})
+        of some channels, on top of `snapshot`. Only the look-up tables of
+        these channels are computed (all channels for frequencies new to the
+        families). This does not touch the channels: it can run in a worker
+        thread, while the lights are being driven.
+        Return what swap_calibration needs.
+        """
 
-        for thing1 in updated_things:
-            t1v = {k: v  for k, v in self.value.items() if k in thing1.channels}
-            thing1.properties["channel_brightness"].value.notify_of_external_update(t1v)
-            thing1.properties["colour"].value.notify_of_external_update(thing1.colour_convert(t1v))
-            thing1.properties["brightness"].value.notify_of_external_update(scale(max(t1v.values()), 100, "brightness"))
+        generation, frequency, calibrated_frequency, families, LUTs, LUT = snapshot
+        changed = [k  for k in self.channels if k in curves or k in curve_families]
+        for k in changed:
+            family = dict(curve_families.get(k, families[k]))
+            # The curve given for the calibrated frequency prevails
+            family[calibrated_frequency] = curves.get(k, families[k][calibrated_frequency])
+            families[k] = {f: {float(x): y  for x, y in curve.items()}  for f, curve in family.items()}
+        changed_families = {k: families[k]  for k in changed}
+
+        new_LUTs = {}
+        for f in set().union(*families.values()):
+            if f in LUTs:
+                new_LUTs[f] = {**LUTs[f], **self.__compile_LUTs(self.__curves_at(f, changed_families))}
+            else:
+                new_LUTs[f] = self.__compile_LUTs(self.__curves_at(f, families))
+        changed_curves = self.__curves_at(frequency, changed_families)
+        if frequency in new_LUTs:
+            new_LUT = new_LUTs[frequency]
+        else:
+            new_LUT = {**LUT, **self.__compile_LUTs(changed_curves)}
 
-        logging.info(f'Dimmable_LED_strip_channels: reset self.value = {self.value}.')
-        if sum(self.value.values()) == 0:
-            GPIO.output(self.on_off_channel, False)
-            for thing2 in self.all_things:
-                thing2.properties["on"].value.notify_of_external_update(False)
-                thing2.properties["brightness"].value.notify_of_external_update(scale(0, 100, "brightness"))
+        return generation, changed, families, new_LUTs, new_LUT, changed_curves
 
-    def channel_brightness(self, thing, values):
+    def swap_calibration(self, compiled):
         """
-        Set channel values (maybe to zero), but only for the channels relevant to the calling `webthing`.
-        If all channels are 0, then switch the relay OFF.
-        If any channel is non 0, then switch the relay ON.
-        Notify all relevant changes to their `webthing`.
+        Swap in the curves compiled by compile_calibration, between two
+        commits, and redraw the lit channels whose curves changed, in one
+        commit. Return False, changing nothing, if the curves or the
+        frequency changed since the snapshot: it must be compiled again.
         """
 
-        updated_things = set()
-        # This is not a call to the self.set function, but the creation of a standard python set object (empty)
+        generation, changed, families, LUTs, LUT, changed_curves = compiled
+        if generation != self.curves_generation:
+            return False
+
+        logging.info(f'Dimmable_LED_strip_channels: new calibration of {changed}.')
+        self.curves_generation += 1
+        self.curve_families = families
+        self.LUTs           = LUTs
+        self.LUT            = LUT
+        self.channel_curves = {**self.channel_curves, **changed_curves}
+        metrics.count("calibration_reloads")
+
+        # Only the scenes and the channels lit that use the new curves
+        self.__compile_scenes([
+            name  for name, scene in self.scenes.items() if any(k in scene  for k in changed)
+        ])
+        lit = [k  for k in changed if k in self.lit_channels or self.compositor.active()]
+        if len(lit) > 0:
+            self.__commit(
+                {},
+                {self.channels[k]: self.__rectified_channel(self.value[k], k, k in self.raw_channels)  for k in lit}
+            )
 
-        logging.info(f'Dimmable_LED_strip_channels: channel_brightness {thing.channels} to {values}.')
-        for channel_name, value in values.items():
-            if self.value[channel_name] != value:
-                for thing1 in self.things[channel_name]:
-                    updated_things.add(thing1)
-            self.value[channel_name] = value
-            self.PWM_board.channels[self.channels[channel_name]].duty_cycle = self.__rectified_channel(value, channel_name)
+        for thing2 in set().union(*(self.things[k]  for k in changed)):
+            thing2.properties["channel_curve"].value.notify_of_external_update(self.channel_curves)
+        return True
 
-        for thing1 in updated_things:
-            t1v = {k: v  for k, v in self.value.items() if k in thing1.channels}
-            thing1.properties["channel_brightness"].value.notify_of_external_update(t1v)
-            thing1.properties["colour"].value.notify_of_external_update(thing1.colour_convert(t1v))
-            thing1.properties["brightness"].value.notify_of_external_update(scale(max(t1v.values()), 100, "brightness"))
+    def set_output_cap(self, cap):
+        """
+        Scale the duty cycles of all the channels by `cap` (0 to 1), from this
+        commit on, without changing the channel values: the channels lit are
+        written again in one commit.
+        """
 
-        logging.info(f'Dimmable_LED_strip_channels: channel_brightness self.value = {self.value}.')
-        if sum(self.value.values()) == 0:
-            GPIO.output(self.on_off_channel, False)
-            for thing2 in self.all_things:
-                thing2.properties["on"].value.notify_of_external_update(False)
-        else:
-            GPIO.output(self.on_off_channel, True)
-            for thing2 in self.all_things:
-                if max([v  for k, v in self.value.items() if k in thing2.channels]) > 0:
-                    thing2.properties["on"].value.notify_of_external_update(True)
+        cap = min(1.0, max(0.0, cap))
+        if cap == self.output_cap:
+            return
 
-    def channel_curve(self, value):
-        logging.info(f'Dimmable_LED_strip_channels: command to adjust channel curves to {value}.')
-        for c in value.keys():
-            self.channel_curves[c] = {float(k): v  for k, v in value[c].items()}
+        self.output_cap = cap
+        self.__commit(
+            {},
+            {self.channels[k]: self.__rectified_channel(self.value[k], k, k in self.raw_channels)
+             for k in (self.channels if self.compositor.active() else self.lit_channels)}
+        )
 
         for thing2 in self.all_things:
-            thing2.properties["channel_curve"].value.notify_of_external_update(self.channel_curves)
+            thing2.properties["output_cap"].value.notify_of_external_update(round(cap * 100, 1))
 
 
 class Dimmable_LED_strip_webthing(Thing):
@@ -972,7 +4583,8 @@ class Dimmable_LED_strip_webthing(Thing):
 
     # Take example on:
     # https://github.com/WebThingsIO/webthing-python/blob/5b779b5d3e545c93d636a0f6fac1582512cba62d/example/multiple-things.py#L161
-    def __init__(self, uritype, urilocation, uriname, name, description, channels, LED_strip_channels):
+    def __init__(self, uritype, urilocation, uriname, name, description, channels, LED_strip_channels,
+                 primaries=None):
         logging.info(f'{name}: initialising webthing.')
 
         Thing.__init__(
@@ -985,17 +4597,14 @@ class Dimmable_LED_strip_webthing(Thing):
 
         self.LED_strip_channels = LED_strip_channels
         self.channels           = channels
+        self.audio              = None  # Audio_reactive driving the channels
+        self.auto_off_delay     = 0     # seconds, 0 for no auto-off
+        self.auto_off_fade      = 0     # milliseconds
+        self.raw_brightness     = False # channel_brightness without the
+                                        # perceptual model
 
-        rgb = len(set(channels) & {"Red", "Green", "Blue"}) > 0
-        w   = len(set(channels) & {"White"}) > 0
-        if rgb & w:
-            self.colour_type = "RGBW"
-        elif rgb:
-            self.colour_type = "RGB"
-        elif w:
-            self.colour_type = "W"
-        else:
-            self.colour_type = "Other"
+        # Colour of each channel at full brightness, see Colour_mixer
+        self.mixer              = Colour_mixer(channels, primaries)
 
         LED_strip_channels.register_thing_with_LED_strip_channels(self)
 
@@ -1062,6 +4671,7 @@ class Dimmable_LED_strip_webthing(Thing):
                          'type':        'string',
                          'description': 'The colour of the light #000000 to #ffffff',
                          'unit':        'hexadecimal value',
+                         'pattern':     '^#[0-9a-fA-F]{6}$',
                      }))
 
         # Purpose:
@@ -1076,6 +4686,21 @@ class Dimmable_LED_strip_webthing(Thing):
                          'type':        'object',
                          'description': 'Control the brightness of each channel separately, value from 0.0 to 1.0',
                          'unit':        '1 = fully on',
+                         'additionalProperties': {'type': 'number', 'minimum': 0, 'maximum': 1},
+                     }))
+
+        # Purpose:
+        #   Set channel_brightness on the calibration curves only, without the
+        #   perceptual model, for calibration work.
+        self.add_property(
+            Property(self,
+                     'raw_channel_brightness',
+                     Value(False, self.raw_channel_brightness),
+                     metadata={
+                         '@type':       'BooleanProperty',
+                         'title':       'Raw channel brightness',
+                         'type':        'boolean',
+                         'description': 'Channel brightness follows the calibration curves only (no perceptual model)',
                      }))
 
         # Purpose:
@@ -1092,6 +4717,239 @@ class Dimmable_LED_strip_webthing(Thing):
                          'unit':        '{channel: {brightness: PWM ratio}}',
                      }))
 
+        # Purpose:
+        #   Change the PWM frequency of all channels (e.g. to get rid of
+        #   flicker on camera), the curves follow.
+        self.add_property(
+            Property(self,
+                     'frequency',
+                     Value(LED_strip_channels.frequency, self.frequency),
+                     metadata={
+                         '@type':       'FrequencyProperty',
+                         'title':       'PWM frequency',
+                         'type':        'integer',
+                         'description': 'PWM frequency of all channels, calibrated frequencies switch instantly',
+                         'unit':        'Hz',
+                         'minimum':     24,
+                         'maximum':     1526,
+                     }))
+
+        # Purpose:
+        #   Make the lights follow music: each channel shows the energy of a
+        #   band of frequencies (see Audio_reactive).
+        self.add_property(
+            Property(self,
+                     'audio_source',
+                     Value("", self.audio_source),
+                     metadata={
+                         '@type':       'AudioSourceProperty',
+                         'title':       'Audio source',
+                         'type':        'string',
+                         'description': 'WAV file or raw PCM stream (16 bit, 44.1kHz, mono) the lights follow, empty to stop',
+                     }))
+
+        # Purpose:
+        #   Show how much the output is derated to protect the electronics
+        #   from overheating (see Thermal_derating).
+        self.add_property(
+            Property(self,
+                     'output_cap',
+                     Value(round(LED_strip_channels.output_cap * 100, 1)),
+                     metadata={
+                         '@type':       'LevelProperty',
+                         'title':       'Output cap',
+                         'type':        'number',
+                         'readOnly':    True,
+                         'description': 'Maximum output of all channels, lowered when the enclosure overheats',
+                         'unit':        'percent',
+                         'minimum':     0,
+                         'maximum':     100,
+                     }))
+
+        # Purpose:
+        #   Show the current drawn from the 12V supply by all the channels, as
+        #   estimated from the calibration (see Power_budget).
+        self.add_property(
+            Property(self,
+                     'estimated_current',
+                     Value(round(LED_strip_channels.power.current, 2)),
+                     metadata={
+                         '@type':       'CurrentProperty',
+                         'title':       'Estimated current',
+                         'type':        'number',
+                         'readOnly':    True,
+                         'description': 'Current drawn by all the LED strips, the output is scaled down over the power budget',
+                         'unit':        'ampere',
+                         'minimum':     0,
+                     }))
+
+        # Purpose:
+        #   Meter the energy used by the channels of this webthing (see
+        #   Energy_accountant).
+        self.add_property(
+            Property(self,
+                     'energy',
+                     Value(round(LED_strip_channels.energy.energy(self.channels), 4)),
+                     metadata={
+                         '@type':       'EnergyProperty',
+                         'title':       'Energy',
+                         'type':        'number',
+                         'readOnly':    True,
+                         'description': 'Energy used by the LED strips since metering started, estimated from the calibration',
+                         'unit':        'kilowatt hour',
+                         'minimum':     0,
+                     }))
+
+        self.add_available_event(
+            'overheated',
+            {
+                'description':
+                'The lamp has exceeded its safe operating temperature',
+                'type': 'number',
+                'unit': 'degree celsius',
+            })
+
+        # Purpose:
+        #   Switch the lights off after a while without any command, e.g.
+        #   when forgotten on.
+        self.add_property(
+            Property(self,
+                     'auto_off',
+                     Value(self.auto_off_delay, self.auto_off),
+                     metadata={
+                         '@type':       'AutoOffProperty',
+                         'title':       'Auto-off',
+                         'type':        'integer',
+                         'description': 'Switch off after this long without command, restarted by any command, 0 to never',
+                         'unit':        'seconds',
+                         'minimum':     0,
+                     }))
+
+        self.add_property(
+            Property(self,
+                     'auto_off_fade',
+                     Value(self.auto_off_fade, self.auto_off_fade_duration),
+                     metadata={
+                         '@type':       'AutoOffFadeProperty',
+                         'title':       'Auto-off fade',
+                         'type':        'integer',
+                         'description': 'Fade out over this long when switching off automatically',
+                         'unit':        'milliseconds',
+                         'minimum':     0,
+                     }))
+
+        self.add_available_event(
+            'auto-off',
+            {
+                'description':
+                'The lamp was switched off after a while without command',
+                'type': 'integer',
+                'unit': 'seconds',
+            })
+
+        # Purpose:
+        #   Named presets of channel values, shared by all webthings, recalled
+        #   with the "apply_scene" action.
+        self.add_property(
+            Property(self,
+                     'scenes',
+                     Value(LED_strip_channels.scenes, self.scenes),
+                     metadata={
+                         '@type':       'ScenesProperty',
+                         'title':       'Scenes',
+                         'type':        'object',
+                         'description': 'Named presets of channel values, value from 0.0 to 1.0',
+                         'unit':        '{scene: {channel: brightness}}',
+                     }))
+
+        self.add_available_action(
+            'apply_scene',
+            {
+                'title': 'Apply scene',
+                'description': 'Set all the channels of a scene together, optionally fading',
+                'input': {
+                    'type': 'object',
+                    'required': [
+                        'name',
+                    ],
+                    'properties': {
+                        'name': {
+                            'type': 'string',
+                        },
+                        'duration': {
+                            'type': 'integer',
+                            'minimum': 0,
+                            'unit': 'milliseconds',
+                        },
+                    },
+                },
+            },
+            ApplySceneAction)
+
+        self.add_available_action(
+            'save_scene',
+            {
+                'title': 'Save scene',
+                'description': 'Save the current channel values of this light as a scene',
+                'input': {
+                    'type': 'object',
+                    'required': [
+                        'name',
+                    ],
+                    'properties': {
+                        'name': {
+                            'type': 'string',
+                        },
+                    },
+                },
+            },
+            SaveSceneAction)
+
+        self.add_available_action(
+            'overlay',
+            {
+                'title': 'Overlay',
+                'description': 'Blend values over channels for a while (e.g. a blink), the light settings stay, no values to clear',
+                'input': {
+                    'type': 'object',
+                    'properties': {
+                        'values': {
+                            'type': 'object',
+                            'unit': '{channel: brightness}',
+                        },
+                        'mode': {
+                            'type': 'string',
+                            'enum': list(Compositor.MODES),
+                        },
+                        'layer': {
+                            'type': 'string',
+                            'enum': list(Compositor.ORDERS),
+                        },
+                        'duration': {
+                            'type': 'integer',
+                            'minimum': 0,
+                            'unit': 'milliseconds',
+                        },
+                    },
+                },
+            },
+            OverlayAction)
+
+        # Purpose:
+        #   Counters and latencies of the hot paths, for monitoring.
+        self.add_property(
+            Property(self,
+                     'diagnostics',
+                     Diagnostics_value(),
+                     metadata={
+                         '@type':       'DiagnosticsProperty',
+                         'title':       'Diagnostics',
+                         'type':        'object',
+                         'readOnly':    True,
+                         'description': 'Counters and latencies (ms) of commits, I2C writes, notifications, relay toggles and sensor reads',
+                         'unit':        '{counters: {name: count}, latency_ms: {name: {count, mean, p50, p99}}}',
+                     }))
+
         logging.info(f'{name}: initialised webthing.')
 
     def colour_convert(self, value):
@@ -1099,51 +4957,109 @@ class Dimmable_LED_strip_webthing(Thing):
         ...
         """
 
-        r = value["Red"]   if "Red"   in value else 0
-        g = value["Green"] if "Green" in value else 0
-        b = value["Blue"]  if "Blue"  in value else 0
-        w = value["White"] if "White" in value else 0
+        r, g, b = self.mixer.colours([value.get(k, 0)  for k in self.mixer.channels])
+        c = f"#{scale(r, 255, 'Hex colour'):02x}{scale(g, 255, 'Hex colour'):02x}{scale(b, 255, 'Hex colour'):02x}"
 
-        c = "#000000"
-
-        if   self.colour_type == "RGB":
-            c = f"#{scale(r, 255, 'Hex colour'):02x}{scale(g, 255, 'Hex colour'):02x}{scale(b, 255, 'Hex colour'):02x}"
-        elif self.colour_type == "W":
-            c = "#" + f"{scale(r, 255, 'Hex colour'):02x}" * 3
-        elif self.colour_type == "RGBW":
-            W = w - min((r, g, b))
-            if w > 0:
-                M = W / w - max((r, g, b))
-                r += M
-                g += M
-                b += M
-            c = f"#{scale(r, 255, 'Hex colour'):02x}{scale(g, 255, 'Hex colour'):02x}{scale(b, 255, 'Hex colour'):02x}"
-
-        logging.debug(f"{self.title}: convert colour {value} for {self.colour_type} -> {c}.")
+        trace.record("colour_convert", self.title, int(c[1:7], 16))
         return c
 
     def OnOff(self, value):
         logging.info(f'{self.title}: command to switch lights {"ON" if value else "OFF"}.')
+        loop_monitor.blame(self, 'on')
         self.LED_strip_channels.OnOff(self, value)
+        if not value and self.audio is not None:
+            # After switching off: stopping restores the last ON values the
+            # audio levels replaced
+            self.audio_source("")
+            self.properties["audio_source"].value.notify_of_external_update("")
+        self.restart_auto_off()
 
     def brightness(self, value):
         logging.info(f'{self.title}: command to alter light brightness to {value}.')
+        loop_monitor.blame(self, 'brightness')
         self.LED_strip_channels.brightness(self, value)
+        self.restart_auto_off()
 
     def colour(self, value):
         logging.info(f'{self.title}: command to alter light colour to {value}.')
+        loop_monitor.blame(self, 'colour')
         self.LED_strip_channels.colour(self, value)
+        self.restart_auto_off()
 
     def channel_brightness(self, value):
         logging.info(f'{self.title}: command to adjust light channels to {value}.')
+        loop_monitor.blame(self, 'channel_brightness')
         filtered_value = {k: v  for k, v in value.items() if k in self.channels}
         if len(filtered_value) > 0:
-            self.LED_strip_channels.channel_brightness(self, filtered_value)
+            self.LED_strip_channels.channel_brightness(self, filtered_value, self.raw_brightness)
+        self.restart_auto_off()
+
+    def raw_channel_brightness(self, value):
+        logging.info(f'{self.title}: command to set raw channel brightness {"ON" if value else "OFF"}.')
+        self.raw_brightness = bool(value)
+
+    def auto_off(self, value):
+        logging.info(f'{self.title}: command to switch off automatically after {value}s.')
+        self.auto_off_delay = max(0, int(value))
+        self.restart_auto_off()
+
+    def auto_off_fade_duration(self, value):
+        logging.info(f'{self.title}: command to fade out over {value}ms when switching off automatically.')
+        self.auto_off_fade = max(0, int(value))
+
+    def restart_auto_off(self):
+        """
+        Start the auto-off timer again if the light is on (any channel), stop
+        it otherwise (e.g. switched off by hand).
+        """
+
+        LED_strip_channels = self.LED_strip_channels
+        if self.auto_off_delay > 0 and any(LED_strip_channels.value[k] > 0  for k in self.channels):
+            LED_strip_channels.timers.schedule(self, self.auto_off_delay, self.__auto_off_due)
+        else:
+            LED_strip_channels.timers.cancel(self)
+
+    def __auto_off_due(self):
+        logging.info(f'{self.title}: switching off automatically after {self.auto_off_delay}s.')
+        metrics.count("auto_offs")
+        self.add_event(AutoOffEvent(self, self.auto_off_delay))
+        if self.audio is not None:
+            self.audio_source("")
+            self.properties["audio_source"].value.notify_of_external_update("")
+        if self.auto_off_fade > 0:
+            self.LED_strip_channels.fade_off(self, self.auto_off_fade / 1000)
+        else:
+            self.LED_strip_channels.OnOff(self, False)
+
+    def audio_source(self, value):
+        logging.info(f'{self.title}: command to follow audio from "{value}".')
+        loop_monitor.blame(self, 'audio_source')
+        if self.audio is not None:
+            self.audio.stop()
+            self.audio = None
+        if value:
+            self.audio = Audio_reactive(self.LED_strip_channels, self.channels, value,
+                                        on_end=self.__audio_end)
+
+    def __audio_end(self):
+        self.audio = None
+        self.properties["audio_source"].value.notify_of_external_update("")
 
     def channel_curve(self, value):
         logging.info(f'{self.title}: command to adjust channel curves to {value}.')
+        loop_monitor.blame(self, 'channel_curve')
         self.LED_strip_channels.channel_curve(value)
 
+    def frequency(self, value):
+        logging.info(f'{self.title}: command to set the PWM frequency to {value} Hz.')
+        loop_monitor.blame(self, 'frequency')
+        self.LED_strip_channels.set_frequency(value)
+
+    def scenes(self, value):
+        logging.info(f'{self.title}: command to set scenes to {value}.')
+        loop_monitor.blame(self, 'scenes')
+        self.LED_strip_channels.scenes_update(value)
+
 
 """
     Dimmable_LED_strip_webthing.add_available_action(
@@ -1193,6 +5109,67 @@ def load_calibration(channel):
         return pickle.load(f)
 
 
+def load_calibration_family(channel):
+    """
+    Return the curves of `channel` indexed by frequency (see
+    Compute-LED-calibration.py), none if there is no curve family file.
+    """
+
+    filename = f"Calibration-channel{channel}-family.pkl"
+    if not os.path.exists(filename):
+        return {}
+    with open(filename, "rb") as f:
+        return pickle.load(f)
+
+
+def load_scenes(filename):
+    """
+    Return the scenes saved in `filename`, no scenes if there is no file yet.
+    """
+
+    if filename is None or not os.path.exists(filename):
+        return {}
+    with open(filename, "rb") as f:
+        return pickle.load(f)
+
+
+def save_scenes(filename, scenes):
+    """
+    Save the scenes to `filename`, replacing the previous file in one step so
+    that a power cut cannot leave a truncated file.
+    """
+
+    if filename is None:
+        return
+    with open(f"{filename}.tmp", "wb") as f:
+        pickle.dump(scenes, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(f"{filename}.tmp", filename)
+
+
+def load_schedule(filename):
+    """
+    Return the scheduler entries saved in `filename`, none if there is no
+    file yet.
+    """
+
+    if filename is None or not os.path.exists(filename):
+        return {}
+    with open(filename, "rb") as f:
+        return pickle.load(f)
+
+
+def save_schedule(filename, entries):
+    """
+    Save the scheduler entries to `filename`, in one step (see save_scenes).
+    """
+
+    if filename is None:
+        return
+    with open(f"{filename}.tmp", "wb") as f:
+        pickle.dump(entries, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(f"{filename}.tmp", filename)
+
+
 class Weather_measurement_webthing(Thing):
     """
     This class defines a webthing that communicates with the BME280 PCB over
@@ -1201,9 +5178,13 @@ class Weather_measurement_webthing(Thing):
     """
 
 
-    def __init__(self, uritype, urilocation, uriname, name, description, i2c_bus):
+    def __init__(self, uritype, urilocation, uriname, name, description, i2c_bus,
+                 thermal_derating=None):
         logging.info(f'{name}: initialising webthing.')
 
+        # Fed with the temperature readings, see Thermal_derating
+        self.thermal_derating = thermal_derating
+
         self.bme280 = adafruit_bme280.Adafruit_BME280_I2C(i2c_bus, address=0x76)
         self.bme280.sea_level_pressure = 1013.25
         logging.info(f'STT {self.bme280.measurement_time_typical}ms')
@@ -1296,6 +5277,22 @@ class Weather_measurement_webthing(Thing):
             )
         )
 
+        self.add_property(
+            Property(
+                self,
+                'diagnostics',
+                Diagnostics_value(),
+                metadata={
+                     '@type':       'DiagnosticsProperty',
+                     'title':       'Diagnostics',
+                     'type':        'object',
+                     'readOnly':    True,
+                     'description': 'Counters and latencies (ms) of commits, I2C writes, notifications, relay toggles and sensor reads',
+                     'unit':        '{counters: {name: count}, latency_ms: {name: {count, mean, p50, p99}}}',
+                }
+            )
+        )
+
 #        self.properties["all_sensor_readings"].value.notify_of_external_update(self.readings)
 #        for k in self.readings:
 #            self.properties[k].value.notify_of_external_update(self.readings[k])
@@ -1305,12 +5302,17 @@ class Weather_measurement_webthing(Thing):
 
 
     def all_sensor_readings(self):
-        return {
+        loop_monitor.blame(self, 'all_sensor_readings')
+        start = time.perf_counter()
+        readings = {
             "temperature":          self.bme280.temperature,
             "relative_humidity":    self.bme280.relative_humidity,
             "pressure":             self.bme280.pressure,
             #"altitude":             self.bme280.altitude,
         }
+        metrics.count("sensor_reads")
+        metrics.observe("sensor_read", time.perf_counter() - start)
+        return readings
 
 
     async def property_update_loop(self):
@@ -1319,6 +5321,9 @@ class Weather_measurement_webthing(Thing):
                 self.readings = self.all_sensor_readings()
                 notified = False
 
+                if self.thermal_derating is not None:
+                    self.thermal_derating.update(self.readings["temperature"])
+
                 for k in self.readings:
                     if ((math.fabs(self.readings_notified[k] - self.readings[k])
                          < self.readings_change_tolerance[k])
@@ -1342,6 +5347,7 @@ class Weather_measurement_webthing(Thing):
                                 self.readings_notified[k] = round(self.readings[k], self.readings_digits[k])
 
                             self.properties[k].value.notify_of_external_update(self.readings_notified[k])
+                            metrics.count("sensor_notifications")
 
                             logging.info(f'Sensor update: {k} = {self.readings[k]:0.2f}')
                             notified = True
@@ -1366,7 +5372,11 @@ class Weather_measurement_webthing(Thing):
             await asyncio.sleep(60.01 - time.time() % 60)
 
             while True:
+                loop_monitor.blame(self, 'pressure')
+                start = time.perf_counter()
                 p[n] = round(self.bme280.pressure, 2)
+                metrics.count("pressure_reads")
+                metrics.observe("pressure_read", time.perf_counter() - start)
                 if n == 0:
                     pmin, pmax, psum, pssq = p[n], p[n], p[n], p[n] ** 2
                 else:
@@ -1396,14 +5406,30 @@ class Weather_measurement_webthing(Thing):
             pass
 
 
-def run_server():
+def run_server(simulate=False, record=None, debug_loop=False):
+    """
+    simulate            # True to run without the hardware: simulated I2C bus
+                        # (PWM boards and BME280) and relay GPIO
+    record              # File to record the traffic to (see
+                        # Traffic_recorder), None not to record
+    debug_loop          # True to time every callback of the loop (asyncio
+                        # debug mode, slower), see Loop_monitor
+    """
+
+    global GPIO
+
     logging.basicConfig(
-        level  = logging.DEBUG,
+        level  = logging.INFO,
         format = "%(asctime)s %(filename)s:%(lineno)s %(levelname)s %(message)s"
     )
 
     logging.info('run_server: configure GPIO')
-    i2c_bus = busio.I2C(board.SCL, board.SDA)               # set-up the I2C communication bus
+    if simulate:
+        logging.info('run_server: simulated hardware')
+        GPIO    = Simulated_GPIO()
+        i2c_bus = Simulated_I2C()
+    else:
+        i2c_bus = busio.I2C(board.SCL, board.SDA)           # set-up the I2C communication bus
     GPIO.setmode(GPIO.BCM)
     # Notes:
     #   1/ Every MOS FET board behaves differently: change the curves to match your equipment.
@@ -1415,6 +5441,7 @@ def run_server():
     curves.append(load_calibration(1))
     curves.append(load_calibration(2))
     curves.append(load_calibration(3))
+    families = [load_calibration_family(c)  for c in range(4)]
 
     LED_strip_channels = Dimmable_LED_strip_channels(23, i2c_bus, 991, {"Red": 0, "Green": 1, "Blue": 3, "White": 2},
         # Approximately good curves for my set-up (hand & eye tuned):
@@ -1426,7 +5453,23 @@ def run_server():
         # "Green": {0.0001:0.0343, 0.5:0.09, 0.93:0.20, 0.99:0.4},
         # "Blue":  {0.0001:0.24  , 0.5:0.6 , 0.93:0.77, 0.99:0.95},
         # "White": {0.0001:0.0075, 0.83:0.05, 0.93:0.2, 0.99:0.3},
-         }
+         },
+        scenes_file = "Scenes.pkl",
+        state_file  = "State.journal",
+        # True to isolate PWM writes in their own process
+        split_process = False,
+        # Fast enough for streaming at 100 fps
+        frame_rate    = 100,
+        # Curves at other frequencies
+        curve_families = {"Red": families[0], "Green": families[1], "Blue": families[3], "White": families[2]},
+        # About 2A with all four channels fully on (measured)
+        channel_watts  = {"Red": 4.8, "Green": 4.8, "Blue": 4.8, "White": 9.6},
+        # 4A supply, with some margin
+        power_budget   = 3.5,
+        energy_file    = "Energy.pkl",
+        # The powers of Compute-LED-calibration.py already bend these curves,
+        # use "CIE" with curves computed with powers around 1
+        perceptual     = None,
     )
 
     urilocation = 'am56.GF.Porch'
@@ -1456,24 +5499,81 @@ def run_server():
                                                            'Weather measurements in the porch',
                                                            'Temperature, humidity and pressure measurements in the porch',
                                                            i2c_bus,
+                                                           # Same enclosure as the MOS FETs and the power supply
+                                                           thermal_derating=Thermal_derating(LED_strip_channels,
+                                                                                             start=45, full=60),
                                                            )
 
     logging.info('run_server: define things: Dimmable_LED_strip_webthings')
     Dimmable_LED_strip_webthings = [Dimmable_RGB_LED_strip, Dimmable_White_LED_strip, Dimmable_RGBW_LED_strip,]
     Sensor_webthings = [Weather_measurements,]
+    LED_strip_channels.restore()
+
+    # Self-calibration if the ADS1115 is plugged in, inputs wired as the PWM
+    # outputs
+    self_calibration = None
+    if not simulate:
+        self_calibration = Self_calibration.detect(LED_strip_channels, i2c_bus,
+                                                   {"Red": 0, "Green": 1, "Blue": 3, "White": 2})
+    if self_calibration is not None:
+        self_calibration.start()
+
+    # Tuning the calibration (Compute-LED-calibration.py) shows in seconds
+    calibration_watcher = Calibration_watcher(LED_strip_channels, {"Red": 0, "Green": 1, "Blue": 3, "White": 2})
+    calibration_watcher.start()
+
+    # Lights on at dusk and off at night, even if the gateway is down
+    scheduler = Scheduler(Dimmable_LED_strip_webthings + Sensor_webthings, LED_strip_channels,
+                          "Schedule.pkl", solar_table="Solar-table.pkl")
+
     logging.info('run_server: define server')
     Server = WebThingServer(MultipleThings(Dimmable_LED_strip_webthings + Sensor_webthings,
                                            'Porch lights & sensors'),
                             port=8888, hostname='rpi3.local',
+                            additional_routes=[[r'/metrics', Metrics_handler, {}],
+                                               [r'/trace', Trace_handler, {}],
+                                               [r'/stream', Stream_handler,
+                                                dict(LED_strip_channels=LED_strip_channels)],
+                                               [r'/bulk', Bulk_handler,
+                                                dict(things=Dimmable_LED_strip_webthings + Sensor_webthings,
+                                                     LED_strip_channels=LED_strip_channels)],
+                                               [r'/schedule', Schedule_handler, dict(scheduler=scheduler)]],
                            )
 
+    recorder = None
+    if record is not None:
+        recorder = Traffic_recorder(record)
+        recorder.start(Server.app)
+
+    # Hot paths are traced rather than logged: write a sample to the log, and
+    # the whole trace when something goes wrong.
+    trace.sample_every = 100
+
+    def exception_handler(loop, context):
+        trace.dump_to_log()
+        loop.default_exception_handler(context)
+
+    asyncio.get_event_loop().set_exception_handler(exception_handler)
+
     try:
         logging.info('run_server: start')
+        loop_monitor.start(debug=debug_loop)
         Server.start()
     except KeyboardInterrupt:
         pass
+    except Exception:
+        trace.dump_to_log()
+        raise
     finally:
+        if self_calibration is not None:
+            self_calibration.stop()
+        calibration_watcher.stop()
+        scheduler.stop()
+        loop_monitor.stop()
         Dimmable_RGBW_LED_strip.OnOff(False)
+        LED_strip_channels.stop()
+        if recorder is not None:
+            recorder.stop()
         logging.info('run_server: stop')
         Server.stop()
         logging.info('run_server: stopped')
@@ -1482,7 +5582,15 @@ def run_server():
 
 
 if __name__ == '__main__':
-    run_server()
+    parser = argparse.ArgumentParser(description='Webthing server of the porch lights & sensors')
+    parser.add_argument('--simulate', action='store_true',
+                        help='run without the hardware (simulated I2C bus and relay)')
+    parser.add_argument('--record', metavar='FILE',
+                        help='record the traffic to FILE, to replay with Replay-traffic.py')
+    parser.add_argument('--debug-loop', action='store_true',
+                        help='time every callback of the event loop to find slow ones (slower)')
+    arguments = parser.parse_args()
+    run_server(simulate=arguments.simulate, record=arguments.record, debug_loop=arguments.debug_loop)
 
 """
 TESTING 2020-09-24
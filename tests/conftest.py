@@ -0,0 +1,105 @@
+"""
+Stand-ins for the hardware libraries of the server module (RPi.GPIO, board,
+busio, adafruit_pca9685 and adafruit_bme280), so that the tests run on a
+machine without them. A library that is installed is used as is.
+The stand-ins only need to drive the Simulated_I2C bus of the module (the
+tests never touch a real bus): the PCA9685 writes its registers to it, the
+BME280 returns the example readings of its datasheet.
+"""
+
+import importlib
+import math
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "code"))
+
+
+def missing(name):
+    try:
+        importlib.import_module(name)
+    except (ImportError, RuntimeError):     # RPi.GPIO off a Raspberry Pi
+        return True
+    return False
+
+
+def stand_in(name, **attributes):
+    module = types.ModuleType(name)
+    module.__dict__.update(attributes)
+    sys.modules[name] = module
+    return module
+
+
+class I2C_device():
+    def __init__(self, i2c, address):
+        self.i2c     = i2c
+        self.address = address
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        return False
+
+    def write(self, buffer, *, start=0, end=None):
+        self.i2c.writeto(self.address, buffer, start=start, end=end)
+
+
+class PCA9685():
+    MODE1     = 0x00
+    PRESCALE  = 0xFE
+
+    def __init__(self, i2c_bus, *, address=0x40, reference_clock_speed=25000000):
+        self.i2c_device = I2C_device(i2c_bus, address)
+        self.reference_clock_speed = reference_clock_speed
+        self.prescale   = 0x1E
+
+    @property
+    def frequency(self):
+        return self.reference_clock_speed / 4096 / (self.prescale + 1)
+
+    @frequency.setter
+    def frequency(self, frequency):
+        self.prescale = max(3, min(255, math.floor(self.reference_clock_speed / 4096 / frequency + 0.5) - 1))
+        with self.i2c_device as i2c:
+            i2c.write(bytes((self.MODE1, 0x10)))             # sleep
+            i2c.write(bytes((self.PRESCALE, self.prescale)))
+            i2c.write(bytes((self.MODE1, 0xA0)))             # restart, auto-increment
+
+
+class Adafruit_BME280_I2C():
+    measurement_time_typical = 8
+    measurement_time_max     = 10
+
+    def __init__(self, i2c, address=0x77):
+        self.sea_level_pressure = 1013.25
+        self.temperature        = 25.08
+        self.relative_humidity  = 50.0
+        self.pressure           = 1006.5
+
+    @property
+    def altitude(self):
+        return 44330 * (1.0 - math.pow(self.pressure / self.sea_level_pressure, 0.1903))
+
+
+class I2C():
+    def __init__(self, scl, sda, *, frequency=100000):
+        raise RuntimeError("no I2C bus here, run the server simulated")
+
+
+if missing("RPi.GPIO"):
+    GPIO = stand_in("RPi.GPIO", BCM=11, OUT=0, IN=1,
+                    setmode=lambda mode: None,
+                    setup=lambda channel, direction: None,
+                    output=lambda channel, value: None,
+                    cleanup=lambda: None)
+    stand_in("RPi", GPIO=GPIO, __path__=[])
+if missing("board"):
+    stand_in("board", SCL=3, SDA=2)
+if missing("busio"):
+    stand_in("busio", I2C=I2C)
+if missing("adafruit_pca9685"):
+    stand_in("adafruit_pca9685", PCA9685=PCA9685)
+if missing("adafruit_bme280"):
+    stand_in("adafruit_bme280", Adafruit_BME280_I2C=Adafruit_BME280_I2C)
@@ -0,0 +1,141 @@
+"""
+Tests of the additional routes of the webthing server (/bulk, /stream,
+/metrics, /trace and /schedule) and of the colour property, on simulated
+hardware, run with: python -m pytest tests
+The server module needs its hardware libraries (RPi.GPIO, board, busio...) to
+be importable, conftest.py stands in for those that are not.
+"""
+
+import json
+import struct
+
+import pytest
+
+server = pytest.importorskip("webthing_dimmable_LED_strip")
+
+import tornado.testing
+import tornado.websocket
+
+
+CURVE = {0.0001: 0.03, 0.5: 0.11, 0.93: 0.23, 0.99: 0.8}
+
+
+class Handlers_test(tornado.testing.AsyncHTTPTestCase):
+    """
+    The routes of run_server --simulate, with an RGB and a white webthing on
+    the same channels, and an empty scheduler.
+    """
+
+    def get_app(self):
+        self.LED_strip_channels = server.Dimmable_LED_strip_channels(
+            23, server.Simulated_I2C(bit_rate=10**9), 991, {"Red": 0, "Green": 1, "Blue": 3, "White": 2},
+            {name: CURVE  for name in ("Red", "Green", "Blue", "White")},
+            relay_settle=0)
+        self.things = [
+            server.Dimmable_LED_strip_webthing('powerled.rgb', 'test', 'RGB', 'RGB', 'RGB LED strip',
+                                               ["Red", "Green", "Blue"], self.LED_strip_channels),
+            server.Dimmable_LED_strip_webthing('powerled.w', 'test', 'White', 'White', 'White LED strip',
+                                               ["White"], self.LED_strip_channels),
+        ]
+        self.scheduler = server.Scheduler(self.things, self.LED_strip_channels, filename=None,
+                                          solar_table=None)
+        self.server = server.WebThingServer(
+            server.MultipleThings(self.things, 'Test lights'),
+            disable_host_validation=True,
+            additional_routes=[[r'/metrics', server.Metrics_handler, {}],
+                               [r'/trace', server.Trace_handler, {}],
+                               [r'/stream', server.Stream_handler,
+                                dict(LED_strip_channels=self.LED_strip_channels)],
+                               [r'/bulk', server.Bulk_handler,
+                                dict(things=self.things, LED_strip_channels=self.LED_strip_channels)],
+                               [r'/schedule', server.Schedule_handler, dict(scheduler=self.scheduler)]],
+        )
+        return self.server.app
+
+    def tearDown(self):
+        self.scheduler.stop()
+        self.LED_strip_channels.stop()
+        super().tearDown()
+
+    def put(self, path, body):
+        return self.fetch(path, method="PUT", body=json.dumps(body))
+
+    def test_bulk(self):
+        response = self.put("/bulk", {"0": {"colour": "#ff0000"}, "1": {"channel_brightness": {"White": 0.5}}})
+        assert response.code == 200
+        reply = json.loads(response.body)
+        assert reply["0"]["colour"] == "#ff0000"
+        assert reply["1"]["channel_brightness"] == {"White": 0.5}
+        assert self.LED_strip_channels.value["Red"] == pytest.approx(1)
+        assert self.LED_strip_channels.value["Green"] == 0
+        assert self.LED_strip_channels.value["White"] == 0.5
+
+    def test_bulk_rejected(self):
+        self.put("/bulk", {"1": {"channel_brightness": {"White": 0.5}}})
+        before = dict(self.LED_strip_channels.value)
+
+        for thing_id in ("-1", "-2", "2", "1.0", " 1", "one"):
+            response = self.put("/bulk", {"0": {"on": False}, thing_id: {"on": False}})
+            assert response.code == 404, thing_id
+        for properties in ({"colour": "red"}, {"colour": "#ff00"}, {"colour": 0xff0000},
+                           {"channel_brightness": {"Red": "x"}}, {"channel_brightness": {"Red": 1.5}},
+                           {"channel_brightness": {"Red": True}}, {"channel_brightness": {"White": 0.2}},
+                           {"channel_curve": {}}):
+            response = self.put("/bulk", {"1": {"on": False}, "0": properties})
+            assert response.code == 400, properties
+        assert self.put("/bulk", ["0"]).code == 400
+        assert self.fetch("/bulk", method="PUT", body="{").code == 400
+
+        assert self.LED_strip_channels.value == before
+
+    def test_colour_property_rejected(self):
+        response = self.put("/0/properties/colour", {"colour": "red"})
+        assert response.code == 400
+        response = self.put("/0/properties/channel_brightness", {"channel_brightness": {"Red": "x"}})
+        assert response.code == 400
+        assert self.LED_strip_channels.value["Red"] == 0
+
+    def test_metrics(self):
+        self.put("/bulk", {"0": {"on": True}})
+        response = self.fetch("/metrics")
+        assert response.code == 200
+        assert response.headers["Content-Type"].startswith("text/plain")
+        assert b"powerled_bulk_commits" in response.body
+
+    def test_trace(self):
+        self.put("/bulk", {"1": {"channel_brightness": {"White": 0.25}}})
+        response = self.fetch("/trace")
+        assert response.code == 200
+        assert b"bulk" in response.body
+
+    def test_schedule(self):
+        entries = {"evening": {"trigger": "0 19 * * *", "thing": 1, "on": True}}
+        response = self.put("/schedule", entries)
+        assert response.code == 200
+        reply = json.loads(response.body)
+        assert reply["entries"] == entries
+        assert "evening" in reply["next"]
+
+        for entry in ({"trigger": "0 19 * * *", "thing": 0, "colour": "red"},
+                      {"trigger": "0 19 * * *", "thing": 0, "channel_brightness": {"Red": 2}},
+                      {"trigger": "0 19 * * *", "thing": 5, "on": True},
+                      {"trigger": "0 25 * * *", "thing": 0, "on": True}):
+            response = self.put("/schedule", {"bad": entry})
+            assert response.code == 400, entry
+        assert b"is not #rrggbb" in self.put("/schedule", {"bad": {"trigger": "0 19 * * *", "colour": "red"}}).body
+        assert json.loads(self.fetch("/schedule").body)["entries"] == entries
+
+    @tornado.testing.gen_test
+    async def test_stream(self):
+        connection = await tornado.websocket.websocket_connect(self.get_url("/stream").replace("http", "ws"))
+        # Channel 0 (Red) and 2 (Blue)
+        connection.write_message(struct.pack("<IHIHH", 1, 0, 0b101, 65535, 32768), binary=True)
+        # Older frame: dropped
+        connection.write_message(struct.pack("<IHIH", 0, 0, 0b1, 0), binary=True)
+        for _ in range(100):
+            if self.LED_strip_channels.value["Blue"] > 0:
+                break
+            await tornado.gen.sleep(0.01)
+        connection.close()
+        assert self.LED_strip_channels.value["Red"] == 1
+        assert self.LED_strip_channels.value["Blue"] == pytest.approx(32768 / 65535)
@@ -0,0 +1,126 @@
+"""
+Tests of the triggers of the local scheduler (Scheduler.parse_trigger and
+Scheduler.next_time), run with: python -m pytest tests
+The server module needs its hardware libraries (RPi.GPIO, board, busio...) to
+be importable, conftest.py stands in for those that are not.
+"""
+
+import array
+import os
+import pickle
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "code"))
+server = pytest.importorskip("webthing_dimmable_LED_strip")
+
+
+class LED_strip_channels():
+    scenes = {"porch": {"White": 0.5}}
+
+
+def local(year, month, day, hour=0, minute=0):
+    return time.mktime((year, month, day, hour, minute, 0, 0, 0, -1))
+
+
+@pytest.fixture
+def scheduler(tmp_path):
+    """
+    A scheduler without entries nor webthings, its solar table has sunset at
+    18:00 UTC, sunrise at 06:00 UTC and no dusk from 1 June to 31 July.
+    """
+
+    minutes = {event: array.array("h", [0] * 366)  for event in server.Scheduler.SOLAR}
+    minutes["sunrise"] = array.array("h", [6 * 60] * 366)
+    minutes["sunset"]  = array.array("h", [18 * 60] * 366)
+    minutes["dusk"]    = array.array("h", [19 * 60] * 152 + [server.Scheduler.NONE] * 61 + [19 * 60] * 153)
+    table = tmp_path / "Solar-table.pkl"
+    with open(table, "wb") as f:
+        pickle.dump({"latitude": 0, "longitude": 0, "year": 2024, "minutes": minutes}, f)
+    return server.Scheduler([], LED_strip_channels(), filename=None, solar_table=str(table))
+
+
+def test_cron_fields(scheduler):
+    kind, (minutes, hours, days, months, weekdays, restricted) = scheduler.parse_trigger("*/15 8-10 1,15 * 7")
+    assert kind == "cron"
+    assert minutes == {0, 15, 30, 45}
+    assert hours == {8, 9, 10}
+    assert days == {1, 15}
+    assert months == set(range(1, 13))
+    assert weekdays == {0}
+    assert restricted == (True, True)
+
+
+@pytest.mark.parametrize("trigger", [
+    "60 * * * *", "* 24 * * *", "* * 0 * *", "* * * 13 *", "* * * * 8",
+    "5-1 * * * *", "* * *", "noon", "sunset+ten",
+])
+def test_invalid_triggers(scheduler, trigger):
+    with pytest.raises(ValueError):
+        scheduler.parse_trigger(trigger)
+
+
+def test_cron_next_time(scheduler):
+    trigger = scheduler.parse_trigger("30 23 * * *")
+    assert scheduler.next_time(trigger, local(2026, 3, 10, 12)) == local(2026, 3, 10, 23, 30)
+    # Strictly after
+    assert scheduler.next_time(trigger, local(2026, 3, 10, 23, 30)) == local(2026, 3, 11, 23, 30)
+
+
+def test_cron_step(scheduler):
+    trigger = scheduler.parse_trigger("*/20 * * * *")
+    assert scheduler.next_time(trigger, local(2026, 3, 10, 12, 41)) == local(2026, 3, 10, 13, 0)
+
+
+def test_cron_weekday(scheduler):
+    # 2026-03-10 is a Tuesday, Sunday is 0 or 7
+    for weekday in ("0", "7"):
+        trigger = scheduler.parse_trigger(f"0 9 * * {weekday}")
+        assert scheduler.next_time(trigger, local(2026, 3, 10)) == local(2026, 3, 15, 9)
+
+
+def test_cron_day_or_weekday(scheduler):
+    # Both restricted: either matches (13th or next Monday)
+    trigger = scheduler.parse_trigger("0 9 13 * 1")
+    assert scheduler.next_time(trigger, local(2026, 3, 10)) == local(2026, 3, 13, 9)
+    assert scheduler.next_time(trigger, local(2026, 3, 14)) == local(2026, 3, 16, 9)
+
+
+def test_cron_29_february(scheduler):
+    trigger = scheduler.parse_trigger("0 12 29 2 *")
+    assert scheduler.next_time(trigger, local(2026, 3, 1)) == local(2028, 2, 29, 12)
+
+
+def test_solar_offsets(scheduler):
+    assert scheduler.parse_trigger("sunset") == ("solar", "sunset", 0)
+    assert scheduler.parse_trigger("sunset+15") == ("solar", "sunset", 15)
+    assert scheduler.parse_trigger("dawn - 10") == ("solar", "dawn", -10)
+
+    noon = 1773144000   # 2026-03-10 12:00 UTC
+    assert scheduler.next_time(scheduler.parse_trigger("sunset"), noon) == noon + 6 * 3600
+    assert scheduler.next_time(scheduler.parse_trigger("sunset+15"), noon) == noon + 6 * 3600 + 15 * 60
+    # Sunrise of the day has passed: the next day's
+    assert scheduler.next_time(scheduler.parse_trigger("sunrise-30"), noon) == noon + 18 * 3600 - 30 * 60
+
+
+def test_solar_missing_days(scheduler):
+    # No dusk in June and July (table of a leap year: day 153 is 1 June)
+    may_31 = 1780228800     # 2026-05-31 12:00 UTC
+    assert scheduler.next_time(scheduler.parse_trigger("dusk"), may_31) == may_31 + 7 * 3600
+    june_1 = may_31 + 86400
+    assert scheduler.next_time(scheduler.parse_trigger("dusk"), june_1) == june_1 + 61 * 86400 + 7 * 3600
+
+
+def test_solar_without_table():
+    scheduler = server.Scheduler([], LED_strip_channels(), filename=None, solar_table=None)
+    with pytest.raises(ValueError):
+        scheduler.parse_trigger("sunset")
+
+
+def test_check_entry(scheduler):
+    with pytest.raises(ValueError):
+        scheduler.check_entry("a", {"trigger": "0 9 * * *", "thing": 0})      # no webthing 0
+    with pytest.raises(ValueError):
+        scheduler.check_entry("a", {"trigger": "0 9 * * *", "scene": "hall"})